@@ -0,0 +1,293 @@
+"""
+In-process stand-in for the Altinn and ID-porten endpoints used by the
+client, for benchmarks. Implements the token exchange, validation, instance
+creation, data upload, process/next, feedback/status, feedback and data
+download endpoints, with configurable latency and error injection.
+
+Usage:
+with FakeAltinn(latency=0.01, error_rate=0.05) as fake:
+    vat_client = VatReturn(
+        {"Authorization": "Bearer x"}, fake.url, fake.url, fake.instance_api_url
+    )
+"""
+import base64
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional
+from urllib.parse import urlsplit
+
+VALIDATION_RESULT = (
+    b'<?xml version="1.0" encoding="UTF-8"?>'
+    b'<valideringsresultat xmlns="no:skatteetaten:fastsetting:avgift:mva:'
+    b'valideringsresultat:v0.1"><status>GODKJENT</status>'
+    b'</valideringsresultat>'
+)
+
+
+def fake_token(lifetime: int = 1800) -> bytes:
+    """An unsigned JWT with an expiry, as returned by the token exchange."""
+    def encode(part: Dict) -> str:
+        raw = json.dumps(part).encode("utf-8")
+        return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+    payload = {"exp": int(time.time()) + lifetime}
+    return f"{encode({'alg': 'none'})}.{encode(payload)}.x".encode("ascii")
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out in separate writes; without this the
+    # delayed ACK of the client adds ~40 ms to every response.
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def _read_body(self) -> int:
+        """Reads and discards the request body, returning its size."""
+        size = 0
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            while True:
+                chunk_size = int(self.rfile.readline().split(b";")[0], 16)
+                if chunk_size == 0:
+                    self.rfile.readline()
+                    return size
+                self._discard(chunk_size)
+                self.rfile.readline()
+                size += chunk_size
+        length = int(self.headers.get("Content-Length") or 0)
+        self._discard(length)
+        return length
+
+    def _discard(self, length: int):
+        while length > 0:
+            length -= len(self.rfile.read(min(length, 1024 * 1024)))
+
+    def _send(
+            self, body, status: int = 200,
+            content_type: str = "application/json",
+            headers: Optional[Dict] = None,
+    ):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _handle(self, method: str):
+        fake: FakeAltinn = self.server.fake
+        path = urlsplit(self.path).path
+        received = self._read_body() if method in ("POST", "PUT") else 0
+        fake.count(method, path, received)
+        fake.delay()
+        if fake.inject_error():
+            headers = {}
+            if fake.retry_after is not None:
+                headers["Retry-After"] = str(fake.retry_after)
+            return self._send(
+                {"error": "injected"}, fake.error_status, headers=headers
+            )
+        status, body, content_type = fake.respond(method, path)
+        self._send(body, status, content_type)
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def do_PUT(self):
+        self._handle("PUT")
+
+
+class FakeAltinn:
+    """
+    Fake Altinn, VAT app and validation service on one local port.
+
+    :param latency: Seconds added to every response.
+    :param jitter: Up to this many seconds more, chosen at random.
+    :param slow_rate: Share of responses delayed by slow_latency more, for
+    a latency tail.
+    :param slow_latency: Seconds added to the slow responses.
+    :param error_rate: Share of requests answered with error_status.
+    :param error_status: Status of injected errors.
+    :param retry_after: Retry-After seconds sent with injected errors.
+    :param feedback_after: Status polls answered false before feedback is
+    provided for an instance.
+    :param feedback_file_size: Bytes of each downloadable feedback file.
+    :param seed: Seed for latency jitter and error injection.
+    """
+
+    def __init__(
+            self,
+            latency: float = 0.0,
+            jitter: float = 0.0,
+            slow_rate: float = 0.0,
+            slow_latency: float = 0.0,
+            error_rate: float = 0.0,
+            error_status: int = 503,
+            retry_after: Optional[float] = None,
+            feedback_after: int = 0,
+            feedback_file_size: int = 64 * 1024,
+            seed: Optional[int] = None,
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.retry_after = retry_after
+        self.feedback_after = feedback_after
+        self.feedback_file = b"k" * feedback_file_size
+        self.requests: Dict[str, int] = {}
+        self.bytes_received = 0
+        self._random = random.Random(seed)
+        self._instances: Dict[str, Dict] = {}
+        self._lock = threading.Lock()
+        self._server: Optional[ThreadingHTTPServer] = None
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self._server.server_port}"
+
+    @property
+    def instance_api_url(self) -> str:
+        return f"{self.url}/skd/mva-melding-innsending-etm2/instances"
+
+    @property
+    def total_requests(self) -> int:
+        with self._lock:
+            return sum(self.requests.values())
+
+    def start(self) -> "FakeAltinn":
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        self._server.daemon_threads = True
+        self._server.fake = self
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def count(self, method: str, path: str, received: int):
+        endpoint = f"{method} {self._endpoint(path)}"
+        with self._lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+            self.bytes_received += received
+
+    def delay(self):
+        if self.latency or self.jitter or self.slow_rate:
+            with self._lock:
+                extra = self._random.uniform(0, self.jitter)
+                if self._random.random() < self.slow_rate:
+                    extra += self.slow_latency
+            time.sleep(self.latency + extra)
+
+    def inject_error(self) -> bool:
+        if not self.error_rate:
+            return False
+        with self._lock:
+            return self._random.random() < self.error_rate
+
+    @staticmethod
+    def _endpoint(path: str) -> str:
+        """Endpoint name of a path, used for request counts."""
+        for suffix in (
+                "exchange/id-porten", "valider", "instances", "process/next",
+                "feedback/status", "feedback",
+        ):
+            if path.endswith(suffix):
+                return suffix
+        return "data" if "/data" in path else "other"
+
+    def _instance(self, instance_id: str) -> Dict:
+        base = f"{self.instance_api_url}/{instance_id}"
+        instance = self._instances[instance_id]
+        return {
+            "id": instance_id,
+            "selfLinks": {"apps": base},
+            "process": {"currentTask": {"elementId": instance["task"]}},
+            "data": [
+                {
+                    "id": element_id,
+                    "dataType": data_type,
+                    "filename": filename,
+                    "selfLinks": {"apps": f"{base}/data/{element_id}"},
+                }
+                for element_id, data_type, filename in instance["data"]
+            ],
+        }
+
+    def respond(self, method: str, path: str):
+        """Status, body and content type for a request."""
+        endpoint = self._endpoint(path)
+        if endpoint == "exchange/id-porten":
+            return 200, fake_token(), "text/plain"
+        if endpoint == "valider":
+            return 200, VALIDATION_RESULT, "application/xml"
+        if endpoint == "instances" and method == "POST":
+            instance_id = f"50000000/{uuid.uuid4()}"
+            with self._lock:
+                self._instances[instance_id] = {
+                    "task": "Task_1",
+                    "polls": 0,
+                    "feedback": False,
+                    "data": [(str(uuid.uuid4()), "mvameldinginnsending",
+                              None)],
+                }
+                return 201, self._instance(instance_id), "application/json"
+        instance_id = self._instance_id(path)
+        with self._lock:
+            if instance_id not in self._instances:
+                return 404, {"error": "unknown instance"}, "application/json"
+            instance = self._instances[instance_id]
+            if endpoint == "process/next":
+                task = int(instance["task"].split("_")[1]) + 1
+                instance["task"] = f"Task_{task}"
+                return 200, {"currentTask": {"elementId": instance["task"]}}, \
+                    "application/json"
+            if endpoint == "feedback/status":
+                instance["polls"] += 1
+                provided = instance["polls"] > self.feedback_after
+                if provided and not instance["feedback"]:
+                    instance["feedback"] = True
+                    instance["data"].append(
+                        (str(uuid.uuid4()), "kvittering", "kvittering.xml")
+                    )
+                return 200, {"isFeedbackProvided": provided}, \
+                    "application/json"
+            if endpoint == "feedback":
+                return 200, self._instance(instance_id), "application/json"
+            if endpoint == "data" and method == "GET":
+                return 200, self.feedback_file, "application/octet-stream"
+            if endpoint == "data":
+                element_id = path.rsplit("/", 1)[-1] if method == "PUT" \
+                    else str(uuid.uuid4())
+                if method == "POST":
+                    instance["data"].append((element_id, "binaerVedlegg",
+                                             None))
+                return (200 if method == "PUT" else 201), \
+                    {"id": element_id, "instanceGuid": instance_id}, \
+                    "application/json"
+        return 404, {"error": "not found"}, "application/json"
+
+    def _instance_id(self, path: str) -> str:
+        rest = path.split("/instances/", 1)[-1].split("/")
+        return "/".join(rest[:2])
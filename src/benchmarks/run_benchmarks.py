@@ -0,0 +1,431 @@
+"""
+Benchmarks of the client against the local FakeAltinn.
+Each scenario runs in its own process so its peak RSS is its own, and is
+reported as requests/sec, p50/p99 call latency and peak RSS, compared with
+baselines.json.
+
+Run from this folder:
+python run_benchmarks.py                      # all scenarios
+python run_benchmarks.py bulk_filings         # some scenarios
+python run_benchmarks.py --update-baselines   # store the results
+
+Exits with 1 when a scenario is slower or uses more memory than its
+baseline by more than the tolerance. Baselines depend on the machine, so
+record them on the one the benchmarks are run on.
+"""
+import argparse
+import contextlib
+import io
+import json
+import math
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List
+
+BENCHMARK_DIR = Path(__file__).resolve().parent
+CLIENT_DIR = BENCHMARK_DIR.parent / "vat_return_client"
+EXAMPLE_FILES = CLIENT_DIR / "example_files"
+BASELINES_FILE = BENCHMARK_DIR / "baselines.json"
+sys.path[:0] = [str(CLIENT_DIR), str(BENCHMARK_DIR)]
+
+from fake_altinn import FakeAltinn  # noqa: E402
+
+
+def _percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(math.ceil(p / 100 * len(ordered)) - 1, 0)]
+
+
+def _peak_rss_mb() -> float:
+    """Peak resident set size of this process (ru_maxrss is KiB on Linux)."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+class Bench:
+    """
+    Measuring context handed to a scenario. Call 'start' after the setup
+    that should not count, e.g. creating instances to poll.
+    """
+
+    def __init__(self, fake: FakeAltinn, workdir: Path):
+        from metrics import INSTRUMENTATION
+
+        self.fake = fake
+        self.workdir = workdir
+        self.durations: List[float] = []
+        self.errors = 0
+        self._requests_at_start = 0
+        self._started = time.perf_counter()
+        INSTRUMENTATION.add_hook(self._on_call)
+
+    def _on_call(self, event):
+        self.durations.append(event.duration)
+        if event.error or (event.status_code or 0) >= 400:
+            self.errors += 1
+
+    def start(self):
+        self.durations = []
+        self.errors = 0
+        self._requests_at_start = self.fake.total_requests
+        self._started = time.perf_counter()
+
+    def client(self, pool_size: int = 10, **transport_options):
+        from client import VatReturn
+        from transport import Transport
+
+        vat_client = VatReturn(
+            id_porten_auth_headers={"Authorization": "Bearer benchmark"},
+            altinn_environment=self.fake.url,
+            id_porten_environment=self.fake.url,
+            instance_api_url=self.fake.instance_api_url,
+            transport=Transport(pool_size=pool_size, **transport_options),
+        )
+        vat_client.set_altinn_token()
+        return vat_client
+
+    def filing(self, org_number: str, attachments: int = 1):
+        from submission import Attachment, Filing
+
+        return Filing(
+            org_number=org_number,
+            message=EXAMPLE_FILES / "message" / "compensation_vat_message.xml",
+            envelope=EXAMPLE_FILES / "envelope" / "compensation_vat_envelope.xml",
+            attachments=[
+                Attachment(
+                    content_type="text/xml",
+                    file_name=f"vedlegg_{index}.xml",
+                    path=EXAMPLE_FILES / "appendix" / "vat_appendix.xml",
+                )
+                for index in range(attachments)
+            ],
+        )
+
+    def result(self, operations: int) -> Dict:
+        wall_time = time.perf_counter() - self._started
+        requests = self.fake.total_requests - self._requests_at_start
+        return {
+            "operations": operations,
+            "requests": requests,
+            "errors": self.errors,
+            "wall_time": round(wall_time, 3),
+            "requests_per_second": round(requests / wall_time, 1),
+            "p50_ms": round(_percentile(self.durations, 50) * 1000, 2),
+            "p99_ms": round(_percentile(self.durations, 99) * 1000, 2),
+            "peak_rss_mb": round(_peak_rss_mb(), 1),
+        }
+
+
+def single_filing(bench: Bench) -> Dict:
+    """One filing at a time through the whole flow, feedback included."""
+    from submission import submit_filing
+
+    vat_client = bench.client()
+    bench.start()
+    filings = 25
+    for index in range(filings):
+        result = submit_filing(vat_client, bench.filing(str(index)))
+        assert result.ok, result.error
+    return bench.result(filings)
+
+
+def bulk_filings(bench: Bench) -> Dict:
+    """Many filings at once through run_bulk with a shared pool."""
+    from bulk import run_bulk
+
+    vat_client = bench.client(pool_size=32)
+    filings = [bench.filing(str(index), attachments=2) for index in range(300)]
+    bench.start()
+    summary = run_bulk(
+        vat_client, filings, max_workers=32,
+        stage_limits={"create": 16, "ship": 16},
+    )
+    assert summary.failed == 0, summary.results[0].error
+    return bench.result(len(filings))
+
+
+def throttled_bulk_filings(bench: Bench) -> Dict:
+    """Bulk filings against a host throttling 2% of requests."""
+    from bulk import run_bulk
+    from rate_limit import RateLimiter
+
+    vat_client = bench.client(
+        pool_size=32,
+        rate_limiter=RateLimiter(
+            rates={bench.fake.url: 2000}, initial_limit=32
+        ),
+    )
+    filings = [bench.filing(str(index)) for index in range(200)]
+    bench.start()
+    summary = run_bulk(vat_client, filings, max_workers=32)
+    assert summary.failed == 0, summary.results[0].error
+    return bench.result(len(filings))
+
+
+def large_attachments(bench: Bench) -> Dict:
+    """Streaming upload of large attachments, where memory use matters."""
+    from submission import Attachment
+
+    size = 20 * 1024 * 1024
+    paths = []
+    for index in range(4):
+        path = bench.workdir / f"large_{index}.pdf"
+        with open(path, "wb") as file:
+            for _ in range(size // (1024 * 1024)):
+                file.write(os.urandom(1024 * 1024))
+        paths.append(path)
+    vat_client = bench.client(pool_size=4)
+    instance = vat_client.create_instance("0")
+    attachments = [
+        Attachment("application/pdf", path.name, path) for path in paths
+    ]
+    bench.start()
+    uploads = vat_client.upload_attachments_batch(
+        instance_url=instance["selfLinks"]["apps"],
+        attachments=[
+            (attachment.content_type, attachment.file_name, attachment.path)
+            for attachment in attachments
+        ],
+        max_workers=4,
+    )
+    assert all(upload.ok for upload in uploads), uploads
+    result = bench.result(len(uploads))
+    result["mb_per_second"] = round(
+        len(paths) * size / (1024 * 1024) / result["wall_time"], 1
+    )
+    return result
+
+
+def feedback_polling(bench: Bench) -> Dict:
+    """Many instances waiting for feedback on one FeedbackPoller."""
+    from feedback_poller import FeedbackPoller
+
+    bench.fake.feedback_after = 3
+    vat_client = bench.client(pool_size=8)
+    instance_urls = [
+        vat_client.create_instance(str(index))["selfLinks"]["apps"]
+        for index in range(500)
+    ]
+    bench.start()
+    with FeedbackPoller(
+            vat_client, workers=8, initial_delay=0.02, max_delay=0.2,
+            backoff=1.5, timeout=60,
+    ) as poller:
+        for instance_url in instance_urls:
+            poller.add(instance_url)
+        results = list(poller.results(timeout=120))
+    assert all(result.status == "feedback" for result in results), results[0]
+    return bench.result(len(results))
+
+
+def hedged_status_polls(bench: Bench) -> Dict:
+    """
+    Feedback status calls against a host answering 2% of requests slowly,
+    hedged with a HedgePolicy. Latencies are those seen by the caller.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from hedging import HedgePolicy
+
+    vat_client = bench.client(pool_size=16)
+    vat_client.hedging = HedgePolicy(budget=0.1)
+    instance_url = vat_client.create_instance("0")["selfLinks"]["apps"]
+    calls = 2000
+
+    def poll(_):
+        start = time.perf_counter()
+        vat_client.get_feedback_status(instance_url)
+        return time.perf_counter() - start
+
+    bench.start()
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        latencies = list(executor.map(poll, range(calls)))
+    result = bench.result(calls)
+    result["p50_ms"] = round(_percentile(latencies, 50) * 1000, 2)
+    result["p99_ms"] = round(_percentile(latencies, 99) * 1000, 2)
+    stats = vat_client.hedging.stats()["get_feedback_status"]
+    result["hedged"] = stats["hedged"]
+    result["hedge_wins"] = stats["hedge_wins"]
+    vat_client.hedging.close()
+    return result
+
+
+# Modules the validate path with a pre-supplied token must not import.
+HEAVY_MODULES = (
+    "aiohttp", "cryptography", "http.server", "jwt", "lxml", "numpy",
+    "webbrowser",
+)
+
+_CLI_RUN = """
+import json, sys, time
+start = time.perf_counter()
+sys.path.insert(0, {client_dir!r})
+import cli
+imported = time.perf_counter() - start
+cli.main({argv!r})
+print(json.dumps({{
+    "import_ms": imported * 1000,
+    "heavy_modules": [m for m in {heavy!r} if m in sys.modules],
+}}), file=sys.stderr)
+"""
+
+
+def cli_startup(bench: Bench) -> Dict:
+    """
+    Short-lived 'python cli.py validate' processes with a pre-supplied token,
+    as run by cron jobs: process start-up, import time of the CLI and the
+    heavy modules loaded on the way.
+    """
+    argv = [
+        "--validation-url", bench.fake.url,
+        "validate", str(EXAMPLE_FILES / "message" /
+                        "compensation_vat_message.xml"),
+    ]
+    code = _CLI_RUN.format(
+        client_dir=str(CLIENT_DIR), argv=argv, heavy=HEAVY_MODULES
+    )
+    environment = dict(os.environ, ID_PORTEN_TOKEN="Bearer benchmark")
+    startups, imports, heavy = [], [], set()
+    bench.start()
+    runs = 10
+    for _ in range(runs):
+        started = time.perf_counter()
+        process = subprocess.run(
+            [sys.executable, "-c", code], env=environment,
+            check=True, capture_output=True, text=True,
+        )
+        startups.append(time.perf_counter() - started)
+        report = json.loads(process.stderr.strip().splitlines()[-1])
+        imports.append(report["import_ms"])
+        heavy.update(report["heavy_modules"])
+    result = bench.result(runs)
+    # The calls are made by the child processes, not measured here.
+    for metric in ("requests_per_second", "p50_ms", "p99_ms", "peak_rss_mb"):
+        del result[metric]
+    result["startup_ms"] = round(_percentile(startups, 50) * 1000, 1)
+    result["import_ms"] = round(_percentile(imports, 50), 1)
+    result["heavy_modules"] = sorted(heavy)
+    return result
+
+
+# Scenario function and FakeAltinn options.
+SCENARIOS: Dict[str, tuple] = {
+    "single_filing": (single_filing, {"latency": 0.002}),
+    "bulk_filings": (bulk_filings, {"latency": 0.005, "jitter": 0.005}),
+    "throttled_bulk_filings": (throttled_bulk_filings, {
+        "latency": 0.005, "error_rate": 0.02, "retry_after": 0.05,
+    }),
+    "large_attachments": (large_attachments, {}),
+    "feedback_polling": (feedback_polling, {"latency": 0.001}),
+    "hedged_status_polls": (hedged_status_polls, {
+        "latency": 0.002, "slow_rate": 0.02, "slow_latency": 0.2,
+    }),
+    "cli_startup": (cli_startup, {}),
+}
+
+# (metric, higher is better, absolute slack) used against the baselines.
+COMPARED = (
+    ("requests_per_second", True, 0.0),
+    ("p50_ms", False, 1.0),
+    ("p99_ms", False, 2.0),
+    ("peak_rss_mb", False, 5.0),
+    ("startup_ms", False, 30.0),
+    ("import_ms", False, 20.0),
+)
+
+# How each reported metric is printed.
+PRINTED = (
+    ("requests_per_second", "{:9.1f} req/s"),
+    ("p50_ms", "p50 {:7.2f} ms"),
+    ("p99_ms", "p99 {:7.2f} ms"),
+    ("peak_rss_mb", "peak RSS {:6.1f} MB"),
+    ("startup_ms", "start-up {:6.1f} ms"),
+    ("import_ms", "import {:6.1f} ms"),
+)
+
+
+def run_scenario(name: str) -> Dict:
+    """Runs one scenario in this process."""
+    function, options = SCENARIOS[name]
+    with FakeAltinn(seed=1, **options) as fake, \
+            tempfile.TemporaryDirectory() as workdir, \
+            contextlib.redirect_stdout(io.StringIO()):
+        return function(Bench(fake, Path(workdir)))
+
+
+def run_isolated(name: str) -> Dict:
+    """Runs one scenario in a child process and returns its result."""
+    output = subprocess.run(
+        [sys.executable, __file__, "--child", name],
+        check=True, capture_output=True, text=True, cwd=str(CLIENT_DIR),
+    ).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def regressions(result: Dict, baseline: Dict, tolerance: float) -> List[str]:
+    """Metrics of a result worse than the baseline by more than allowed."""
+    found = []
+    for metric, higher_is_better, slack in COMPARED:
+        if metric not in baseline:
+            continue
+        expected = baseline[metric]
+        if higher_is_better:
+            worse = result[metric] < expected * (1 - tolerance) - slack
+        else:
+            worse = result[metric] > max(expected * (1 + tolerance),
+                                         expected + slack)
+        if worse:
+            found.append(f"{metric} {result[metric]} (baseline {expected})")
+    if result.get("heavy_modules"):
+        found.append(f"imports {', '.join(result['heavy_modules'])}")
+    return found
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("scenarios", nargs="*",
+                        help=f"Scenarios to run, all by default. One of: "
+                             f"{', '.join(SCENARIOS)}.")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="Allowed relative change from the baseline.")
+    parser.add_argument("--update-baselines", action="store_true",
+                        help="Store the results as the new baselines.")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+    if args.child:
+        print(json.dumps(run_scenario(args.child)))
+        return 0
+
+    baselines = json.loads(BASELINES_FILE.read_text()) \
+        if BASELINES_FILE.exists() else {}
+    failed = False
+    results = {}
+    for name in args.scenarios or list(SCENARIOS):
+        result = results[name] = run_isolated(name)
+        problems = regressions(result, baselines.get(name, {}), args.tolerance)
+        failed = failed or bool(problems)
+        print(
+            f"{name:22} " + "  ".join(
+                text.format(result[metric])
+                for metric, text in PRINTED if metric in result
+            ) + ("  REGRESSED: " + ", ".join(problems) if problems else "")
+        )
+    if args.update_baselines:
+        baselines.update(results)
+        BASELINES_FILE.write_text(json.dumps(baselines, indent=2) + "\n")
+        return 0
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
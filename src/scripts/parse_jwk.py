@@ -1,15 +1,36 @@
 """
 Script to create a jwk object used for defining the public key in ID
 porten integration.
+
+python parse_jwk.py client_key.pem [kid]
+
+Writes the private key to the given file (readable by the owner only) and
+prints the public key as a JWK to register with the integration. Point
+CLIENT_PRIVATE_KEY_FILE at the file and set CLIENT_KEY_ID to the kid to
+use it with CLIENT_AUTHENTICATION_METHOD=private_key_jwt.
 """
 import hashlib
+import json
+import os
 import secrets
+import sys
 import base64
+import uuid
 
 
+from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.primitives.asymmetric import rsa
 
+
+def _base64url_uint(value: int) -> str:
+    """A JWK integer: big endian bytes, base64url without padding."""
+    data = value.to_bytes((value.bit_length() + 7) // 8, "big")
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
 if __name__ == "__main__":
+    key_file = sys.argv[1] if len(sys.argv) > 1 else "client_key.pem"
+    kid = sys.argv[2] if len(sys.argv) > 2 else str(uuid.uuid4())
 
     # Generate a new RSA private key
     private_key = rsa.generate_private_key(
@@ -17,20 +38,42 @@ if __name__ == "__main__":
         key_size=2048,  # Use 2048 bits in accordance with documentation.
     )
 
+    # Keep the private key for signing client assertions.
+    descriptor = os.open(
+        key_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600
+    )
+    with os.fdopen(descriptor, "wb") as file:
+        file.write(private_key.private_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PrivateFormat.PKCS8,
+            encryption_algorithm=serialization.NoEncryption(),
+        ))
+
     # Access the modulus (n)
-    modulus = private_key.public_key().public_numbers().n
+    public_numbers = private_key.public_key().public_numbers()
+    modulus = public_numbers.n
 
     print(modulus)
 
+    # The public key to register with the integration.
+    print(json.dumps({
+        "kty": "RSA",
+        "kid": kid,
+        "alg": "RS256",
+        "use": "sig",
+        "e": _base64url_uint(public_numbers.e),
+        "n": _base64url_uint(modulus),
+    }, indent=2))
+
     # Sequence to add into each log in operation. Remember these values
     # in notepad for now.
     code_verifier = secrets.token_urlsafe(64)
     print(code_verifier)
 
-    code_challenge = base64.urlsafe_b64decode(
+    code_challenge = base64.urlsafe_b64encode(
         hashlib.sha256(
             code_verifier.encode()
         ).digest()
-    ).rstrip(b="=").decode()
+    ).rstrip(b"=").decode()
 
     print(code_challenge)
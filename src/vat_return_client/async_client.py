@@ -0,0 +1,980 @@
+"""
+The asyncio VAT Return Client.
+Mirrors 'client.VatReturn' method by method, but every call is a coroutine
+and all clients created with the same AsyncTransport share one connection
+pool. One event loop can then drive many submissions at once.
+"""
+import asyncio
+import functools
+import io
+import json
+import logging
+import time
+from pathlib import Path
+from typing import Union, Dict, Optional, List, Sequence, Iterable, Tuple
+
+import aiohttp
+
+from attachments import (
+    AttachmentItem,
+    AttachmentUpload,
+    batch_results,
+    check_attachments,
+)
+from downloads import (
+    DownloadSink,
+    FeedbackDownload,
+    download_name,
+    feedback_data_elements,
+    open_sink,
+    sink_name,
+)
+from metrics import (
+    INSTRUMENTATION,
+    CallEvent,
+    Instrumentation,
+    body_size,
+    current_operation,
+    host_of,
+    instrumented,
+    operation,
+)
+from rate_limit import (
+    RateLimiter,
+    latency_class,
+    rewind_body,
+    throttle_outcome,
+)
+from streaming import (
+    CHUNK_SIZE,
+    UploadBody,
+    UploadSource,
+    open_upload,
+    upload_body,
+)
+from settings import (
+    HTTP_POOL_SIZE,
+    HTTP_CONNECT_TIMEOUT,
+    HTTP_READ_TIMEOUT,
+    HTTP_KEEP_ALIVE,
+)
+from token_cache import AltinnTokenManager
+from validation_cache import ValidationCache
+from validation_result import (
+    ValidationParser,
+    ValidationResult,
+    parse_validation,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def _with_length(headers: Dict, body: UploadBody) -> Dict:
+    """
+    Adds Content-Length for bodies of known size. aiohttp uses chunked
+    transfer for streamed bodies without it.
+    """
+    if body.length is not None:
+        headers = dict(headers)
+        headers["Content-Length"] = str(body.length)
+    return headers
+
+
+async def _chunks(body: UploadBody):
+    """
+    Reads the body chunk by chunk in a thread, so disk reads do not block
+    the loop. Used instead of handing aiohttp the file-like body, which it
+    closes after sending and which could then not be retried.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        chunk = await loop.run_in_executor(None, body.read, body.chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+
+class AsyncResponse:
+    """
+    The parts of an aiohttp response the client needs, read in full so
+    that the connection is released back to the pool right away.
+    """
+
+    def __init__(
+            self,
+            status_code: int,
+            headers: Dict,
+            content: bytes,
+            request_info: Optional[aiohttp.RequestInfo] = None,
+    ):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.request_info = request_info
+
+    def json(self):
+        return json.loads(self.content.decode("utf-8"))
+
+    def raise_for_status(self):
+        """Raises aiohttp.ClientResponseError for 4xx and 5xx responses."""
+        if self.status_code >= 400:
+            raise aiohttp.ClientResponseError(
+                self.request_info, (),
+                status=self.status_code,
+                message=self.content.decode("utf-8", "replace")[:200],
+                headers=self.headers,
+            )
+
+    def __repr__(self):
+        return f"<AsyncResponse [{self.status_code}]>"
+
+
+class AsyncTransport:
+    """
+    Pooled asyncio HTTP transport. The aiohttp session is created lazily
+    on first use, so the transport can be constructed outside of a running
+    event loop. Use 'close' (or 'async with') when done.
+
+    :param pool_size: Max connections kept open per host.
+    :param connect_timeout: Seconds to wait for a connection.
+    :param read_timeout: Seconds to wait for the server to send data.
+    :param keep_alive: Keep connections open between requests.
+    :param rate_limiter: Optional rate_limit.RateLimiter, see Transport.
+    :param max_throttle_retries: Retries of a throttled request.
+    :param instrumentation: Hooks called with a metrics.CallEvent per
+    request, defaults to metrics.INSTRUMENTATION. Calls made with 'stream'
+    are not reported.
+    """
+
+    def __init__(
+            self,
+            pool_size: int = HTTP_POOL_SIZE,
+            connect_timeout: float = HTTP_CONNECT_TIMEOUT,
+            read_timeout: float = HTTP_READ_TIMEOUT,
+            keep_alive: bool = HTTP_KEEP_ALIVE,
+            rate_limiter: Optional[RateLimiter] = None,
+            max_throttle_retries: int = 3,
+            instrumentation: Optional[Instrumentation] = None,
+    ):
+        self.pool_size = pool_size
+        self.timeout = aiohttp.ClientTimeout(
+            sock_connect=connect_timeout, sock_read=read_timeout
+        )
+        self.keep_alive = keep_alive
+        self.rate_limiter = rate_limiter
+        self.max_throttle_retries = max_throttle_retries
+        self.instrumentation = instrumentation or INSTRUMENTATION
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._stats = {"requests": 0, "connections": 0, "reused": 0}
+
+    def _trace_config(self) -> aiohttp.TraceConfig:
+        trace_config = aiohttp.TraceConfig()
+
+        async def on_request_start(session, context, params):
+            self._stats["requests"] += 1
+
+        async def on_connection_create_end(session, context, params):
+            self._stats["connections"] += 1
+
+        async def on_connection_reuseconn(session, context, params):
+            self._stats["reused"] += 1
+
+        trace_config.on_request_start.append(on_request_start)
+        trace_config.on_connection_create_end.append(on_connection_create_end)
+        trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+        return trace_config
+
+    @staticmethod
+    def _phase_trace_config() -> aiohttp.TraceConfig:
+        """
+        Records phase timings and bytes sent into the dict passed as
+        'trace_request_ctx', which is only done while instrumenting.
+        aiohttp opens the connection and does TLS in one step, so the tls
+        phase is part of connect.
+        """
+        trace_config = aiohttp.TraceConfig()
+
+        def mark(name):
+            async def callback(session, context, params):
+                phases = context.trace_request_ctx
+                if phases is not None:
+                    phases[name] = time.perf_counter()
+            return callback
+
+        def measure(name, started):
+            async def callback(session, context, params):
+                phases = context.trace_request_ctx
+                if phases is not None and started in phases:
+                    phases[name] = time.perf_counter() - phases.pop(started)
+            return callback
+
+        async def on_request_chunk_sent(session, context, params):
+            phases = context.trace_request_ctx
+            if phases is not None:
+                phases["bytes_sent"] = \
+                    phases.get("bytes_sent", 0) + len(params.chunk)
+
+        trace_config.on_dns_resolvehost_start.append(mark("dns_start"))
+        trace_config.on_dns_resolvehost_end.append(measure("dns", "dns_start"))
+        trace_config.on_connection_create_start.append(mark("connect_start"))
+        trace_config.on_connection_create_end.append(
+            measure("connect", "connect_start")
+        )
+        trace_config.on_request_headers_sent.append(mark("ttfb_start"))
+        trace_config.on_request_end.append(measure("ttfb", "ttfb_start"))
+        trace_config.on_request_chunk_sent.append(on_request_chunk_sent)
+        return trace_config
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        """The shared session, created on first access."""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=0,
+                limit_per_host=self.pool_size,
+                force_close=not self.keep_alive,
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=self.timeout,
+                trace_configs=[
+                    self._trace_config(), self._phase_trace_config()
+                ],
+            )
+        return self._session
+
+    async def request(self, method: str, url: str, **kwargs) -> AsyncResponse:
+        """
+        Sends a request on the shared session and reads the body.
+        Takes the same keyword arguments as 'aiohttp.ClientSession.request'.
+        """
+        if not self.instrumentation.enabled:
+            return (await self._send_with_retries(method, url, kwargs))[0]
+        return await self._observed(method, url, kwargs)
+
+    async def _observed(
+            self, method: str, url: str, kwargs: Dict
+    ) -> AsyncResponse:
+        """Sends a request and emits its CallEvent."""
+        event = CallEvent(current_operation(), method, host_of(url))
+        phases = kwargs["trace_request_ctx"] = {}
+        start = time.perf_counter()
+        try:
+            response, event.retries = await self._send_with_retries(
+                method, url, kwargs
+            )
+        except Exception as error:
+            event.error = type(error).__name__
+            raise
+        else:
+            event.status_code = response.status_code
+            event.bytes_received = len(response.content)
+            return response
+        finally:
+            event.duration = time.perf_counter() - start
+            event.bytes_sent = phases.get("bytes_sent", 0)
+            # The dns, connect and ttfb of the last attempt.
+            event.dns = phases.get("dns")
+            event.connect = phases.get("connect")
+            if event.connect is not None and event.dns is not None:
+                event.connect = max(event.connect - event.dns, 0.0)
+            event.ttfb = phases.get("ttfb")
+            self.instrumentation.emit(event)
+
+    async def _send_with_retries(
+            self, method: str, url: str, kwargs: Dict
+    ) -> Tuple[AsyncResponse, int]:
+        """Sends a request; returns the response and the retry count."""
+        if self.rate_limiter is None:
+            return await self._send(method, url, **kwargs), 0
+        limiter = self.rate_limiter.for_url(url)
+        attempt = 0
+        while True:
+            await limiter.acquire_async()
+            start = time.monotonic()
+            status_code = None
+            throttled, retry_after = False, None
+            try:
+                response = await self._send(method, url, **kwargs)
+                status_code = response.status_code
+                throttled, retry_after = throttle_outcome(
+                    status_code, response.headers
+                )
+            finally:
+                limiter.release(
+                    time.monotonic() - start, status_code, retry_after,
+                    kind=latency_class(
+                        current_operation(),
+                        body_size(kwargs.get("data"), kwargs.get("json")),
+                    ),
+                )
+            if not throttled or attempt >= self.max_throttle_retries or \
+                    not rewind_body(kwargs.get("data")):
+                return response, attempt
+            attempt += 1
+            # With Retry-After the limiter holds the next acquire back.
+            if retry_after is None:
+                await asyncio.sleep(min(0.5 * 2 ** attempt, 30))
+
+    async def _send(self, method: str, url: str, **kwargs) -> AsyncResponse:
+        async with self.session.request(method, url, **kwargs) as response:
+            content = await response.read()
+            return AsyncResponse(
+                response.status, response.headers, content,
+                response.request_info,
+            )
+
+    def stream(self, method: str, url: str, **kwargs):
+        """
+        Sends a request without reading the body. Use as
+        'async with transport.stream(...) as response' and read the body
+        from 'response.content' in chunks.
+        """
+        return self.session.request(method, url, **kwargs)
+
+    async def get(self, url: str, **kwargs) -> AsyncResponse:
+        return await self.request("GET", url, **kwargs)
+
+    async def post(self, url: str, **kwargs) -> AsyncResponse:
+        return await self.request("POST", url, **kwargs)
+
+    async def put(self, url: str, **kwargs) -> AsyncResponse:
+        return await self.request("PUT", url, **kwargs)
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Pool reuse statistics.
+
+        :return: Number of requests sent, connections opened and requests
+        that reused an already open connection.
+        """
+        return dict(self._stats)
+
+    async def close(self):
+        """Closes every pooled connection."""
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+
+class AsyncVatReturn:
+    """
+    Asyncio version of 'client.VatReturn'. Takes the same arguments and
+    returns the same values; only the calls have to be awaited.
+
+    Url patterns:
+    instance = await create_instance(...)
+    instance_url = instance["selfLinks"]["apps"]
+    instance_data_url = instance["data"][0]["selfLinks"]["apps"]
+
+    Pass the same AsyncTransport to every client to share one pool.
+
+    'token_manager', 'instance_index' and 'hedging' work as in VatReturn;
+    the token manager and hedge policy can be shared with sync clients.
+    With a token manager every call awaits a valid Altinn token, and
+    concurrent coroutines share one exchange.
+
+    The SQLite calls of the instance index and validation cache and the
+    XSD check run in the loop's default executor, so they do not block
+    other coroutines.
+    """
+
+    def __init__(
+            self,
+            id_porten_auth_headers: Dict,
+            altinn_environment: str,
+            id_porten_environment: str,
+            instance_api_url: str,
+            transport: Optional[AsyncTransport] = None,
+            token_manager: Optional[AltinnTokenManager] = None,
+            xsd_validator=None,
+            validation_cache: Optional[ValidationCache] = None,
+            instance_index=None,
+            hedging=None,
+    ):
+        self.id_porten_auth_headers = id_porten_auth_headers
+        self.altinn_environment = altinn_environment
+        self.id_porten_environment = id_porten_environment
+        self.instance_api_url = instance_api_url
+        self._altinn_token = None
+        self.transport = transport or AsyncTransport()
+        self.token_manager = token_manager
+        self.xsd_validator = xsd_validator
+        self.validation_cache = validation_cache
+        self.instance_index = instance_index
+        self.hedging = hedging
+
+    @property
+    def altinn_token(self) -> str:
+        """
+        The Altinn token. With a token manager, the token it has cached for
+        this identity; await 'set_altinn_token' first, a property cannot
+        await an exchange.
+        """
+        if self.token_manager is not None and self._altinn_token is None:
+            return self.token_manager.cached_token(
+                self.id_porten_auth_headers
+            )
+        return self._altinn_token
+
+    @altinn_token.setter
+    def altinn_token(self, token: str):
+        self._altinn_token = token
+
+    async def set_altinn_token(self):
+        """
+        Exchanges the ID-porten token to a Altinn token. Sets the attribute
+        altinn_token. With a token manager the token is taken from (and
+        kept in) its cache instead, and refreshed when it nears expiry.
+        """
+        if self.token_manager is not None:
+            self._altinn_token = None
+            await self.token_manager.get_token_async(
+                self.id_porten_auth_headers, self._exchange_altinn_token
+            )
+            return
+        self.altinn_token = await self._exchange_altinn_token()
+
+    async def _token(self) -> str:
+        """The Altinn token to send, from the token manager if there is one."""
+        if self.token_manager is not None and self._altinn_token is None:
+            return await self.token_manager.get_token_async(
+                self.id_porten_auth_headers, self._exchange_altinn_token
+            )
+        return self._altinn_token
+
+    @staticmethod
+    async def _blocking(function, *args):
+        """Runs a blocking call (SQLite, lxml) in the default executor."""
+        return await asyncio.get_running_loop().run_in_executor(
+            None, functools.partial(function, *args)
+        )
+
+    async def _read(self, send, url: str, **kwargs) -> AsyncResponse:
+        """
+        Sends an idempotent, read-only request with 'send' (a transport
+        method), hedged when the client has a hedging policy.
+        """
+        if self.hedging is None:
+            return await send(url, **kwargs)
+        return await self.hedging.call_async(lambda: send(url, **kwargs))
+
+    @instrumented
+    async def _exchange_altinn_token(self) -> str:
+        """Calls the ID-porten to Altinn token exchange endpoint."""
+        exchange_token_url = (
+            f"{self.altinn_environment}/authentication/api/v1/exchange/id-porten"
+        )
+        headers = dict(self.id_porten_auth_headers)
+        headers["content-type"] = "application/json"
+        response = await self.transport.get(exchange_token_url, headers=headers)
+        response.raise_for_status()
+        return response.content.decode("utf-8")
+
+    @instrumented
+    async def validate_tax_return(
+            self, body: bytes, use_cache: bool = True
+    ) -> str:
+        """
+        Validates the content of a tax return and returns a response with
+        any errors, deviations, and warnings.
+
+        :param body: VAT message.
+        :return: Validation result as xml string.
+        :raises xsd_validation.SchemaValidationError: With an xsd_validator,
+        when the message fails the local check. Nothing is sent then.
+        """
+        key, cached = await self._cached_validation(body, use_cache)
+        if cached is not None:
+            return cached
+        url, headers = await self._validation_request(body)
+        validate_response = await self._read(
+            self.transport.post, url, headers=headers, data=body
+        )
+        result = validate_response.content.decode("utf-8")
+        if key is not None and validate_response.status_code == 200:
+            await self._blocking(self.validation_cache.put, key, result)
+        return result
+
+    @instrumented
+    async def validate_tax_return_result(
+            self, body: bytes, use_cache: bool = True
+    ) -> ValidationResult:
+        """
+        Validates like 'validate_tax_return', but parses the response into
+        a validation_result.ValidationResult chunk by chunk as it arrives.
+
+        :param body: VAT message.
+        :return: Status, counts per severity and the findings.
+        """
+        key, cached = await self._cached_validation(body, use_cache)
+        if cached is not None:
+            return parse_validation(cached)
+        url, headers = await self._validation_request(body)
+        parser = ValidationParser()
+        received = []
+        async with self.transport.stream(
+                "POST", url, headers=headers, data=body
+        ) as response:
+            async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                received.append(chunk)
+                parser.feed(chunk)
+            status_code = response.status
+        result = parser.close()
+        if key is not None and status_code == 200:
+            await self._blocking(
+                self.validation_cache.put, key,
+                b"".join(received).decode("utf-8"),
+            )
+        return result
+
+    async def _cached_validation(self, body: bytes, use_cache: bool):
+        """The cache key of the message and the cached result, if any."""
+        if self.validation_cache is None or not use_cache:
+            return None, None
+        return await self._blocking(self._cache_lookup, body)
+
+    def _cache_lookup(self, body: bytes):
+        key = self.validation_cache.key(body, self.id_porten_environment)
+        return key, self.validation_cache.get(key)
+
+    async def _validation_request(self, body: bytes) -> Tuple[str, Dict]:
+        """The url and headers of the validation, after the XSD check."""
+        if self.xsd_validator is not None:
+            await self._blocking(self.xsd_validator.check_message, body)
+        environment = self.id_porten_environment
+        if "://" not in environment:
+            environment = f"https://{environment}"
+        validate_tax_return_url = (
+            f"{environment}/api/mva/grensesnittstoette/mva-melding/valider"
+        )
+        headers = dict(self.id_porten_auth_headers)
+        headers["Content-Type"] = "application/xml"
+        return validate_tax_return_url, headers
+
+    @instrumented
+    async def create_instance(self, organization_number: str) -> Dict:
+        """
+        Creates an instance object in altinn.
+
+        :param organization_number: Organization number.
+        :return: Instance as dict.
+        """
+        headers = {
+            "Authorization": f"Bearer {await self._token()}",
+            "content-type": "application/json"
+        }
+
+        body = {
+            "instanceOwner": {
+                "organisationNumber": f"{organization_number}"
+                }
+        }
+        response = await self.transport.post(
+            self.instance_api_url, headers=headers, json=body
+        )
+        instance = response.json()
+        if self.instance_index is not None and "selfLinks" in instance:
+            await self._blocking(
+                self.instance_index.record, instance, organization_number
+            )
+        return instance
+
+    @instrumented
+    async def upload_vat_submission(
+            self, instance_data_app_url: str, content: UploadSource
+    ) -> Dict:
+        """
+        Upload VAT return submission by using the data api for the instance.
+
+        :param instance_data_app_url: Url to the data of the instance.
+        :param content: Vat submission, as text or any streaming.UploadSource.
+        :return: Data instance as dict.
+        """
+        headers = {
+            "Authorization": f"Bearer {await self._token()}",
+            "content-type": "application/xml"
+        }
+        with upload_body(content) as body:
+            response = await self.transport.put(
+                instance_data_app_url,
+                headers=_with_length(headers, body),
+                data=_chunks(body),
+            )
+        return response.json()
+
+    @instrumented
+    async def upload_vat_return(
+            self, instance_url: str, content: UploadSource
+    ) -> Dict:
+        """
+        Upload VAT return xml document to the instance.
+
+        :param instance_url: Url to the instance.
+        :param content: Vat message, as bytes or any streaming.UploadSource.
+        :return: Data instance as dict.
+        """
+        headers = {
+            "Authorization": f"Bearer {await self._token()}",
+            "content-type": "text/xml",
+            "Content-Disposition": "attachment; filename=mvaMelding.xml",
+        }
+        url = f"{instance_url}/data?datatype=mvamelding"
+        with upload_body(content) as body:
+            response = await self.transport.post(
+                url, headers=_with_length(headers, body), data=_chunks(body)
+            )
+        return response.json()
+
+    @instrumented
+    async def upload_attachments(
+            self,
+            instance_url: str,
+            content_type: str,
+            file_name: str,
+            content: UploadSource,
+    ) -> Dict:
+        """
+        Upload one attachment to the instance. See
+        'client.VatReturn.upload_attachments' for the allowed content types
+        and limits.
+
+        :param instance_url: Url to the instance.
+        :param content_type: Attachment content-type.
+        :param file_name: Attachment filename with suffix (.pdf, .xml, ...)
+        :param content: Attachment as bytes or any streaming.UploadSource.
+        :return: Data instance as dict.
+        """
+        with upload_body(content) as body:
+            response = await self._post_attachment(
+                instance_url, content_type, file_name, body
+            )
+        return response.json()
+
+    async def _post_attachment(
+            self,
+            instance_url: str,
+            content_type: str,
+            file_name: str,
+            body: UploadBody,
+    ) -> AsyncResponse:
+        url = f"{instance_url}/data?datatype=binaerVedlegg"
+        headers = {
+            "Authorization": f"Bearer {await self._token()}",
+            "content-type": content_type,
+            "Content-Disposition": f"attachment; filename={file_name}",
+        }
+        return await self.transport.post(
+            url, headers=_with_length(headers, body), data=_chunks(body)
+        )
+
+    async def upload_attachments_batch(
+            self,
+            instance_url: str,
+            attachments: Sequence[AttachmentItem],
+            max_workers: int = 4,
+            max_attempts: int = 3,
+            retry_wait: float = 1,
+            previous: Optional[List[AttachmentUpload]] = None,
+    ) -> List[AttachmentUpload]:
+        """
+        Uploads many attachments concurrently, see
+        'client.VatReturn.upload_attachments_batch'.
+
+        :param instance_url: Url to the instance.
+        :param attachments: (content_type, file_name, source) items.
+        :param max_workers: Max uploads in flight at once.
+        :param max_attempts: Attempts per attachment.
+        :param retry_wait: Seconds to wait before each retry round.
+        :param previous: Results of an earlier call with the same
+        attachments; those already uploaded are skipped.
+        :return: One result per attachment, in the same order.
+        """
+        bodies = [open_upload(source) for _, _, source in attachments]
+        try:
+            check_attachments(attachments, bodies)
+            results, todo = batch_results(attachments, previous)
+            # Bodies that failed to rewind, they are not tried again.
+            spent = set()
+            semaphore = asyncio.Semaphore(max_workers)
+
+            async def upload(index: int):
+                content_type, file_name, _ = attachments[index]
+                result = results[index]
+                body = bodies[index]
+                async with semaphore:
+                    start = time.perf_counter()
+                    try:
+                        if result.attempts:
+                            try:
+                                body.rewind()
+                            except (io.UnsupportedOperation, OSError):
+                                spent.add(index)
+                                raise
+                        result.attempts += 1
+                        with operation("upload_attachments"):
+                            response = await self._post_attachment(
+                                instance_url, content_type, file_name, body
+                            )
+                        if 200 <= response.status_code < 300:
+                            result.status = "uploaded"
+                            result.data_element = response.json()
+                            result.error = None
+                        else:
+                            result.status = "failed"
+                            result.error = (
+                                f"HTTP {response.status_code}: "
+                                f"{response.content.decode('utf-8')[:200]}"
+                            )
+                    except Exception as error:
+                        result.status = "failed"
+                        result.error = f"{type(error).__name__}: {error}"
+                    result.duration = time.perf_counter() - start
+                    result.size = body.bytes_read
+                    result.sha256 = body.sha256
+
+            for attempt in range(max_attempts):
+                if attempt:
+                    await asyncio.sleep(retry_wait * attempt)
+                await asyncio.gather(*(upload(index) for index in todo))
+                todo = [
+                    index for index in todo
+                    if results[index].status == "failed"
+                    and bodies[index].rewindable() and index not in spent
+                ]
+                if not todo:
+                    break
+            return results
+        finally:
+            for (_, _, source), body in zip(attachments, bodies):
+                if body is not source:
+                    body.close()
+
+    @instrumented
+    async def ship_to_next_process(self, instance_url: str) -> Union[Dict, str]:
+        """
+        Move the instance to the next step for VAT return filing in the
+        application process.
+
+        :param instance_url: Url to the instance.
+        :return: Process description as dict.
+        """
+        url = f"{instance_url}/process/next"
+        headers = {
+            "Authorization": f"Bearer {await self._token()}",
+            "content-type": "application/json",
+        }
+        response = await self.transport.put(
+            url, headers=headers,
+        )
+        if response.status_code != 200:
+            context = response.content.decode("utf-8")
+            logger.warning("process/next of %s answered %s: %s",
+                           instance_url, response.status_code, context[:500])
+            return context
+        process = response.json()
+        if self.instance_index is not None:
+            await self._blocking(
+                self.instance_index.set_process_step, instance_url,
+                (process.get("currentTask") or {}).get("elementId"),
+            )
+        return process
+
+    @instrumented
+    async def get_feedback_status(self, instance_url: str) -> bool:
+        """
+        Checks once whether the Tax Administration has given feedback.
+
+        :param instance_url: Url to the instance.
+        :return: The isFeedbackProvided flag.
+        """
+        headers = {
+            "Authorization": f"Bearer {await self._token()}",
+            "content-type": "application/json",
+        }
+        status_response = await self._read(
+            self.transport.get, f"{instance_url}/feedback/status",
+            headers=headers,
+        )
+        provided = status_response.json()["isFeedbackProvided"]
+        if provided and self.instance_index is not None:
+            await self._blocking(
+                self.instance_index.set_feedback_provided, instance_url
+            )
+        return provided
+
+    @instrumented
+    async def get_feedback(self, instance_url: str) -> Dict:
+        """
+        Fetches the instance with feedback, without checking the status.
+
+        :param instance_url: Url to the instance.
+        :return: Feedback as dict.
+        """
+        headers = {
+            "Authorization": f"Bearer {await self._token()}",
+            "content-type": "application/json",
+        }
+        response = await self._read(
+            self.transport.get, f"{instance_url}/feedback", headers=headers
+        )
+        instance = response.json()
+        if self.instance_index is not None and "selfLinks" in instance:
+            await self._blocking(self.instance_index.record, instance)
+        return instance
+
+    @instrumented
+    async def query_instances(
+            self, params: Optional[Dict] = None, url: Optional[str] = None
+    ) -> Dict:
+        """
+        One page of the Altinn storage instance query.
+
+        :param params: Query parameters, e.g. appId, lastChanged and size.
+        :param url: The 'next' link of the previous page, instead of params.
+        :return: The page, with 'instances', 'count' and 'next'.
+        """
+        headers = {
+            "Authorization": f"Bearer {await self._token()}",
+            "content-type": "application/json",
+        }
+        if url is None:
+            url = f"{self.altinn_environment}/storage/api/v1/instances"
+        response = await self._read(
+            self.transport.get, url, headers=headers, params=params
+        )
+        response.raise_for_status()
+        return response.json()
+
+    async def retrieve_feedback(
+            self, instance_url: str, max_retry: int = 5, wait_time: int = 2
+    ) -> Dict:
+        """
+        Return the instance when the Tax Administration has given feedback.
+        Waits with 'asyncio.sleep' between status checks, so other
+        submissions keep running on the loop meanwhile.
+
+        :param instance_url: Url to the instance.
+        :param max_retry: How many time to retry.
+        :param wait_time: How long to wait between requests.
+        :return: Feedback as dict.
+        """
+        for _ in range(max_retry + 1):
+            logger.info("Requesting the feedback status of %s.", instance_url)
+            if await self.get_feedback_status(instance_url):
+                break
+            await asyncio.sleep(wait_time)
+
+        return await self.get_feedback(instance_url)
+
+    @instrumented
+    async def get_feedback_files(self, instance_data_app_url: str) -> bytes:
+        """
+        Once the Tax Administration has given feedback, the files for the
+        feedback can be downloaded from the instance.
+
+        :param instance_data_app_url: URl to the file data app url.
+        :return: Files as bytes.
+        """
+        headers = {
+            "Authorization": f"Bearer {await self._token()}",
+        }
+
+        response = await self._read(
+            self.transport.get, instance_data_app_url, headers=headers
+        )
+        return response.content
+
+    @instrumented
+    async def download_feedback_file(
+            self,
+            instance_data_app_url: str,
+            sink: DownloadSink,
+            chunk_size: int = CHUNK_SIZE,
+    ) -> FeedbackDownload:
+        """
+        Streams one feedback file to a path or an open binary file, in
+        chunks. Writes happen in a thread so the loop is not blocked.
+
+        :param instance_data_app_url: URl to the file data app url.
+        :param sink: Path to write to, or a writable binary file object.
+        :param chunk_size: Bytes per chunk.
+        :return: Download result with size and sha256.
+        """
+        headers = {
+            "Authorization": f"Bearer {await self._token()}",
+        }
+        result = FeedbackDownload(
+            url=instance_data_app_url,
+            file_name=sink_name(sink),
+        )
+        start = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        async with self.transport.stream(
+                "GET", instance_data_app_url, headers=headers
+        ) as response:
+            response.raise_for_status()
+            with open_sink(sink) as writer:
+                async for chunk in response.content.iter_chunked(chunk_size):
+                    await loop.run_in_executor(None, writer.write, chunk)
+        if not hasattr(sink, "write"):
+            result.path = Path(sink)
+        result.status = "downloaded"
+        result.size = writer.size
+        result.sha256 = writer.sha256
+        result.duration = time.perf_counter() - start
+        return result
+
+    async def download_feedback_files(
+            self,
+            instance: Dict,
+            directory: Union[str, Path],
+            data_types: Optional[Iterable[str]] = None,
+            max_workers: int = 4,
+            chunk_size: int = CHUNK_SIZE,
+    ) -> List[FeedbackDownload]:
+        """
+        Downloads every data element of an instance concurrently, see
+        'client.VatReturn.download_feedback_files'.
+
+        :param instance: Instance as dict, e.g. from retrieve_feedback.
+        :param directory: Folder to write the files to.
+        :param data_types: Only download elements with these dataTypes.
+        :param max_workers: Max downloads in flight at once.
+        :param chunk_size: Bytes per chunk.
+        :return: One result per data element.
+        """
+        directory = Path(directory)
+        taken = set()
+        jobs = [
+            (element, directory / download_name(element, taken))
+            for element in feedback_data_elements(instance, data_types)
+        ]
+        semaphore = asyncio.Semaphore(max_workers)
+
+        async def download(element: Dict, path: Path) -> FeedbackDownload:
+            url = element["selfLinks"]["apps"]
+            async with semaphore:
+                try:
+                    result = await self.download_feedback_file(
+                        url, path, chunk_size
+                    )
+                except Exception as error:
+                    result = FeedbackDownload(
+                        url=url,
+                        file_name=path.name,
+                        status="failed",
+                        error=f"{type(error).__name__}: {error}",
+                    )
+            result.data_type = element.get("dataType")
+            return result
+
+        return list(await asyncio.gather(
+            *(download(element, path) for element, path in jobs)
+        ))
@@ -0,0 +1,116 @@
+"""
+Limits and result records for attachment uploads.
+ref: https://skatteetaten.github.io/mva-meldingen/english/api/
+"""
+from dataclasses import dataclass, replace
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from streaming import UploadBody, UploadSource
+
+MAX_ATTACHMENTS = 57
+MAX_ATTACHMENT_SIZE = 25 * 1024 * 1024
+ALLOWED_ATTACHMENT_CONTENT_TYPES = frozenset([
+    "text/xml",
+    "application/pdf",
+    "application/vnd.oasis.opendocument.formula",
+    "application/vnd.oasis.opendocument.text",
+    "application/vnd.oasis.opendocument.spreadsheet",
+    "application/vnd.oasis.opendocument.presentation",
+    "application/vnd.oasis.opendocument.graphics",
+    "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+    "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    "application/vnd.openxmlformats-officedocument.presentationml.presentation",
+    "application/msword",
+    "application/vnd.ms-excel",
+    "application/vnd.ms-powerpoint",
+    "image/jpeg",
+    "image/png",
+])
+
+# (content_type, file_name, source)
+AttachmentItem = Tuple[str, str, UploadSource]
+
+
+@dataclass
+class AttachmentUpload:
+    """
+    Result of uploading one attachment in a batch.
+
+    status is "uploaded", "failed" or "skipped" (uploaded by an earlier
+    batch passed as 'previous').
+    """
+    file_name: str
+    content_type: str
+    status: str = "pending"
+    data_element: Optional[Dict] = None
+    error: Optional[str] = None
+    attempts: int = 0
+    duration: float = 0.0
+    size: int = 0
+    sha256: Optional[str] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.status in ("uploaded", "skipped")
+
+
+def check_attachments(
+        attachments: Sequence[AttachmentItem], bodies: List[UploadBody]
+):
+    """
+    Checks the documented limits before anything is sent: the number of
+    attachments, their content types and the size of those with a known
+    size. Iterators of unknown size can only be checked by the server.
+
+    :param attachments: (content_type, file_name, source) items.
+    :param bodies: The opened upload bodies, in the same order.
+    :raises ValueError: Listing every attachment breaking a limit.
+    """
+    problems = []
+    if len(attachments) > MAX_ATTACHMENTS:
+        problems.append(
+            f"{len(attachments)} attachments, at most {MAX_ATTACHMENTS} "
+            f"are allowed."
+        )
+    for (content_type, file_name, _), body in zip(attachments, bodies):
+        if content_type not in ALLOWED_ATTACHMENT_CONTENT_TYPES:
+            problems.append(
+                f"{file_name}: content type '{content_type}' is not allowed."
+            )
+        if body.length is not None and body.length > MAX_ATTACHMENT_SIZE:
+            problems.append(
+                f"{file_name}: {body.length} bytes, at most "
+                f"{MAX_ATTACHMENT_SIZE} are allowed."
+            )
+    if problems:
+        raise ValueError("Invalid attachments:\n" + "\n".join(problems))
+
+
+def batch_results(
+        attachments: Sequence[AttachmentItem],
+        previous: Optional[List[AttachmentUpload]] = None,
+) -> Tuple[List[AttachmentUpload], List[int]]:
+    """
+    The results of a new batch, with the attachments uploaded by an
+    earlier batch marked as skipped.
+
+    :param attachments: (content_type, file_name, source) items.
+    :param previous: Results of the earlier batch, one per attachment.
+    :return: The results and the indexes of the attachments to upload.
+    :raises ValueError: If 'previous' does not match the attachments.
+    """
+    if previous is not None and len(previous) != len(attachments):
+        raise ValueError(
+            f"{len(previous)} previous results for {len(attachments)} "
+            f"attachments."
+        )
+    results, todo = [], []
+    for index, (content_type, file_name, _) in enumerate(attachments):
+        if previous is not None and previous[index].ok:
+            results.append(replace(previous[index], status="skipped"))
+        else:
+            results.append(AttachmentUpload(
+                file_name=file_name, content_type=content_type
+            ))
+            todo.append(index)
+    return results, todo
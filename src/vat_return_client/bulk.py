@@ -0,0 +1,185 @@
+"""
+Bulk filing: runs the submission flow for many organisations through a
+bounded worker pool, with a separate concurrency limit per stage.
+
+Manifest format (JSON), paths are relative to the manifest file:
+[
+    {
+        "org_number": "310332313",
+        "message": "message/compensation_vat_message.xml",
+        "envelope": "envelope/compensation_vat_envelope.xml",
+        "attachments": [
+            {
+                "content_type": "text/xml",
+                "file_name": "vat_appendix.xml",
+                "path": "appendix/vat_appendix.xml"
+            }
+        ]
+    }
+]
+"""
+import json
+import logging
+import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional, Union, Callable
+
+from client import VatReturn
+from journal import SubmissionJournal
+from submission import STAGES, Attachment, Filing, FilingResult, submit_filing
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class BulkSummary:
+    """Per-organisation results and aggregate figures for a bulk run."""
+    results: List[FilingResult] = field(default_factory=list)
+    wall_time: float = 0.0
+
+    @property
+    def succeeded(self) -> int:
+        return sum(1 for result in self.results if result.ok)
+
+    @property
+    def failed(self) -> int:
+        return len(self.results) - self.succeeded
+
+    @property
+    def throughput(self) -> float:
+        """Filings completed per second of wall time."""
+        if not self.wall_time:
+            return 0.0
+        return len(self.results) / self.wall_time
+
+    def latency(self, percentile: float) -> float:
+        """Filing duration at the given percentile (0-100), in seconds."""
+        return _percentile(
+            [result.duration for result in self.results], percentile
+        )
+
+    def stage_latency(self, stage: str, percentile: float) -> float:
+        """Stage duration at the given percentile (0-100), in seconds."""
+        return _percentile(
+            [
+                result.stage_timings[stage] for result in self.results
+                if stage in result.stage_timings
+            ],
+            percentile,
+        )
+
+    def as_dict(self) -> Dict:
+        return {
+            "filings": len(self.results),
+            "succeeded": self.succeeded,
+            "failed": self.failed,
+            "wall_time": self.wall_time,
+            "throughput": self.throughput,
+            "latency_p50": self.latency(50),
+            "latency_p95": self.latency(95),
+            "latency_p99": self.latency(99),
+            "stage_latency_p50": {
+                stage: self.stage_latency(stage, 50) for stage in STAGES
+            },
+        }
+
+
+def _percentile(values: List[float], percentile: float) -> float:
+    """Nearest-rank percentile, 0.0 for no values."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(math.ceil(percentile / 100 * len(ordered)), 1)
+    return ordered[rank - 1]
+
+
+def load_manifest(manifest_path: Union[str, Path]) -> List[Filing]:
+    """
+    Reads a bulk manifest.
+
+    :param manifest_path: Path to the JSON manifest.
+    :return: The filings, with paths resolved against the manifest folder.
+    """
+    manifest_path = Path(manifest_path)
+    base = manifest_path.parent
+    with open(manifest_path, "r", encoding="UTF-8") as file:
+        entries = json.load(file)
+    return [
+        Filing(
+            org_number=str(entry["org_number"]),
+            message=base / entry["message"],
+            envelope=base / entry["envelope"],
+            attachments=[
+                Attachment(
+                    content_type=attachment["content_type"],
+                    file_name=attachment["file_name"],
+                    path=base / attachment["path"],
+                ) for attachment in entry.get("attachments", [])
+            ],
+        ) for entry in entries
+    ]
+
+
+def run_bulk(
+        vat_client: VatReturn,
+        filings: List[Filing],
+        max_workers: int = 16,
+        stage_limits: Optional[Dict[str, int]] = None,
+        validate_only: bool = False,
+        wait_for_feedback: bool = True,
+        on_result: Optional[Callable[[FilingResult], None]] = None,
+        journal: Optional[SubmissionJournal] = None,
+        max_parallel_steps: int = 4,
+) -> BulkSummary:
+    """
+    Submits many filings concurrently with one shared client.
+
+    :param vat_client: Client with the altinn token set. Its transport
+    should have a pool size of at least max_workers.
+    :param filings: Filings to submit, e.g. from load_manifest.
+    :param max_workers: Number of filings in flight at once.
+    :param stage_limits: Max steps running each stage at once, keyed by
+    stage name (validate, create, upload, ship, feedback). Stages without
+    a limit are only bounded by max_workers and max_parallel_steps.
+    :param validate_only: Only validate the messages.
+    :param wait_for_feedback: Poll for feedback after shipping.
+    :param on_result: Called with each result as soon as it is done.
+    Errors it raises are logged.
+    :param journal: Journal shared by the filings, so a re-run of the same
+    manifest continues where the last one stopped.
+    :param max_parallel_steps: Steps of each filing running at once.
+    :return: Results in the order of the filings and aggregate figures.
+    """
+    semaphores = {
+        stage: threading.BoundedSemaphore(limit)
+        for stage, limit in (stage_limits or {}).items()
+    }
+
+    def run(filing: Filing) -> FilingResult:
+        result = submit_filing(
+            vat_client,
+            filing,
+            stage_limits=semaphores,
+            validate_only=validate_only,
+            wait_for_feedback=wait_for_feedback,
+            journal=journal,
+            max_parallel_steps=max_parallel_steps,
+        )
+        if on_result is not None:
+            try:
+                on_result(result)
+            except Exception:
+                logger.exception("on_result failed for %s.",
+                                 filing.org_number)
+        return result
+
+    summary = BulkSummary()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        summary.results = list(executor.map(run, filings))
+    summary.wall_time = time.perf_counter() - start
+    return summary
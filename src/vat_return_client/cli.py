@@ -0,0 +1,401 @@
+"""
+Command line entry point, run from this folder with 'python cli.py'.
+
+python cli.py validate message.xml
+python cli.py submit --org 310332313 --message message.xml \
+    --envelope envelope.xml
+python cli.py bulk manifest.json --workers 32
+python cli.py enqueue manifest.json --queue filing_queue.db
+python cli.py worker --queue filing_queue.db --processes 4 --journal journal.db
+python cli.py feedback <instance url> [<instance url> ...]
+python cli.py download <instance url> feedback_files/
+python cli.py instances --index instance_index.db --sync --status awaiting
+
+Set ID_PORTEN_TOKEN="Bearer <token>" (or pass --token) to skip the browser
+log-in. Results are written to stdout as JSON; log messages go to
+stderr. Modules are imported by the subcommands that use them, so
+short-lived runs only load what they need. Each subcommand returns its
+result and whether it succeeded; the exit code is 1 if not.
+"""
+import argparse
+import contextlib
+import dataclasses
+import json
+import logging
+import os
+import sys
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from settings import (
+    ALTINN_BASE,
+    VALIDATION_BASE,
+    INSTANCE_API_URL,
+    FILING_LEASE_SECONDS,
+    FILING_QUEUE_FILE,
+)
+
+
+def _auth_headers(args: argparse.Namespace) -> Dict:
+    """ID-porten headers from --token or ID_PORTEN_TOKEN, else a log-in."""
+    token = args.token or os.environ.get("ID_PORTEN_TOKEN")
+    if token:
+        if not token.startswith("Bearer "):
+            token = f"Bearer {token}"
+        return {"Authorization": token}
+    # The interactive log-in pulls in jwt, cryptography and a web server.
+    from get_id_porten_token import get_id_token
+    return get_id_token()
+
+
+def _client(args: argparse.Namespace, altinn_token: bool = True):
+    from client import VatReturn
+    from transport import Transport
+
+    xsd_validator = None
+    if getattr(args, "xsd", False):
+        from xsd_validation import XsdValidator
+        xsd_validator = XsdValidator()
+    instance_index = None
+    if getattr(args, "index", None):
+        from instance_index import InstanceIndex
+        instance_index = InstanceIndex(args.index)
+    hedging = None
+    if args.hedge:
+        from hedging import HedgePolicy
+        hedging = HedgePolicy()
+    vat_client = VatReturn(
+        id_porten_auth_headers=_auth_headers(args),
+        altinn_environment=args.altinn_url,
+        id_porten_environment=args.validation_url,
+        instance_api_url=args.instance_api_url,
+        transport=Transport(pool_size=max(getattr(args, "workers", 1), 10)),
+        xsd_validator=xsd_validator,
+        instance_index=instance_index,
+        hedging=hedging,
+    )
+    if altinn_token:
+        vat_client.set_altinn_token()
+    return vat_client
+
+
+def _as_json(value):
+    if dataclasses.is_dataclass(value):
+        return dataclasses.asdict(value)
+    if isinstance(value, bytes):
+        return value.decode("utf-8")
+    return str(value)
+
+
+def _stage_limits(values: List[str]) -> Dict[str, int]:
+    limits = {}
+    for value in values or []:
+        stage, _, limit = value.partition("=")
+        limits[stage] = int(limit)
+    return limits
+
+
+def validate(args: argparse.Namespace) -> Tuple[Any, bool]:
+    from validation_result import parse_validation
+
+    vat_client = _client(args, altinn_token=False)
+    ok = True
+    results = []
+    for message in args.messages:
+        body = Path(message).read_bytes()
+        if args.check_totals:
+            # numpy is only imported when the sums are checked.
+            from vat_lines import VatLines
+            try:
+                report = VatLines.from_bytes(body).check()
+            except ValueError as error:
+                ok = False
+                results.append({"message": message, "totals": str(error)})
+                continue
+            if not report.ok:
+                ok = False
+                results.append({"message": message,
+                                "totals": report.as_dict()})
+                continue
+        try:
+            result = vat_client.validate_tax_return(body=body)
+        except ValueError as error:
+            ok = False
+            results.append({"message": message, "result": str(error)})
+            continue
+        summary = parse_validation(result)
+        ok = ok and summary.ok
+        results.append({"message": message, "result": result,
+                        "summary": summary.as_dict()})
+    return results, ok
+
+
+def submit(args: argparse.Namespace) -> Tuple[Any, bool]:
+    from submission import Attachment, Filing, submit_filing
+
+    attachments = []
+    for value in args.attachment or []:
+        content_type, file_name, path = value.split(":", 2)
+        attachments.append(Attachment(content_type, file_name, Path(path)))
+    filing = Filing(
+        org_number=args.org,
+        message=Path(args.message),
+        envelope=Path(args.envelope),
+        attachments=attachments,
+    )
+    result = submit_filing(
+        _client(args, altinn_token=not args.validate_only),
+        filing,
+        validate_only=args.validate_only,
+        wait_for_feedback=not args.no_feedback,
+        journal=_journal(args),
+        max_parallel_steps=args.parallel_steps,
+    )
+    return result, result.ok
+
+
+def bulk(args: argparse.Namespace) -> Tuple[Any, bool]:
+    from bulk import load_manifest, run_bulk
+
+    summary = run_bulk(
+        _client(args, altinn_token=not args.validate_only),
+        load_manifest(args.manifest),
+        max_workers=args.workers,
+        stage_limits=_stage_limits(args.stage_limit),
+        validate_only=args.validate_only,
+        wait_for_feedback=not args.no_feedback,
+        journal=_journal(args),
+        max_parallel_steps=args.parallel_steps,
+    )
+    output = summary.as_dict()
+    output["results"] = summary.results
+    return output, summary.failed == 0
+
+
+def enqueue(args: argparse.Namespace) -> Tuple[Any, bool]:
+    from bulk import load_manifest
+    from work_queue import FilingQueue
+
+    queue = FilingQueue(args.queue, network_filesystem=args.network_fs)
+    added = queue.enqueue(load_manifest(args.manifest))
+    if args.requeue_failed:
+        queue.requeue_failed()
+    return {"added": added, "counts": queue.counts()}, True
+
+
+def _run_worker(args: argparse.Namespace) -> Dict:
+    """One worker, in this process or a child process of 'worker'."""
+    from work_queue import FilingQueue, run_worker
+
+    _log_to_stderr()
+    with contextlib.redirect_stdout(sys.stderr):
+        summary = run_worker(
+            _client(args, altinn_token=not args.validate_only),
+            FilingQueue(args.queue, lease_seconds=args.lease,
+                        network_filesystem=args.network_fs),
+            concurrency=args.workers,
+            until_empty=not args.forever,
+            validate_only=args.validate_only,
+            wait_for_feedback=not args.no_feedback,
+            journal=_journal(args),
+            max_parallel_steps=args.parallel_steps,
+        )
+    return summary.as_dict()
+
+
+def worker(args: argparse.Namespace) -> Tuple[Any, bool]:
+    from work_queue import FilingQueue
+
+    if args.processes > 1:
+        import multiprocessing
+
+        # Log in once here, not once per process.
+        args.token = _auth_headers(args)["Authorization"]
+        context = multiprocessing.get_context("spawn")
+        with context.Pool(args.processes) as pool:
+            workers = pool.map(_run_worker, [args] * args.processes)
+    else:
+        workers = [_run_worker(args)]
+    counts = FilingQueue(args.queue, network_filesystem=args.network_fs) \
+        .counts()
+    return {"workers": workers, "counts": counts}, \
+        all(summary["failed"] == 0 for summary in workers)
+
+
+def feedback(args: argparse.Namespace) -> Tuple[Any, bool]:
+    from feedback_poller import FeedbackPoller
+
+    vat_client = _client(args)
+    instance_urls = args.instance_urls
+    if not instance_urls and vat_client.instance_index is not None:
+        instance_urls = vat_client.instance_index.awaiting_feedback()
+    with FeedbackPoller(vat_client, timeout=args.timeout) as poller:
+        for instance_url in instance_urls:
+            poller.add(instance_url)
+        results = list(poller.results())
+    return results, all(result.status == "feedback" for result in results)
+
+
+def download(args: argparse.Namespace) -> Tuple[Any, bool]:
+    vat_client = _client(args)
+    instance = vat_client.get_feedback(args.instance_url)
+    downloads = vat_client.download_feedback_files(
+        instance, args.directory, data_types=args.data_type,
+    )
+    return downloads, all(item.ok for item in downloads)
+
+
+def instances(args: argparse.Namespace) -> Tuple[Any, bool]:
+    vat_client = _client(args, altinn_token=args.sync)
+    index = vat_client.instance_index
+    synced = 0
+    if args.sync:
+        filters = {"instanceOwner.partyId": args.party_id} \
+            if args.party_id else None
+        synced = index.sync(vat_client, filters=filters)
+    return {
+        "synced": synced,
+        "counts": index.counts(),
+        "instances": index.instances(
+            feedback=args.status, org_number=args.org
+        ),
+    }, True
+
+
+def _journal(args: argparse.Namespace):
+    if not args.journal:
+        return None
+    from journal import SubmissionJournal
+    return SubmissionJournal(
+        args.journal, network_filesystem=getattr(args, "network_fs", False)
+    )
+
+
+def parser() -> argparse.ArgumentParser:
+    root = argparse.ArgumentParser(
+        prog="cli.py", description="VAT return client for Altinn."
+    )
+    root.add_argument("--token", help="ID-porten token, else ID_PORTEN_TOKEN "
+                                      "or a browser log-in.")
+    root.add_argument("--altinn-url", default=ALTINN_BASE)
+    root.add_argument("--validation-url", default=VALIDATION_BASE)
+    root.add_argument("--instance-api-url", default=INSTANCE_API_URL)
+    root.add_argument("--hedge", action="store_true",
+                      help="Send slow read-only calls a second time.")
+    commands = root.add_subparsers(dest="command", required=True)
+
+    command = commands.add_parser("validate", help="Validate VAT messages.")
+    command.add_argument("messages", nargs="+")
+    command.add_argument("--xsd", action="store_true",
+                         help="Check against the XSD before sending.")
+    command.add_argument("--check-totals", action="store_true",
+                         help="Check line amounts and the total locally, "
+                              "and do not send messages that are off.")
+    command.set_defaults(run=validate)
+
+    filing_options = argparse.ArgumentParser(add_help=False)
+    filing_options.add_argument("--validate-only", action="store_true")
+    filing_options.add_argument("--no-feedback", action="store_true",
+                                help="Do not wait for feedback.")
+    filing_options.add_argument("--journal",
+                                help="Journal file to record and resume "
+                                     "steps with.")
+    filing_options.add_argument("--xsd", action="store_true",
+                                help="Check against the XSD before sending.")
+    filing_options.add_argument("--parallel-steps", type=int, default=4,
+                                help="Steps of a filing running at once.")
+    filing_options.add_argument("--index",
+                                help="Instance index file to record the "
+                                     "instances in.")
+
+    command = commands.add_parser("submit", parents=[filing_options],
+                                  help="Submit one filing.")
+    command.add_argument("--org", required=True)
+    command.add_argument("--message", required=True)
+    command.add_argument("--envelope", required=True)
+    command.add_argument("--attachment", action="append",
+                         metavar="CONTENT_TYPE:FILE_NAME:PATH")
+    command.set_defaults(run=submit)
+
+    command = commands.add_parser("bulk", parents=[filing_options],
+                                  help="Submit the filings of a manifest.")
+    command.add_argument("manifest")
+    command.add_argument("--workers", type=int, default=16)
+    command.add_argument("--stage-limit", action="append",
+                         metavar="STAGE=LIMIT")
+    command.set_defaults(run=bulk)
+
+    queue_options = argparse.ArgumentParser(add_help=False)
+    queue_options.add_argument("--queue", default=FILING_QUEUE_FILE,
+                               help="Queue file shared by the workers.")
+    queue_options.add_argument("--network-fs", action="store_true",
+                               help="The queue is on a network filesystem.")
+
+    command = commands.add_parser("enqueue", parents=[queue_options],
+                                  help="Queue the filings of a manifest.")
+    command.add_argument("manifest")
+    command.add_argument("--requeue-failed", action="store_true",
+                         help="Also queue failed filings again.")
+    command.set_defaults(run=enqueue)
+
+    command = commands.add_parser("worker",
+                                  parents=[filing_options, queue_options],
+                                  help="Submit queued filings.")
+    command.add_argument("--workers", type=int, default=8,
+                         help="Filings in flight per process.")
+    command.add_argument("--processes", type=int, default=1)
+    command.add_argument("--lease", type=float, default=FILING_LEASE_SECONDS,
+                         help="Seconds before a dead worker's jobs are "
+                              "taken over.")
+    command.add_argument("--forever", action="store_true",
+                         help="Keep waiting for new filings.")
+    command.set_defaults(run=worker)
+
+    command = commands.add_parser("feedback", help="Wait for feedback.")
+    command.add_argument("instance_urls", nargs="*",
+                         help="Default: those awaiting feedback in --index.")
+    command.add_argument("--index", help="Instance index file.")
+    command.add_argument("--timeout", type=float, default=600)
+    command.set_defaults(run=feedback)
+
+    command = commands.add_parser("download",
+                                  help="Download the feedback files.")
+    command.add_argument("instance_url")
+    command.add_argument("directory")
+    command.add_argument("--data-type", action="append")
+    command.set_defaults(run=download)
+
+    command = commands.add_parser("instances",
+                                  help="List the instances in the index.")
+    command.add_argument("--index", required=True,
+                         help="Instance index file.")
+    command.add_argument("--sync", action="store_true",
+                         help="Read the changes from Altinn first.")
+    command.add_argument("--party-id", help="Instance owner to sync.")
+    command.add_argument("--status", choices=("draft", "awaiting",
+                                              "provided"))
+    command.add_argument("--org")
+    command.set_defaults(run=instances)
+    return root
+
+
+def _log_to_stderr():
+    logging.basicConfig(
+        stream=sys.stderr, level=logging.INFO,
+        format="%(levelname)s %(name)s: %(message)s",
+    )
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parser().parse_args(argv)
+    _log_to_stderr()
+    # Keep stdout for the JSON result, also if other code prints.
+    with contextlib.redirect_stdout(sys.stderr):
+        result, ok = args.run(args)
+    json.dump(result, sys.stdout, default=_as_json, indent=2)
+    sys.stdout.write("\n")
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,120 @@
+"""
+Signed client assertions for 'private_key_jwt' client authentication.
+The RSA key registered with ID-porten (see scripts/parse_jwk.py) is read
+once. A signed assertion is kept per client id and audience, and reused by
+every /token request until shortly before its 'exp'. Many token exchanges
+running in parallel then share one RSA signature per assertion lifetime,
+instead of signing one each.
+
+If the authorization server refuses a 'jti' it has already seen, set
+CLIENT_ASSERTION_REUSE=false to sign a new assertion for every request.
+ref: https://docs.digdir.no/docs/idporten/oidc/oidc_protocol_token.html#client-authentication
+"""
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Dict, Optional, Tuple, Union
+
+from settings import (
+    CLIENT_ASSERTION_LIFETIME,
+    CLIENT_ASSERTION_MARGIN,
+    CLIENT_ASSERTION_REUSE,
+    CLIENT_KEY_ID,
+    CLIENT_PRIVATE_KEY_FILE,
+)
+
+CLIENT_ASSERTION_TYPE = "urn:ietf:params:oauth:client-assertion-type:jwt-bearer"
+
+
+class ClientAssertions:
+    """
+    Signs and caches client assertions. Safe to share between threads;
+    when a cached assertion runs out, one thread signs the next while the
+    others wait for it.
+
+    :param private_key_file: PEM file with the RSA private key.
+    :param key_id: 'kid' of the key as registered with ID-porten.
+    :param lifetime: Seconds an assertion is valid.
+    :param margin: Seconds before 'exp' a new assertion is signed.
+    :param reuse: Reuse assertions, else sign one per request.
+    """
+
+    def __init__(
+            self,
+            private_key_file: Optional[Union[str, Path]] = CLIENT_PRIVATE_KEY_FILE,
+            key_id: Optional[str] = CLIENT_KEY_ID,
+            lifetime: float = CLIENT_ASSERTION_LIFETIME,
+            margin: float = CLIENT_ASSERTION_MARGIN,
+            reuse: bool = CLIENT_ASSERTION_REUSE,
+    ):
+        self.private_key_file = private_key_file
+        self.key_id = key_id
+        self.lifetime = lifetime
+        self.margin = margin
+        self.reuse = reuse
+        self.signed = 0
+        self._key = None
+        self._assertions: Dict[Tuple[str, str], Tuple[str, float]] = {}
+        self._lock = threading.Lock()
+
+    def _private_key(self):
+        # cryptography is slow to import, so the key is only loaded when the
+        # first assertion is signed.
+        from cryptography.hazmat.primitives.serialization import (
+            load_pem_private_key,
+        )
+
+        if self._key is None:
+            if self.private_key_file is None:
+                raise ValueError(
+                    "private_key_jwt needs CLIENT_PRIVATE_KEY_FILE."
+                )
+            self._key = load_pem_private_key(
+                Path(self.private_key_file).read_bytes(), password=None
+            )
+        return self._key
+
+    def _sign(self, client_id: str, audience: str) -> Tuple[str, float]:
+        import jwt
+
+        now = int(time.time())
+        expires_at = now + int(self.lifetime)
+        headers = {"kid": self.key_id} if self.key_id else None
+        assertion = jwt.encode(
+            {
+                "iss": client_id,
+                "sub": client_id,
+                "aud": audience,
+                "iat": now,
+                "exp": expires_at,
+                "jti": str(uuid.uuid4()),
+            },
+            self._private_key(),
+            algorithm="RS256",
+            headers=headers,
+        )
+        self.signed += 1
+        return assertion, float(expires_at)
+
+    def get(self, client_id: str, audience: str) -> str:
+        """
+        A signed assertion for the client towards the audience (the issuer
+        of the authorization server), reused while it is valid for more
+        than 'margin' seconds.
+        """
+        key = (client_id, audience)
+        with self._lock:
+            cached = self._assertions.get(key)
+            if self.reuse and cached is not None and \
+                    time.time() + self.margin < cached[1]:
+                return cached[0]
+            cached = self._sign(client_id, audience)
+            self._assertions[key] = cached
+            return cached[0]
+
+    def clear(self):
+        """Forgets the cached assertions, e.g. after a key rotation."""
+        with self._lock:
+            self._assertions.clear()
+            self._key = None
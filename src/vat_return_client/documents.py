@@ -0,0 +1,300 @@
+"""
+Typed models of the VAT message (mvaMeldingDto) and the submission envelope
+(mvaMeldingInnsending), serialised straight to bytes.
+Each document is written in a single pass into a bytearray, without
+templates or intermediate strings, and can be streamed in chunks as an
+upload body or rendered in batches that reuse the same buffer.
+ref: https://github.com/Skatteetaten/mva-meldingen/tree/master/docs/informasjonsmodell_filer/xsd
+"""
+import functools
+from dataclasses import dataclass, field
+from datetime import datetime
+from decimal import Decimal
+from typing import Iterable, Iterator, List, Optional, Union
+
+from streaming import CHUNK_SIZE
+
+VAT_MESSAGE_NAMESPACE = (
+    "no:skatteetaten:fastsetting:avgift:mva:skattemeldingformerverdiavgift:v1.0"
+)
+XML_DECLARATION = b'<?xml version="1.0" encoding="UTF-8"?>'
+
+Number = Union[int, Decimal]
+Timestamp = Union[str, datetime]
+
+_ESCAPES = str.maketrans({"&": "&amp;", "<": "&lt;", ">": "&gt;"})
+
+
+@functools.lru_cache(maxsize=None)
+def _start_tag(tag: str) -> bytes:
+    return f"<{tag}>".encode("utf-8")
+
+
+@functools.lru_cache(maxsize=None)
+def _end_tag(tag: str) -> bytes:
+    return f"</{tag}>".encode("utf-8")
+
+
+def _text(value) -> str:
+    if isinstance(value, datetime):
+        return value.isoformat(timespec="seconds")
+    if isinstance(value, Decimal):
+        return format(value, "f")
+    return str(value)
+
+
+class XmlWriter:
+    """
+    Writes XML into a bytearray from position 0. The buffer is overwritten
+    in place and only grows, so a writer that is reset and reused for many
+    documents stops allocating once it has seen the largest one.
+
+    :param buffer: Buffer to write into, a new one by default.
+    """
+
+    def __init__(self, buffer: Optional[bytearray] = None):
+        self.buffer = bytearray() if buffer is None else buffer
+        self.length = 0
+
+    def write(self, data: bytes):
+        end = self.length + len(data)
+        self.buffer[self.length:end] = data
+        self.length = end
+
+    def start(self, tag: str, namespace: Optional[str] = None):
+        if namespace is None:
+            self.write(_start_tag(tag))
+        else:
+            self.write(f'<{tag} xmlns="{namespace}">'.encode("utf-8"))
+
+    def end(self, tag: str):
+        self.write(_end_tag(tag))
+
+    def element(self, tag: str, value):
+        """Writes <tag>value</tag>, nothing if the value is None."""
+        if value is None:
+            return
+        self.write(_start_tag(tag))
+        self.write(_text(value).translate(_ESCAPES).encode("utf-8"))
+        self.write(_end_tag(tag))
+
+    def reset(self):
+        self.length = 0
+
+    def view(self) -> memoryview:
+        """The bytes written since the last reset, without a copy."""
+        return memoryview(self.buffer)[:self.length]
+
+
+class XmlDocument:
+    """
+    Base of the document models. Subclasses implement '_write' as a
+    generator that yields between repeated elements, which is where
+    'iter_bytes' hands out full chunks.
+    """
+
+    def _write(self, writer: XmlWriter) -> Iterator[None]:
+        raise NotImplementedError
+
+    def render_into(self, writer: XmlWriter):
+        """Writes the whole document to the writer."""
+        for _ in self._write(writer):
+            pass
+
+    def to_bytes(self) -> bytes:
+        writer = XmlWriter()
+        self.render_into(writer)
+        return bytes(writer.view())
+
+    def iter_bytes(self, chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+        """
+        The document in chunks of about chunk_size bytes, rendered while
+        it is read. Usable as a streaming.UploadSource; it is sent with
+        chunked transfer encoding and cannot be rewound for a retry.
+        """
+        writer = XmlWriter()
+        for _ in self._write(writer):
+            if writer.length >= chunk_size:
+                yield bytes(writer.view())
+                writer.reset()
+        if writer.length:
+            yield bytes(writer.view())
+
+
+@dataclass
+class Period:
+    """
+    A skattleggingsperiode. 'period_type' is the element used for the
+    period, e.g. skattleggingsperiodeMaaned or skattleggingsperiodeToMaaneder.
+    """
+    year: int
+    period: str
+    period_type: str = "skattleggingsperiodeToMaaneder"
+
+    def write(self, writer: XmlWriter):
+        writer.start("skattleggingsperiode")
+        writer.start("periode")
+        writer.element(self.period_type, self.period)
+        writer.end("periode")
+        writer.element("aar", self.year)
+        writer.end("skattleggingsperiode")
+
+
+def _remark(writer: XmlWriter, remark: Optional[str]):
+    if remark is None:
+        return
+    writer.start("merknad")
+    writer.element("beskrivelse", remark)
+    writer.end("merknad")
+
+
+@dataclass
+class VatLine:
+    """An mvaSpesifikasjonslinje of the VAT message."""
+    code: str
+    basis: Optional[Number]
+    rate: Optional[Number]
+    amount: Number
+    accounting_code: Optional[str] = None
+    specification: Optional[str] = None
+    remark: Optional[str] = None
+
+    def write(self, writer: XmlWriter):
+        writer.start("mvaSpesifikasjonslinje")
+        writer.element("mvaKode", self.code)
+        writer.element("mvaKodeRegnskapsystem", self.accounting_code)
+        writer.element("spesifikasjon", self.specification)
+        writer.element("grunnlag", self.basis)
+        writer.element("sats", self.rate)
+        writer.element("merverdiavgift", self.amount)
+        _remark(writer, self.remark)
+        writer.end("mvaSpesifikasjonslinje")
+
+
+@dataclass
+class VatMessage(XmlDocument):
+    """The VAT message (mvaMeldingDto) of one organisation and period."""
+    org_number: str
+    period: Period
+    total: Number
+    lines: List[VatLine] = field(default_factory=list)
+    category: str = "kompensasjon"
+    reference: str = "regnskapssystem_referanse"
+    system_name: str = "python-script"
+    system_version: str = "0.0.1"
+    customer_id: Optional[str] = None
+    remark: Optional[str] = None
+
+    def _write(self, writer: XmlWriter) -> Iterator[None]:
+        writer.write(XML_DECLARATION)
+        writer.start("mvaMeldingDto", VAT_MESSAGE_NAMESPACE)
+        writer.start("innsending")
+        writer.element("regnskapssystemsreferanse", self.reference)
+        writer.start("regnskapssystem")
+        writer.element("systemnavn", self.system_name)
+        writer.element("systemversjon", self.system_version)
+        writer.end("regnskapssystem")
+        writer.end("innsending")
+        writer.start("skattegrunnlagOgBeregnetSkatt")
+        self.period.write(writer)
+        writer.element("fastsattMerverdiavgift", self.total)
+        for line in self.lines:
+            line.write(writer)
+            yield
+        writer.end("skattegrunnlagOgBeregnetSkatt")
+        if self.customer_id is not None:
+            writer.start("betalingsinformasjon")
+            writer.element("kundeIdentifikasjonsnummer", self.customer_id)
+            writer.end("betalingsinformasjon")
+        writer.start("skattepliktig")
+        writer.element("organisasjonsnummer", self.org_number)
+        writer.end("skattepliktig")
+        writer.element("meldingskategori", self.category)
+        _remark(writer, self.remark)
+        writer.end("mvaMeldingDto")
+        yield
+
+
+@dataclass
+class EnvelopeAttachment:
+    """A vedlegg of the envelope, describing one file of the submission."""
+    file_name: str
+    created_by: str
+    created_at: Timestamp
+    attachment_type: str = "mva-melding"
+    source_group: str = "sluttbrukersystem"
+    file_extension: str = "xml"
+    content: str = "mva melding"
+
+    def write(self, writer: XmlWriter):
+        writer.start("vedlegg")
+        writer.element("vedleggstype", self.attachment_type)
+        writer.element("kildegruppe", self.source_group)
+        writer.element("opprettetAv", self.created_by)
+        writer.element("opprettingstidspunkt", self.created_at)
+        writer.start("vedleggsfil")
+        writer.element("filnavn", self.file_name)
+        writer.element("filekstensjon", self.file_extension)
+        writer.element("filinnhold", self.content)
+        writer.end("vedleggsfil")
+        writer.end("vedlegg")
+
+
+@dataclass
+class Envelope(XmlDocument):
+    """The submission envelope (mvaMeldingInnsending) of one filing."""
+    org_number: str
+    period: Period
+    created_by: str
+    created_at: Timestamp
+    changed_at: Optional[Timestamp] = None
+    attachments: List[EnvelopeAttachment] = field(default_factory=list)
+    category: str = "kompensasjon"
+    submission_type: str = "komplett"
+    instance_status: Optional[str] = None
+
+    def _write(self, writer: XmlWriter) -> Iterator[None]:
+        writer.write(XML_DECLARATION)
+        writer.start("mvaMeldingInnsending")
+        writer.start("norskIdentifikator")
+        writer.element("organisasjonsnummer", self.org_number)
+        writer.end("norskIdentifikator")
+        self.period.write(writer)
+        writer.element("meldingskategori", self.category)
+        writer.element("innsendingstype", self.submission_type)
+        writer.element("instansstatus", self.instance_status)
+        writer.element("opprettetAv", self.created_by)
+        writer.element("opprettingstidspunkt", self.created_at)
+        writer.element("endringstidspunkt", self.changed_at)
+        for attachment in self.attachments:
+            attachment.write(writer)
+            yield
+        writer.end("mvaMeldingInnsending")
+        yield
+
+
+def render_batch(
+        documents: Iterable[XmlDocument],
+        buffer: Optional[bytearray] = None,
+) -> Iterator[memoryview]:
+    """
+    Renders many documents one after the other into the same buffer.
+
+    Each yielded view is only valid until the next document is requested;
+    upload it, or copy it with bytes(), before moving on, and do not keep
+    slices of it. For message and envelope of the same filing, zip two
+    batches so each has its own buffer.
+
+    :param documents: The documents to render.
+    :param buffer: Buffer to reuse, a new one by default.
+    :return: A view of each rendered document, in order.
+    """
+    writer = XmlWriter(buffer)
+    for document in documents:
+        writer.reset()
+        document.render_into(writer)
+        view = writer.view()
+        try:
+            yield view
+        finally:
+            view.release()
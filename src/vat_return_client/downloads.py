@@ -0,0 +1,109 @@
+"""
+Helpers for streaming feedback files to disk.
+The data elements of an instance returned by 'retrieve_feedback' are
+discovered here and written chunk by chunk to a sink, so memory use stays
+flat no matter the file size.
+"""
+import hashlib
+import os
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from typing import IO, Dict, Iterable, List, Optional, Union
+
+# A path to write to, or an open binary file-like object.
+DownloadSink = Union[str, Path, IO[bytes]]
+
+
+@dataclass
+class FeedbackDownload:
+    """Result of downloading one data element of an instance."""
+    url: str
+    file_name: str
+    data_type: Optional[str] = None
+    path: Optional[Path] = None
+    status: str = "pending"
+    size: int = 0
+    sha256: Optional[str] = None
+    error: Optional[str] = None
+    duration: float = 0.0
+
+    @property
+    def ok(self) -> bool:
+        return self.status == "downloaded"
+
+
+def feedback_data_elements(
+        instance: Dict, data_types: Optional[Iterable[str]] = None
+) -> List[Dict]:
+    """
+    Lists the data elements of an instance, e.g. the one returned by
+    'retrieve_feedback'.
+
+    :param instance: Instance as dict.
+    :param data_types: Only keep elements with these dataType values.
+    :return: The data element dicts.
+    """
+    wanted = set(data_types) if data_types is not None else None
+    return [
+        element for element in instance.get("data", [])
+        if wanted is None or element.get("dataType") in wanted
+    ]
+
+
+def download_name(element: Dict, taken: set) -> str:
+    """
+    A safe, unique file name for a data element. Falls back to the element
+    id when it has no file name, and prefixes the id on collisions.
+    """
+    name = Path(element.get("filename") or element["id"]).name
+    if name in taken:
+        name = f"{element['id']}_{name}"
+    taken.add(name)
+    return name
+
+
+def sink_name(sink: DownloadSink) -> str:
+    """File name of a sink, empty for file objects without a name."""
+    name = sink if not hasattr(sink, "write") else getattr(sink, "name", "")
+    return Path(name).name if isinstance(name, (str, Path)) else ""
+
+
+class ChunkWriter:
+    """Writes chunks to a file object while hashing and counting them."""
+
+    def __init__(self, file: IO[bytes]):
+        self.file = file
+        self.size = 0
+        self._hash = hashlib.sha256()
+
+    def write(self, chunk: bytes):
+        self.file.write(chunk)
+        self._hash.update(chunk)
+        self.size += len(chunk)
+
+    @property
+    def sha256(self) -> str:
+        return self._hash.hexdigest()
+
+
+@contextmanager
+def open_sink(sink: DownloadSink):
+    """
+    Opens a sink for writing. Paths are written to a temporary file that
+    replaces the target only when the download completes, so a failed
+    download never leaves a truncated file behind.
+    """
+    if hasattr(sink, "write"):
+        yield ChunkWriter(sink)
+        return
+    path = Path(sink)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f".{path.name}.part")
+    try:
+        with open(tmp_path, "wb") as file:
+            yield ChunkWriter(file)
+        os.replace(tmp_path, path)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
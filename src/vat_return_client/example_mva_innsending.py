@@ -4,12 +4,16 @@ We have created a test user (required to do):
 - Organization number: 310332313
 - Test-id: 04815398780 (Used to log in to id-porten)
 
+For validation and submission from scripts and cron jobs, use the
+command line in cli.py ('python cli.py --help') instead.
+
 Ref:
 Create test users - https://skatteetaten.github.io/mva-meldingen/kompensasjon_eng/test/
 """
 import os
 
 from client import VatReturn
+from documents import Envelope, EnvelopeAttachment, Period, VatLine, VatMessage
 from get_id_porten_token import get_id_token
 from settings import (
     ALTINN_BASE,
@@ -18,23 +22,53 @@ from settings import (
     ORG_NUMBER,
 )
 
-# Exit the script after validation ov a VAT message.
-VALIDATE_ONLY = True
-
 
-def get_example_files(file_name: str, read_bytes: bool = False):
+def get_example_files(file_name: str) -> bytes:
     from pathlib import Path
     path = Path(__file__).parent / "example_files" / file_name
-    if read_bytes:
-        with open(path, "rb") as file:
-            return file.read()
+    with open(path, "rb") as file:
+        return file.read()
 
-    with open(path, "r", encoding="UTF-8") as file:
-        melding = file.read()
-        return melding.replace("\n", "")
+
+def example_documents(org_number: str):
+    """
+    The VAT message and envelope of example_files, for the given
+    organisation number.
+    """
+    period = Period(year=2022, period="september-oktober")
+    message = VatMessage(
+        org_number=org_number,
+        period=period,
+        total=-29000,
+        lines=[
+            VatLine("1", -100000, 25, -25000, "Inngående MVA, høy sats"),
+            VatLine("13", -12500, 12, -1500, "Inngående MVA, lav sats"),
+            VatLine(
+                "14", -10000, 25, -2500, "Innførsel MVA, høy sats",
+                remark="What do you call a fish wearing a bowtie? "
+                       "Sofishticated",
+            ),
+        ],
+        customer_id="34000009324568708",
+        remark="BFU",
+    )
+    envelope = Envelope(
+        org_number=org_number,
+        period=period,
+        created_by="DUK EMOSJONELL",
+        created_at="2022-05-15T08:41:13+01:00",
+        changed_at="2022-05-16T08:41:13+01:00",
+        attachments=[EnvelopeAttachment(
+            file_name="melding_xml",
+            created_by="DUK EMOSJONELL",
+            created_at="2022-05-15T08:41:13+01:00",
+        )],
+        instance_status="Deprecated",
+    )
+    return message, envelope
 
 
-def vat_return_process(org_number: str):
+def vat_return_process(org_number: str, validate_only: bool = True):
     token = os.environ.get("ID_PORTEN_TOKEN", None)
     if token:
         id_porten_token_header = {"Authorization": token}
@@ -48,12 +82,13 @@ def vat_return_process(org_number: str):
         instance_api_url=INSTANCE_API_URL,
     )
     vat_client.set_altinn_token()
-    vat_message_delivery_filename = "message/compensation_vat_message.xml"
-    mva_message = get_example_files(file_name=vat_message_delivery_filename, read_bytes=True)
+    message, envelope = example_documents(org_number)
+    mva_message = message.to_bytes()
     print("---- Validating -----")
     validation = vat_client.validate_tax_return(body=mva_message)
     print(validation)
-    if VALIDATE_ONLY:
+    # Stop after validation of the VAT message.
+    if validate_only:
         return
 
     print("---- Creating Instance -----")
@@ -62,10 +97,9 @@ def vat_return_process(org_number: str):
     instance_data_url = instance["data"][0]["selfLinks"]["apps"]
 
     print("---- Update Vat Submission -----")
-    vat_message_delivery_filename = "envelope/compensation_vat_envelope.xml"
-    envelope = get_example_files(file_name=vat_message_delivery_filename)
     upload_vat_submission = vat_client.upload_vat_submission(
-        instance_data_app_url=instance_data_url, content=envelope
+        instance_data_app_url=instance_data_url,
+        content=envelope.iter_bytes(),
     )
     print("---- Update Vat Message -----")
     upload_vat_return = vat_client.upload_vat_return(
@@ -73,7 +107,7 @@ def vat_return_process(org_number: str):
     )
 
     print("---- Upload Attachments -----")
-    vat_appendix = get_example_files("appendix/vat_appendix.xml", read_bytes=True)
+    vat_appendix = get_example_files("appendix/vat_appendix.xml")
     upload_attachment = vat_client.upload_attachments(
         instance_url=instance_url,
         content_type="text/xml",
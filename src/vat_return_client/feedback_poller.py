@@ -0,0 +1,242 @@
+"""
+Polls feedback for many instances at once.
+One scheduler thread keeps every pending instance in a priority queue
+ordered by when it is next due, and a small worker pool does the status
+requests. Each instance backs off exponentially (with jitter) between
+checks and gives up at its deadline. Results are delivered as a stream
+('results') and/or through callbacks.
+"""
+import heapq
+import itertools
+import logging
+import queue
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterator, List, Optional
+
+from client import VatReturn
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class FeedbackResult:
+    """
+    Outcome of polling one instance.
+
+    status is one of:
+    - "feedback": feedback was provided, see 'feedback'.
+    - "timeout": the deadline passed before feedback was provided.
+    - "error": the status checks kept failing, see 'error'.
+    """
+    instance_url: str
+    status: str
+    feedback: Optional[Dict] = None
+    error: Optional[str] = None
+    attempts: int = 0
+    elapsed: float = 0.0
+
+
+class _Pending:
+    """Polling state of one instance."""
+
+    def __init__(self, instance_url: str, deadline: float, delay: float):
+        self.instance_url = instance_url
+        self.added_at = time.monotonic()
+        self.deadline = deadline
+        self.delay = delay
+        self.attempts = 0
+        self.errors = 0
+
+
+class FeedbackPoller:
+    """
+    Polls '/feedback/status' for many instances on a single scheduler.
+
+    Usage:
+    with FeedbackPoller(vat_client) as poller:
+        for instance_url in instance_urls:
+            poller.add(instance_url)
+        for result in poller.results():
+            ...
+
+    :param vat_client: Client used for the status and feedback requests.
+    :param workers: Number of threads doing requests.
+    :param initial_delay: Seconds before the first check of an instance.
+    :param max_delay: Upper bound of the delay between two checks.
+    :param backoff: Factor the delay grows with after each check.
+    :param jitter: Relative random spread of each delay (0.1 = +-10%).
+    :param timeout: Default seconds from 'add' until an instance times out.
+    :param max_errors: Failed checks in a row before giving up.
+    :param on_result: Called with every FeedbackResult, from a worker.
+    Errors it raises are logged.
+    """
+
+    def __init__(
+            self,
+            vat_client: VatReturn,
+            workers: int = 4,
+            initial_delay: float = 2,
+            max_delay: float = 60,
+            backoff: float = 2.0,
+            jitter: float = 0.1,
+            timeout: float = 600,
+            max_errors: int = 5,
+            on_result: Optional[Callable[[FeedbackResult], None]] = None,
+    ):
+        self.vat_client = vat_client
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.backoff = backoff
+        self.jitter = jitter
+        self.timeout = timeout
+        self.max_errors = max_errors
+        self.on_result = on_result
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._heap: List[tuple] = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._results: "queue.Queue[FeedbackResult]" = queue.Queue()
+        self._outstanding = 0
+        self._stopped = False
+        self._scheduler = threading.Thread(
+            target=self._run, name="feedback-poller", daemon=True
+        )
+        self._scheduler.start()
+
+    def _jittered(self, delay: float) -> float:
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def _schedule(self, pending: _Pending, delay: float):
+        with self._condition:
+            due = time.monotonic() + self._jittered(delay)
+            heapq.heappush(self._heap, (due, next(self._sequence), pending))
+            self._condition.notify()
+
+    def add(self, instance_url: str, timeout: Optional[float] = None):
+        """
+        Starts polling an instance.
+
+        :param instance_url: Url to the instance, after it has been shipped.
+        :param timeout: Seconds to wait for feedback, default is 'timeout'.
+        """
+        timeout = self.timeout if timeout is None else timeout
+        pending = _Pending(
+            instance_url,
+            deadline=time.monotonic() + timeout,
+            delay=self.initial_delay,
+        )
+        with self._condition:
+            self._outstanding += 1
+        self._schedule(pending, pending.delay)
+
+    def pending(self) -> int:
+        """Number of instances still waiting for feedback."""
+        with self._condition:
+            return self._outstanding
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._stopped:
+                    if not self._heap:
+                        self._condition.wait()
+                        continue
+                    wait = self._heap[0][0] - time.monotonic()
+                    if wait <= 0:
+                        break
+                    self._condition.wait(wait)
+                if self._stopped:
+                    return
+                _, _, pending = heapq.heappop(self._heap)
+            self._executor.submit(self._check, pending)
+
+    def _check(self, pending: _Pending):
+        pending.attempts += 1
+        try:
+            provided = self.vat_client.get_feedback_status(
+                pending.instance_url
+            )
+            pending.errors = 0
+            if provided:
+                feedback = self.vat_client.get_feedback(pending.instance_url)
+                self._finish(pending, "feedback", feedback=feedback)
+                return
+        except Exception as error:
+            pending.errors += 1
+            if pending.errors >= self.max_errors:
+                self._finish(
+                    pending, "error", error=f"{type(error).__name__}: {error}"
+                )
+                return
+
+        pending.delay = min(pending.delay * self.backoff, self.max_delay)
+        remaining = pending.deadline - time.monotonic()
+        if remaining <= 0:
+            self._finish(pending, "timeout")
+            return
+        self._schedule(pending, min(pending.delay, remaining))
+
+    def _finish(self, pending: _Pending, status: str, **kwargs):
+        result = FeedbackResult(
+            instance_url=pending.instance_url,
+            status=status,
+            attempts=pending.attempts,
+            elapsed=time.monotonic() - pending.added_at,
+            **kwargs,
+        )
+        try:
+            if self.on_result is not None:
+                self.on_result(result)
+        except Exception:
+            # A failing callback must not keep results() and wait() from
+            # seeing the instance finish.
+            logger.exception("on_result failed for %s.", pending.instance_url)
+        finally:
+            self._results.put(result)
+            with self._condition:
+                self._outstanding -= 1
+                self._condition.notify_all()
+
+    def results(self, timeout: Optional[float] = None) -> Iterator[FeedbackResult]:
+        """
+        Yields results as instances finish, until none are pending.
+
+        :param timeout: Max seconds to wait for the next result.
+        """
+        while True:
+            with self._condition:
+                if not self._outstanding and self._results.empty():
+                    return
+            try:
+                yield self._results.get(timeout=timeout)
+            except queue.Empty:
+                return
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """
+        Blocks until no instance is pending.
+
+        :return: False if the timeout passed first.
+        """
+        with self._condition:
+            return self._condition.wait_for(
+                lambda: not self._outstanding, timeout
+            )
+
+    def stop(self):
+        """Stops polling. Pending instances are dropped."""
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        self._scheduler.join()
+        self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
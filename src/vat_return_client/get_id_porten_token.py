@@ -4,19 +4,20 @@ ref: https://skatteetaten.github.io/mva-meldingen/documentation/idportenautentis
 """
 import base64
 import json
+import logging
 import secrets
 import sys
 import time
-import webbrowser
 from base64 import urlsafe_b64decode, urlsafe_b64encode
+from concurrent.futures import Future
+from dataclasses import dataclass, field
 from hashlib import sha256
-from http.server import BaseHTTPRequestHandler, HTTPServer
-from urllib.parse import urlparse, parse_qs, urlencode
-
-import jwt
-import requests
-from cryptography import x509
+from typing import Optional
+from urllib.parse import urlencode
 
+from client_assertion import CLIENT_ASSERTION_TYPE, ClientAssertions
+from jwks_cache import JwksCache, load_public_certs
+from metrics import instrumented, operation
 from settings import (
     ID_PORTEN_CLIENT_ID,
     ID_PORTEN_CLIENT_SECRET,
@@ -28,46 +29,22 @@ from settings import (
     SCOPES,
     CLIENT_AUTHENTICATION_METHOD,
     SERVER_TIMEOUT,
+    ID_PORTEN_USER,
+    ID_PORTEN_REFRESH_MARGIN,
+    TOKEN_STORE_DIR,
 )
+from token_store import TokenSet
+from transport import Transport
 
+# Shared by every login in the process. Calls made through the transport
+# are reported to metrics.INSTRUMENTATION.
+TRANSPORT = Transport()
+# See jwks_cache.py.
+JWKS_CACHE = JwksCache(transport=TRANSPORT)
+# See client_assertion.py, used with private_key_jwt.
+CLIENT_ASSERTIONS = ClientAssertions()
 
-class BrowserRedirectHandler(BaseHTTPRequestHandler):
-    """
-    A simple web server hosted locally.
-
-    This class provides a custom request handler for HTTP GET requests.
-    When a GET request is received, the server responds with a 200 status code
-    and a simple HTML page that informs the user about the completion of the
-    authentication process.
-
-    Class Attributes:
-        timeout (int): The timeout value for the server connection.
-        result: Holds the result of the request handling process.
-
-    Methods:
-        do_GET(): Handles the HTTP GET request.
-    """
-    result = None
-
-    def do_GET(self):
-        """Handle HTTP GET request."""
-        self.send_response(200)
-        self.send_header("Content-Type", "text/html")
-        self.end_headers()
-        html_content = """
-        <!DOCTYPE html>
-        <html>
-        <head>
-            <title>Authentication complete</title>
-        </head>
-        <body>
-            <h1>Authentication complete</h1>
-            <p>You may close this page. (Test page for redirect)</p>
-        </body>
-        </html>
-        """
-        self.wfile.write(html_content.encode())
-        BrowserRedirectHandler.result = self
+logger = logging.getLogger(__name__)
 
 
 def random_bytes(n: int) -> bytes:
@@ -104,51 +81,59 @@ def decode_dokument(dokument: dict) -> dict:
     return dokument
 
 
+@instrumented
 def get_jwks(jwk_url: str = ID_PORTEN_JWK_URL) -> dict:
     """
-    Retrieve the JSON Web Key Set (JWKS) from id porten.
+    Retrieve the JSON Web Key Set (JWKS) from id porten. Served from
+    JWKS_CACHE while it is valid.
 
     :returns: The JWKS as a dictionary.
     """
-    response = requests.get(jwk_url)
+    if jwk_url == JWKS_CACHE.jwk_url:
+        return JWKS_CACHE.get_jwks()
+    response = TRANSPORT.get(jwk_url)
     jwks_uri = response.json()["jwks_uri"]
-    jwks_response = requests.get(jwks_uri)
+    jwks_response = TRANSPORT.get(jwks_uri)
     jwks = jwks_response.json()
     return jwks
 
 
-def load_public_certs(x5c: list) -> list:
-    """Loads public certificates from x5c header."""
-    return [
-        x509.load_der_x509_certificate(
-            base64.b64decode(cert),
-        ) for cert in x5c
-    ]
-
-
-def get_id_token(
+@dataclass
+class LoginFlow:
+    """
+    One ID-porten log-in in progress: what was sent to /authorize and is
+    needed again to exchange the code. 'future' is completed with the
+    token_store.TokenSet, or the error, when the flow ends.
+    """
+    state: str
+    nonce: str
+    code_verifier: bytes
+    code_challenge: str
+    authorize_uri: str
+    client_id: str
+    scope: str
+    auth_domain: str
+    redirect_uri: str
+    created_at: float = field(default_factory=time.monotonic)
+    future: Future = field(default_factory=Future, repr=False)
+
+
+def new_login_flow(
         client_id: str = ID_PORTEN_CLIENT_ID,
         scope: str = SCOPES,
         auth_domain: str = ID_PORTEN_AUTH_DOMAIN,
-        server_port: int = SERVER_PORT,
         redirect_uri: str = REDIRECT_URI,
-        server_timeout: int = SERVER_TIMEOUT,
-) -> dict:
+) -> LoginFlow:
     """
-    Perform authentication and retrieve the ID token.
-    Default attributes are towards test environments.
+    Creates the state, PKCE verifier and nonce of a log-in and the
+    /authorize url to send the user to.
 
     :param client_id: Client id for the integration.
     :param scope: Scopes, default is the ones that is required.
     :param auth_domain: Environment specific auth domain.
-    :param server_port: Port for the server.
     :param redirect_uri: The redirect uri specified in the integration.
-    :param server_timeout: How long a person use to log-in via ID porten.
-    :return: Authorization headers as dict.
+    :return: The flow.
     """
-    # Clean to ensure a clean state before handling the auth process.
-    BrowserRedirectHandler.result = None
-
     # Public clients need state parameter and PKCE challenge
     # https://tools.ietf.org/html/draft-ietf-oauth-browser-based-apps-00
     state = urlsafe_b64encode(random_bytes(16)).decode().rstrip("=")
@@ -158,11 +143,6 @@ def get_id_token(
     pkce_challenge = urlsafe_b64encode(sha256(pkce_secret).digest()).decode()
     nonce = str(int(time.time() * 1e6))
 
-    print("state:", state)
-    print("pkce_secret:", pkce_secret.decode("utf-8"))
-    print("pkce_challenge:", pkce_challenge)
-    print("nonce:", nonce)
-
     authorize_query_params = {
         "scope": scope,
         "acr_values": "Level3",
@@ -176,71 +156,118 @@ def get_id_token(
         "ui_locales": "nb"
     }
     encoded_params = urlencode(authorize_query_params, safe="?&=_")
-    # Connecting to the /authorize endpoint.
-    authorize_uri = f"https://{auth_domain}/authorize?{encoded_params}"
-
-    # Starts the test server
-    server = HTTPServer(("127.0.0.1", server_port), BrowserRedirectHandler)
-
-    # Open web browser to get ID-porten authorization token.
-    webbrowser.open(authorize_uri)
-
-    # Wait for callback from ID-porten
-    server.timeout = server_timeout
-    start_time = time.time()
-    while not hasattr(BrowserRedirectHandler.result, "path"):
-        server.handle_request()
-        if time.time() - start_time > server.timeout:
-            server.server_close()
-            sys.exit("Wrong identity towards id porten.")
+    return LoginFlow(
+        state=state,
+        nonce=nonce,
+        code_verifier=pkce_secret,
+        code_challenge=pkce_challenge,
+        # Connecting to the /authorize endpoint.
+        authorize_uri=f"https://{auth_domain}/authorize?{encoded_params}",
+        client_id=client_id,
+        scope=scope,
+        auth_domain=auth_domain,
+        redirect_uri=redirect_uri,
+    )
 
-    # Free the port, no more callbacks expected
-    server.server_close()
-    print("Authorization token received")
 
-    # result.path is now "/token?code=...&state=...".
-    # We must verify that state is identical to what we sent.
-    # ref: https://tools.ietf.org/html/rfc7636
-    parsed_response = urlparse(BrowserRedirectHandler.result.path)
-    query_string = parsed_response.query
-    query_state = parse_qs(query_string)
+def _decode_claims(token: str) -> dict:
+    """The claims of a JWT, without verifying it."""
+    return json.loads(urlsafe_b64decode(token.split(".", 3)[1] + "==").decode())
 
-    print("State was " + state)
-    print(f"Query state length is {len(query_state['state'])}")
-    print(f"Query state is {query_state['state'][0]}")
-    assert len(query_state["state"]) == 1 and query_state["state"][0] == state
 
-    # Use the authorization code to get access and id token from /token
-    payload = {
-        "grant_type": "authorization_code",
-        "code_verifier": pkce_secret,
-        "code": query_state["code"][0],
-        "redirect_uri": redirect_uri,
-        "client_id": client_id,
-        "scope": scope,
-    }
+def _token_request(auth_domain: str, payload: dict) -> dict:
+    """POSTs a grant to /token and returns the response."""
     if CLIENT_AUTHENTICATION_METHOD == "client_secret_post":
         payload["client_secret"] = ID_PORTEN_CLIENT_SECRET
+    elif CLIENT_AUTHENTICATION_METHOD == "private_key_jwt":
+        payload["client_assertion_type"] = CLIENT_ASSERTION_TYPE
+        payload["client_assertion"] = CLIENT_ASSERTIONS.get(
+            payload["client_id"], f"https://{auth_domain}/"
+        )
 
     headers = {"Accept": "application/json"}
 
     # Connecting to the /token endpoint.
-    response = requests.post(
-        f"https://{auth_domain}/token", headers=headers, data=payload
-    )
+    with operation("id_porten_token"):
+        response = TRANSPORT.post(
+            f"https://{auth_domain}/token", headers=headers, data=payload
+        )
     if response.status_code != 200:
-        print(response.status_code)
-        print(response.json())
+        logger.error("The token endpoint answered %s: %s",
+                     response.status_code, response.text[:500])
         response.raise_for_status()
     auth_result = response.json()
+    assert auth_result["token_type"] == "Bearer"
+    return auth_result
+
+
+def _check_access_token(
+        access_token: str, client_id: str, auth_domain: str
+) -> dict:
+    """Validates the access token and returns its claims."""
+    import jwt
+
+    # Validate the access token, this is what we have to pass on to the APIs.
+    jwt.decode(
+        access_token,
+        JWKS_CACHE.get_public_key(
+            jwt.get_unverified_header(access_token).get("kid")
+        ),
+        algorithms=ALGORITHMS,
+        issuer=f"https://{auth_domain}/",
+    )
+    access_token_decoded = _decode_claims(access_token)
+
+    # Validations for access token
+    assert access_token_decoded["client_id"] == client_id
+    assert access_token_decoded["token_type"] == "Bearer"
+    assert access_token_decoded["acr"] in ["Level3", "Level4"]
+    return access_token_decoded
+
+
+def _token_set(
+        auth_result: dict, access_claims: dict, subject: Optional[str]
+) -> TokenSet:
+    refresh_expires_in = auth_result.get("refresh_token_expires_in")
+    return TokenSet(
+        access_token=auth_result["access_token"],
+        expires_at=float(access_claims["exp"]),
+        refresh_token=auth_result.get("refresh_token"),
+        refresh_expires_at=time.time() + refresh_expires_in
+        if refresh_expires_in is not None else None,
+        subject=subject,
+    )
+
+
+def exchange_code(flow: LoginFlow, code: str) -> TokenSet:
+    """
+    Exchanges the authorization code of a flow at /token and validates the
+    id and access tokens.
+
+    :param flow: The flow the code was issued to.
+    :param code: The 'code' of the callback.
+    :return: The tokens, with the refresh token if the integration has one.
+    """
+    import jwt
+
+    auth_domain = flow.auth_domain
+    client_id = flow.client_id
+    # Use the authorization code to get access and id token from /token
+    auth_result = _token_request(auth_domain, {
+        "grant_type": "authorization_code",
+        "code_verifier": flow.code_verifier,
+        "code": code,
+        "redirect_uri": flow.redirect_uri,
+        "client_id": client_id,
+        "scope": flow.scope,
+    })
     access_token = auth_result["access_token"]
     id_token = auth_result["id_token"]
-    assert auth_result["token_type"] == "Bearer"
 
-    # Get the jwks from id porten (for token verification later)
-    jwks = get_jwks()
-    public_certs = load_public_certs(jwks["keys"][0]["x5c"])
-    public_key = public_certs[0].public_key()
+    # Get the signing key from the cached jwks (for token verification)
+    public_key = JWKS_CACHE.get_public_key(
+        jwt.get_unverified_header(id_token).get("kid")
+    )
 
     # Validate tokens, ref: https://tools.ietf.org/html/rfc7519#section-7.2
     jwt.decode(
@@ -251,32 +278,150 @@ def get_id_token(
         audience=client_id,
         access_token=access_token,
     )
-    id_token_encoded = id_token.split(".")[1]
-    id_token_decoded = json.loads(
-        urlsafe_b64decode(id_token_encoded + "==").decode()
+    id_token_decoded = _decode_claims(id_token)
+    assert id_token_decoded["nonce"] == flow.nonce
+
+    access_claims = _check_access_token(access_token, client_id, auth_domain)
+    return _token_set(
+        auth_result, access_claims,
+        id_token_decoded.get("pid") or id_token_decoded.get("sub"),
     )
-    assert id_token_decoded["nonce"] == nonce
 
-    # Validate the access token, this is what we have to pass on to the APIs.
-    jwt.decode(
-        access_token,
-        public_key,
-        algorithms=ALGORITHMS,
-        issuer=f"https://{auth_domain}/",
+
+def refresh_tokens(
+        tokens: TokenSet,
+        client_id: str = ID_PORTEN_CLIENT_ID,
+        scope: str = SCOPES,
+        auth_domain: str = ID_PORTEN_AUTH_DOMAIN,
+) -> TokenSet:
+    """
+    Renews the access token with the refresh_token grant, no log-in needed.
+
+    :param tokens: Tokens with a refresh token.
+    :param client_id: Client id for the integration.
+    :param scope: Scopes, default is the ones that is required.
+    :param auth_domain: Environment specific auth domain.
+    :return: The new tokens. ID-porten rotates refresh tokens, so the old
+    refresh token must not be used again.
+    """
+    auth_result = _token_request(auth_domain, {
+        "grant_type": "refresh_token",
+        "refresh_token": tokens.refresh_token,
+        "client_id": client_id,
+        "scope": scope,
+    })
+    access_claims = _check_access_token(
+        auth_result["access_token"], client_id, auth_domain
     )
+    refreshed = _token_set(auth_result, access_claims, tokens.subject)
+    if refreshed.refresh_token is None:
+        refreshed.refresh_token = tokens.refresh_token
+        refreshed.refresh_expires_at = tokens.refresh_expires_at
+    return refreshed
+
+
+def _stored_tokens(
+        token_store, client_id: str, scope: str, auth_domain: str, user: str,
+) -> Optional[TokenSet]:
+    """
+    Valid tokens of the user from the store, renewed with the refresh token
+    when the access token is about to expire. None when a log-in is needed.
+    """
+    tokens = token_store.load(client_id, user)
+    if tokens is None:
+        return None
+    if not tokens.expires_within(ID_PORTEN_REFRESH_MARGIN):
+        return tokens
+    if not tokens.can_refresh():
+        return None
+    try:
+        tokens = refresh_tokens(tokens, client_id, scope, auth_domain)
+    except Exception as error:
+        # Revoked or expired refresh token, log in again.
+        logger.warning("Refreshing the token failed: %s", error)
+        token_store.delete(client_id, user)
+        return None
+    token_store.save(client_id, user, tokens)
+    return tokens
 
-    access_token_encoded = access_token.split(".", 3)[1]
-    access_token_decoded = json.loads(
-        urlsafe_b64decode(access_token_encoded + "==").decode()
+
+def get_id_token(
+        client_id: str = ID_PORTEN_CLIENT_ID,
+        scope: str = SCOPES,
+        auth_domain: str = ID_PORTEN_AUTH_DOMAIN,
+        server_port: int = SERVER_PORT,
+        redirect_uri: str = REDIRECT_URI,
+        server_timeout: int = SERVER_TIMEOUT,
+        user: str = ID_PORTEN_USER,
+        token_store=None,
+) -> dict:
+    """
+    Perform authentication and retrieve the ID token.
+    Default attributes are towards test environments.
+
+    Tokens are kept in the token store given, or in a
+    token_store.TokenStore in TOKEN_STORE_DIR if that is set. A stored
+    access token is used while valid and renewed with its refresh token
+    near expiry, so the browser log-in only happens when there are no
+    usable tokens.
+
+    :param client_id: Client id for the integration.
+    :param scope: Scopes, default is the ones that is required.
+    :param auth_domain: Environment specific auth domain.
+    :param server_port: Port for the server.
+    :param redirect_uri: The redirect uri specified in the integration.
+    :param server_timeout: How long a person use to log-in via ID porten.
+    :param user: Name of the user in the token store.
+    :param token_store: Token store to use, instead of TOKEN_STORE_DIR.
+    :return: Authorization headers as dict.
+    """
+    if token_store is None and TOKEN_STORE_DIR is not None:
+        from token_store import TokenStore
+        token_store = TokenStore(TOKEN_STORE_DIR)
+    if token_store is not None:
+        tokens = _stored_tokens(
+            token_store, client_id, scope, auth_domain, user
+        )
+        if tokens is not None:
+            return tokens.headers()
+
+    # Only needed for the interactive log-in, so they are not loaded by
+    # processes using a pre-supplied token.
+    import webbrowser
+
+    from login_server import LoginServer
+
+    flow = new_login_flow(
+        client_id=client_id,
+        scope=scope,
+        auth_domain=auth_domain,
+        redirect_uri=redirect_uri,
     )
+    # The code verifier is a secret and is not logged.
+    logger.debug("Log-in flow with state %s.", flow.state)
+
+    # Starts the server, it is closed (freeing the port) when done.
+    with LoginServer(port=server_port, timeout=float(server_timeout)) \
+            as server:
+        server.add(flow)
+        # Open web browser to get ID-porten authorization token.
+        webbrowser.open(flow.authorize_uri)
+        # Wait for the callback from ID-porten and the token exchange.
+        try:
+            tokens = flow.future.result()
+        except TimeoutError:
+            sys.exit("Wrong identity towards id porten.")
+    if token_store is not None:
+        token_store.save(client_id, user, tokens)
 
-    # Validations for access token
-    assert access_token_decoded["client_id"] == client_id
-    assert access_token_decoded["token_type"] == "Bearer"
-    assert access_token_decoded["acr"] in ["Level3", "Level4"]
+    logger.info("Token validated, expires in %d seconds.",
+                int(tokens.expires_at - time.time()))
+    return tokens.headers()
 
-    token_expiration = access_token_decoded["exp"] - int(time.time())
-    print(f"Token validated, expires in {token_expiration} seconds.")
-    print(f"\nBearer {access_token}\n")
 
-    return {"Authorization": f"Bearer {access_token}"}
+if __name__ == "__main__":
+    # Logs in and writes only the authorization header to stdout, for
+    # ID_PORTEN_TOKEN="$(python get_id_porten_token.py)".
+    logging.basicConfig(stream=sys.stderr, level=logging.INFO,
+                        format="%(message)s")
+    print(get_id_token()["Authorization"])
@@ -0,0 +1,281 @@
+"""
+Hedged requests for idempotent, read-only calls.
+When the first attempt of a call has not answered within a quantile of the
+recent latency of the same operation, an identical second attempt is sent
+and the first reply wins. Hedges are paid for from a budget that grows by
+a fraction of a token with every call, so at most that fraction of calls
+are sent twice, also when a host slows down for everyone.
+
+requests can not abort a call in flight: the losing attempt is cancelled
+if it has not started yet, else its response is closed when it arrives.
+With 'call_async' the attempts are tasks and the loser is cancelled.
+ref: https://research.google/pubs/the-tail-at-scale/
+"""
+import asyncio
+import contextvars
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Awaitable, Callable, Deque, Dict, List, Optional, TypeVar
+
+from metrics import _labels, current_operation
+from settings import (
+    HEDGE_BUDGET,
+    HEDGE_MAX_WORKERS,
+    HEDGE_MIN_DELAY,
+    HEDGE_MIN_SAMPLES,
+    HEDGE_QUANTILE,
+    HEDGE_WINDOW,
+)
+
+T = TypeVar("T")
+
+
+class _Latencies:
+    """The last 'window' latencies of one operation."""
+
+    def __init__(self, window: int):
+        self.values: Deque[float] = deque(maxlen=window)
+
+    def quantile(self, q: float) -> float:
+        ordered = sorted(self.values)
+        return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+class HedgePolicy:
+    """
+    Sends calls given to 'call' on a thread pool and hedges the slow ones.
+    The wait before hedging counts from when the first attempt starts, so
+    time spent queued for a busy pool is not taken for a slow reply. Until
+    an operation has enough latencies to hedge on, its calls run on the
+    caller's thread. One policy is meant to be shared by every client of a
+    process, the budget then caps the extra load of all of them together.
+
+    :param quantile: Quantile of the recent latency of an operation after
+    which the call is hedged.
+    :param min_delay: Seconds to wait at least before hedging.
+    :param budget: Hedges allowed per call.
+    :param burst: Hedges that can be saved up from the budget.
+    :param min_samples: Latencies seen of an operation before it is hedged.
+    :param window: Latencies kept per operation.
+    :param max_workers: Threads sending the attempts.
+    """
+
+    def __init__(
+            self,
+            quantile: float = HEDGE_QUANTILE,
+            min_delay: float = HEDGE_MIN_DELAY,
+            budget: float = HEDGE_BUDGET,
+            burst: float = 10.0,
+            min_samples: int = HEDGE_MIN_SAMPLES,
+            window: int = HEDGE_WINDOW,
+            max_workers: int = HEDGE_MAX_WORKERS,
+    ):
+        self.quantile = quantile
+        self.min_delay = min_delay
+        self.budget = budget
+        self.burst = burst
+        self.min_samples = min_samples
+        self.window = window
+        self._tokens = burst
+        self._latencies: Dict[str, _Latencies] = {}
+        self._counts: Dict[str, List[int]] = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="hedged-call"
+        )
+
+    def delay(self, operation: str) -> Optional[float]:
+        """
+        Seconds to wait for the first attempt before hedging, None while
+        too few latencies of the operation have been seen.
+        """
+        with self._lock:
+            latencies = self._latencies.get(operation)
+            if latencies is None or len(latencies.values) < self.min_samples:
+                return None
+            return max(latencies.quantile(self.quantile), self.min_delay)
+
+    def _observe(self, operation: str, seconds: float):
+        with self._lock:
+            latencies = self._latencies.get(operation)
+            if latencies is None:
+                latencies = self._latencies[operation] = _Latencies(
+                    self.window
+                )
+            latencies.values.append(seconds)
+
+    def _count(self, operation: str, index: int):
+        # [calls, hedged, hedge wins, denied by the budget]
+        with self._lock:
+            counts = self._counts.setdefault(operation, [0, 0, 0, 0])
+            counts[index] += 1
+            if index == 0:
+                self._tokens = min(self._tokens + self.budget, self.burst)
+
+    def _take_token(self) -> bool:
+        with self._lock:
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+    def _timed(self, operation: str, send: Callable[[], T],
+               started: Optional[threading.Event] = None) -> T:
+        if started is not None:
+            started.set()
+        start = time.perf_counter()
+        result = send()
+        self._observe(operation, time.perf_counter() - start)
+        return result
+
+    def _submit(self, operation: str, send: Callable[[], T],
+                started: Optional[threading.Event] = None) -> Future:
+        # The operation name and other context follow the attempt onto the
+        # worker thread.
+        return self._executor.submit(
+            contextvars.copy_context().run,
+            self._timed, operation, send, started,
+        )
+
+    def call(self, send: Callable[[], T], operation: Optional[str] = None) -> T:
+        """
+        Calls 'send', a second time if the first call is slow, and returns
+        the first result. An error is only raised when no attempt succeeds.
+
+        :param send: Sends the request, must be safe to call twice.
+        :param operation: Latencies are kept per operation, defaults to
+        the instrumented client method making the call.
+        """
+        operation = operation or current_operation() or ""
+        self._count(operation, 0)
+        delay = self.delay(operation)
+        if delay is None:
+            return self._timed(operation, send)
+        started = threading.Event()
+        first = self._submit(operation, send, started)
+        started.wait()
+        done, _ = wait([first], timeout=delay)
+        if done:
+            return first.result()
+        if not self._take_token():
+            self._count(operation, 3)
+            return first.result()
+        self._count(operation, 1)
+        hedge = self._submit(operation, send)
+        pending = {first, hedge}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is not None:
+                    error = error or future.exception()
+                    continue
+                for loser in pending:
+                    if not loser.cancel():
+                        loser.add_done_callback(_close_response)
+                if future is hedge:
+                    self._count(operation, 2)
+                return future.result()
+        raise error
+
+    async def call_async(
+            self,
+            send: Callable[[], Awaitable[T]],
+            operation: Optional[str] = None,
+    ) -> T:
+        """
+        'call' for coroutines: 'send' is awaited, the hedge is a second
+        task on the same loop, and the losing attempt is cancelled.
+
+        :param send: Coroutine function sending the request, must be safe
+        to call twice.
+        :param operation: Latencies are kept per operation, defaults to
+        the instrumented client method making the call.
+        """
+        operation = operation or current_operation() or ""
+        self._count(operation, 0)
+
+        async def timed():
+            start = time.perf_counter()
+            result = await send()
+            self._observe(operation, time.perf_counter() - start)
+            return result
+
+        delay = self.delay(operation)
+        if delay is None:
+            return await timed()
+        first = asyncio.ensure_future(timed())
+        done, _ = await asyncio.wait([first], timeout=delay)
+        if done:
+            return first.result()
+        if not self._take_token():
+            self._count(operation, 3)
+            return await first
+        self._count(operation, 1)
+        hedge = asyncio.ensure_future(timed())
+        pending = {first, hedge}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    if task.exception() is not None:
+                        error = error or task.exception()
+                        continue
+                    if task is hedge:
+                        self._count(operation, 2)
+                    return task.result()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        """Calls, hedged calls, hedge wins and denied hedges by operation."""
+        with self._lock:
+            return {
+                operation: dict(zip(
+                    ("calls", "hedged", "hedge_wins", "denied"), counts
+                ))
+                for operation, counts in self._counts.items()
+            }
+
+    def prometheus_text(self, prefix: str = "vat_return") -> str:
+        """The hedge counters in the Prometheus text exposition format."""
+        lines = []
+        stats = self.stats()
+        for name, metric, help_text in (
+                ("calls", "hedgeable_calls_total",
+                 "Calls sent through the hedge policy."),
+                ("hedged", "hedges_total", "Calls a hedge was sent for."),
+                ("hedge_wins", "hedge_wins_total",
+                 "Calls answered first by the hedge."),
+                ("denied", "hedges_denied_total",
+                 "Hedges not sent for lack of budget."),
+        ):
+            metric = f"{prefix}_{metric}"
+            lines += [
+                f"# HELP {metric} {help_text}",
+                f"# TYPE {metric} counter",
+            ]
+            for operation, counts in sorted(stats.items()):
+                lines.append(
+                    f"{metric}{_labels(operation=operation)} {counts[name]}"
+                )
+        return "\n".join(lines) + "\n"
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+
+def _close_response(future: Future):
+    """Frees the connection of an attempt that lost."""
+    if future.cancelled() or future.exception() is not None:
+        return
+    close = getattr(future.result(), "close", None)
+    if close is not None:
+        close()
@@ -0,0 +1,291 @@
+"""
+Local index of the Altinn instances of our filings.
+Every instance the client creates, ships or fetches feedback for is
+recorded in SQLite with its selfLinks, data elements, process step and
+feedback status. 'sync' brings the index up to date from the Altinn
+storage instance query, reading only instances changed since the last
+sync (a lastChanged cursor per query) and following the 'next' pages.
+Questions like "which filings still await feedback" are then answered
+locally instead of with one status call per instance.
+ref: https://docs.altinn.studio/api/storage/
+"""
+import json
+import re
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional, Union
+
+from settings import INSTANCE_INDEX_FILE, VAT_APP_ID
+
+# Feedback status of an instance:
+# - "draft": still in the first task, not shipped.
+# - "awaiting": shipped, no feedback yet.
+# - "provided": the feedback (kvittering) is there or the process ended.
+FEEDBACK_STATUSES = ("draft", "awaiting", "provided")
+FIRST_TASK = "Task_1"
+
+_TIMESTAMP = re.compile(
+    r"(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)(?:\.(\d+))?(Z|[+-]\d\d:?\d\d)?$"
+)
+
+
+def instance_id(instance_url: str) -> str:
+    """The '<party id>/<guid>' id of an instance from its url."""
+    rest = instance_url.rstrip("/").split("/instances/", 1)[-1].split("/")
+    return "/".join(rest[:2])
+
+
+def changed_at(value: Optional[str]) -> Optional[datetime]:
+    """
+    A lastChanged timestamp as an aware datetime. Altinn writes up to
+    seven decimals, and drops trailing zeros, so the strings do not
+    compare in time order. Timestamps without a zone are taken as UTC.
+    """
+    match = _TIMESTAMP.match(value.strip()) if value else None
+    if match is None:
+        return None
+    seconds, fraction, zone = match.groups()
+    if zone in (None, "Z"):
+        zone = "+00:00"
+    elif ":" not in zone:
+        zone = f"{zone[:3]}:{zone[3:]}"
+    fraction = (fraction or "")[:6].ljust(6, "0")
+    return datetime.fromisoformat(f"{seconds}.{fraction}{zone}")
+
+
+def feedback_status(instance: Dict) -> str:
+    """One of FEEDBACK_STATUSES for an instance as returned by Altinn."""
+    process = instance.get("process") or {}
+    if process.get("ended") or any(
+            element.get("dataType") == "kvittering"
+            for element in instance.get("data") or []
+    ):
+        return "provided"
+    task = (process.get("currentTask") or {}).get("elementId")
+    return "draft" if task in (None, FIRST_TASK) else "awaiting"
+
+
+class InstanceIndex:
+    """
+    Instances by id in SQLite, shared by the workers and processes of a
+    job. Safe to use from many threads.
+
+    :param path: SQLite file.
+    """
+
+    def __init__(self, path: Union[str, Path] = INSTANCE_INDEX_FILE):
+        self.path = Path(path)
+        self._local = threading.local()
+        with self._connection() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS instances ("
+                "id TEXT PRIMARY KEY, org_number TEXT, instance_url TEXT, "
+                "process_step TEXT, feedback_status TEXT, data TEXT, "
+                "self_links TEXT, last_changed TEXT, recorded_at REAL)"
+            )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS instances_feedback "
+                "ON instances (feedback_status)"
+            )
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS sync_cursors ("
+                "query TEXT PRIMARY KEY, last_changed TEXT, synced_at REAL)"
+            )
+
+    def _connection(self) -> sqlite3.Connection:
+        """One connection per thread, sqlite3 connections are not shared."""
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            connection = sqlite3.connect(str(self.path), timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self._local.connection = connection
+        return connection
+
+    def record(self, instance: Dict, org_number: Optional[str] = None):
+        """
+        Records an instance as returned by create_instance, get_feedback
+        or the instance query, replacing what was known about it.
+
+        :param instance: Instance as dict.
+        :param org_number: Owner, when the instance does not tell.
+        """
+        with self._connection() as connection:
+            self._upsert(connection, instance, org_number)
+
+    @staticmethod
+    def _upsert(connection: sqlite3.Connection, instance: Dict,
+                org_number: Optional[str] = None):
+        self_links = instance.get("selfLinks") or {}
+        owner = instance.get("instanceOwner") or {}
+        process = instance.get("process") or {}
+        step = "ended" if process.get("ended") else \
+            (process.get("currentTask") or {}).get("elementId")
+        instance_url = self_links.get("apps")
+        connection.execute(
+            "INSERT INTO instances (id, org_number, instance_url, "
+            "process_step, feedback_status, data, self_links, last_changed, "
+            "recorded_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (id) DO UPDATE SET "
+            "org_number = COALESCE(excluded.org_number, org_number), "
+            "instance_url = COALESCE(excluded.instance_url, instance_url), "
+            "process_step = excluded.process_step, "
+            "feedback_status = excluded.feedback_status, "
+            "data = excluded.data, self_links = excluded.self_links, "
+            "last_changed = excluded.last_changed, "
+            "recorded_at = excluded.recorded_at",
+            (
+                instance.get("id") or instance_id(instance_url),
+                owner.get("organisationNumber") or org_number,
+                instance_url,
+                step,
+                feedback_status(instance),
+                json.dumps(instance.get("data") or []),
+                json.dumps(self_links),
+                instance.get("lastChanged"),
+                time.time(),
+            ),
+        )
+
+    def set_process_step(self, instance_url: str, step: Optional[str]):
+        """Records the task an instance was shipped to."""
+        status = "draft" if step in (None, FIRST_TASK) else "awaiting"
+        with self._connection() as connection:
+            connection.execute(
+                "UPDATE instances SET process_step = ?, feedback_status = ?, "
+                "recorded_at = ? WHERE id = ? AND feedback_status != ?",
+                (step, status, time.time(), instance_id(instance_url),
+                 "provided"),
+            )
+
+    def set_feedback_provided(self, instance_url: str):
+        with self._connection() as connection:
+            connection.execute(
+                "UPDATE instances SET feedback_status = ?, recorded_at = ? "
+                "WHERE id = ?",
+                ("provided", time.time(), instance_id(instance_url)),
+            )
+
+    @staticmethod
+    def _row(row: tuple) -> Dict:
+        (id_, org_number, instance_url, step, status, data, self_links,
+         last_changed, recorded_at) = row
+        return {
+            "id": id_,
+            "org_number": org_number,
+            "instance_url": instance_url,
+            "process_step": step,
+            "feedback_status": status,
+            "data": json.loads(data),
+            "self_links": json.loads(self_links),
+            "last_changed": last_changed,
+            "recorded_at": recorded_at,
+        }
+
+    def get(self, instance_url: str) -> Optional[Dict]:
+        """The recorded instance, None if it is not in the index."""
+        row = self._connection().execute(
+            "SELECT * FROM instances WHERE id = ?",
+            (instance_id(instance_url),)
+        ).fetchone()
+        return self._row(row) if row is not None else None
+
+    def instances(
+            self,
+            feedback: Optional[str] = None,
+            org_number: Optional[str] = None,
+    ) -> List[Dict]:
+        """
+        Recorded instances, optionally only those with a feedback status
+        (see FEEDBACK_STATUSES) or of one organisation.
+        """
+        query, parameters = "SELECT * FROM instances WHERE 1 = 1", []
+        if feedback is not None:
+            query += " AND feedback_status = ?"
+            parameters.append(feedback)
+        if org_number is not None:
+            query += " AND org_number = ?"
+            parameters.append(org_number)
+        rows = self._connection().execute(
+            query + " ORDER BY recorded_at", parameters
+        ).fetchall()
+        return [self._row(row) for row in rows]
+
+    def awaiting_feedback(self) -> List[str]:
+        """Urls of the shipped instances without feedback."""
+        return [
+            row["instance_url"] for row in self.instances(feedback="awaiting")
+        ]
+
+    def counts(self) -> Dict[str, int]:
+        """Number of instances per feedback status."""
+        rows = self._connection().execute(
+            "SELECT feedback_status, COUNT(*) FROM instances "
+            "GROUP BY feedback_status"
+        ).fetchall()
+        return dict(rows)
+
+    def cursor(self, query: Dict) -> Optional[str]:
+        """lastChanged of the newest instance seen by a query."""
+        row = self._connection().execute(
+            "SELECT last_changed FROM sync_cursors WHERE query = ?",
+            (json.dumps(query, sort_keys=True),)
+        ).fetchone()
+        return row[0] if row is not None else None
+
+    def sync(
+            self,
+            vat_client,
+            app_id: str = VAT_APP_ID,
+            filters: Optional[Dict] = None,
+            page_size: int = 100,
+    ) -> int:
+        """
+        Updates the index with the instances changed since the last sync
+        of the same query. Each page is committed as it is read, but the
+        cursor only moves when the last page is in: the query gives no
+        order, so a newer instance on an early page does not mean the
+        older ones on later pages were seen. An interrupted sync reads
+        its pages again.
+
+        :param vat_client: Client with the altinn token set.
+        :param app_id: The app the instances belong to.
+        :param filters: More query parameters, e.g. instanceOwner.partyId.
+        :param page_size: Instances per page.
+        :return: The number of instances read.
+        """
+        query = dict(filters or {}, appId=app_id)
+        key = json.dumps(query, sort_keys=True)
+        cursor = self.cursor(query)
+        parameters = dict(query, size=page_size)
+        if cursor is not None:
+            # gte, instances changed in the same tick are read again rather
+            # than missed.
+            parameters["lastChanged"] = f"gte:{cursor}"
+        newest = changed_at(cursor)
+        page = vat_client.query_instances(params=parameters)
+        synced = 0
+        while True:
+            instances = page.get("instances") or []
+            with self._connection() as connection:
+                for instance in instances:
+                    self._upsert(connection, instance)
+                    changed = changed_at(instance.get("lastChanged"))
+                    if changed is not None and (
+                            newest is None or changed > newest
+                    ):
+                        newest, cursor = changed, instance["lastChanged"]
+            synced += len(instances)
+            if not page.get("next") or not instances:
+                break
+            page = vat_client.query_instances(url=page["next"])
+        with self._connection() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO sync_cursors "
+                "(query, last_changed, synced_at) VALUES (?, ?, ?)",
+                (key, cursor, time.time()),
+            )
+        return synced
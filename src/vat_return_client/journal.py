@@ -0,0 +1,129 @@
+"""
+Durable step journal for the submission flow.
+Each completed step of a filing (instance created, envelope, message and
+attachments uploaded, each ship) is written to SQLite together with the
+instance url, data urls and content hashes. A restarted job reads the
+journal back and continues from the last checkpoint, instead of creating a
+second Altinn instance and uploading everything again.
+"""
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Optional, Union
+
+from settings import SUBMISSION_JOURNAL_FILE
+from streaming import CHUNK_SIZE
+
+
+def file_sha256(path: Union[str, Path], chunk_size: int = CHUNK_SIZE) -> str:
+    """Hex sha256 of a file, read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def filing_key(org_number: str, message: bytes) -> str:
+    """
+    Journal key of a filing: the organisation and a hash of its VAT
+    message, so a corrected message starts a new submission.
+    """
+    digest = hashlib.sha256(org_number.encode("utf-8"))
+    digest.update(b"\0")
+    digest.update(message)
+    return digest.hexdigest()
+
+
+class SubmissionJournal:
+    """
+    Completed submission steps by filing key, stored in SQLite. Every
+    record is committed before the call returns, so it survives the
+    process being killed right after.
+
+    :param path: SQLite file, shared by every worker of a job.
+    :param network_filesystem: Use file locks instead of WAL, which only
+    works between processes on one host.
+    """
+
+    def __init__(
+            self,
+            path: Union[str, Path] = SUBMISSION_JOURNAL_FILE,
+            network_filesystem: bool = False,
+    ):
+        self.path = Path(path)
+        self.network_filesystem = network_filesystem
+        self._local = threading.local()
+        with self._connection() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS submission_steps ("
+                "filing_key TEXT, step TEXT, data TEXT, sha256 TEXT, "
+                "recorded_at REAL, PRIMARY KEY (filing_key, step))"
+            )
+
+    def _connection(self) -> sqlite3.Connection:
+        """One connection per thread, sqlite3 connections are not shared."""
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            connection = sqlite3.connect(str(self.path), timeout=30)
+            connection.execute(
+                "PRAGMA journal_mode=DELETE" if self.network_filesystem
+                else "PRAGMA journal_mode=WAL"
+            )
+            connection.execute("PRAGMA synchronous=FULL")
+            self._local.connection = connection
+        return connection
+
+    def record(
+            self,
+            key: str,
+            step: str,
+            data: Optional[Dict] = None,
+            sha256: Optional[str] = None,
+    ):
+        """
+        Records a completed step.
+
+        :param key: Filing key from filing_key.
+        :param step: Step name, e.g. 'create' or 'attachment:a.xml'.
+        :param data: Urls and ids needed to resume after the step.
+        :param sha256: Hash of the uploaded content, for upload steps.
+        """
+        with self._connection() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO submission_steps "
+                "(filing_key, step, data, sha256, recorded_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (key, step, json.dumps(data or {}), sha256, time.time()),
+            )
+
+    def steps(self, key: str) -> Dict[str, Dict]:
+        """
+        The completed steps of a filing.
+
+        :param key: Filing key from filing_key.
+        :return: Dict by step name with 'data', 'sha256' and 'recorded_at'.
+        """
+        rows = self._connection().execute(
+            "SELECT step, data, sha256, recorded_at FROM submission_steps "
+            "WHERE filing_key = ?", (key,)
+        ).fetchall()
+        return {
+            step: {
+                "data": json.loads(data),
+                "sha256": sha256,
+                "recorded_at": recorded_at,
+            }
+            for step, data, sha256, recorded_at in rows
+        }
+
+    def forget(self, key: str):
+        """Removes every step of a filing, so it is submitted from scratch."""
+        with self._connection() as connection:
+            connection.execute(
+                "DELETE FROM submission_steps WHERE filing_key = ?", (key,)
+            )
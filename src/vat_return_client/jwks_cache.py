@@ -0,0 +1,152 @@
+"""
+Cache for the ID-porten JSON Web Key Set.
+Keeps the keys in memory for a TTL, optionally on disk between process
+restarts, and memoises the parsed public keys by 'kid'. The JWKS is only
+fetched again when the TTL has passed or a token is signed with an unknown
+'kid' (key rotation).
+"""
+import base64
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Optional, Union
+
+from metrics import operation
+from settings import ID_PORTEN_JWK_URL, JWKS_CACHE_TTL, JWKS_CACHE_FILE
+from transport import Transport
+
+
+class JwksCache:
+    """
+    JWKS with TTL and kid based lookup of public keys.
+
+    :param jwk_url: The openid-configuration url holding 'jwks_uri'.
+    :param ttl: Seconds a fetched JWKS is trusted.
+    :param cache_file: Optional JSON file to persist the JWKS in.
+    :param transport: Transport used for the two discovery requests.
+    :param min_refetch_interval: Minimum seconds between refetches caused
+    by unknown kids, so bogus tokens cannot make us hammer ID-porten.
+    """
+
+    def __init__(
+            self,
+            jwk_url: str = ID_PORTEN_JWK_URL,
+            ttl: float = JWKS_CACHE_TTL,
+            cache_file: Optional[Union[str, Path]] = JWKS_CACHE_FILE,
+            transport: Optional[Transport] = None,
+            min_refetch_interval: float = 60,
+    ):
+        self.jwk_url = jwk_url
+        self.ttl = ttl
+        self.cache_file = Path(cache_file) if cache_file else None
+        self.transport = transport or Transport()
+        self.min_refetch_interval = min_refetch_interval
+        self._jwks: Optional[Dict] = None
+        self._fetched_at = 0.0
+        self._public_keys: Dict[str, object] = {}
+        self._lock = threading.Lock()
+
+    def _expired(self) -> bool:
+        return self._jwks is None or time.time() - self._fetched_at > self.ttl
+
+    def _load_file(self):
+        """Loads the persisted JWKS, if any and not expired."""
+        if self.cache_file is None or not self.cache_file.exists():
+            return
+        try:
+            with open(self.cache_file, "r", encoding="UTF-8") as file:
+                stored = json.load(file)
+            fetched_at = float(stored["fetched_at"])
+            jwks = stored["jwks"]
+        except (OSError, ValueError, KeyError, TypeError):
+            # Unreadable or malformed, fetch the JWKS again.
+            return
+        if time.time() - fetched_at <= self.ttl:
+            self._jwks = jwks
+            self._fetched_at = fetched_at
+
+    def _save_file(self):
+        if self.cache_file is None:
+            return
+        self.cache_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = self.cache_file.with_suffix(".tmp")
+        with open(tmp_file, "w", encoding="UTF-8") as file:
+            json.dump({"fetched_at": self._fetched_at, "jwks": self._jwks}, file)
+        os.replace(tmp_file, self.cache_file)
+
+    def _fetch(self):
+        with operation("fetch_jwks"):
+            response = self.transport.get(self.jwk_url)
+            response.raise_for_status()
+            jwks_uri = response.json()["jwks_uri"]
+            jwks_response = self.transport.get(jwks_uri)
+            jwks_response.raise_for_status()
+        self._jwks = jwks_response.json()
+        self._fetched_at = time.time()
+        self._public_keys.clear()
+        self._save_file()
+
+    def get_jwks(self, force: bool = False) -> Dict:
+        """
+        Returns the JWKS, fetching it only when missing or expired.
+
+        :param force: Fetch even if the cached JWKS is still valid.
+        :return: The JWKS as a dictionary.
+        """
+        with self._lock:
+            if self._jwks is None and not force:
+                self._load_file()
+            if force or self._expired():
+                self._fetch()
+            return self._jwks
+
+    def _find_key(self, kid: Optional[str]) -> Optional[Dict]:
+        keys = self._jwks.get("keys", [])
+        if kid is None:
+            return keys[0] if keys else None
+        for key in keys:
+            if key.get("kid") == kid:
+                return key
+        return None
+
+    def get_public_key(self, kid: Optional[str] = None):
+        """
+        Returns the parsed public key for the kid. An unknown kid refetches
+        the JWKS once before giving up.
+
+        :param kid: Key id from the token header, None for the first key.
+        :return: A 'cryptography' public key object.
+        """
+        self.get_jwks()
+        with self._lock:
+            cache_key = kid or ""
+            public_key = self._public_keys.get(cache_key)
+            if public_key is not None:
+                return public_key
+            jwk = self._find_key(kid)
+            refetch_allowed = (
+                time.time() - self._fetched_at > self.min_refetch_interval
+            )
+            if jwk is None and refetch_allowed:
+                self._fetch()
+                jwk = self._find_key(kid)
+            if jwk is None:
+                raise KeyError(f"No key with kid '{kid}' in the JWKS.")
+            public_key = load_public_certs(jwk["x5c"][:1])[0].public_key()
+            self._public_keys[cache_key] = public_key
+            return public_key
+
+
+def load_public_certs(x5c: list) -> list:
+    """Loads public certificates from x5c header."""
+    # Imported here, cryptography is slow to import and only needed when
+    # a token is verified.
+    from cryptography import x509
+
+    return [
+        x509.load_der_x509_certificate(
+            base64.b64decode(cert),
+        ) for cert in x5c
+    ]
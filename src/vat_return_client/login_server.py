@@ -0,0 +1,202 @@
+"""
+Long-running web server receiving the ID-porten redirects of many log-ins.
+Pending flows are kept by their 'state', each with its PKCE verifier and
+nonce. A callback is answered right away, and the code is exchanged at
+/token and the tokens checked on a worker pool, so slow token requests do
+not hold up other callbacks. Every flow ends through its future: the
+tokens (token_store.TokenSet), the error ID-porten returned, or a
+TimeoutError.
+Kept out of get_id_porten_token.py so http.server is only imported when a
+user logs in interactively.
+"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional
+from urllib.parse import urlparse, parse_qs
+
+from get_id_porten_token import LoginFlow, exchange_code, new_login_flow
+from settings import SERVER_PORT, SERVER_TIMEOUT
+
+_PAGE = """<!DOCTYPE html>
+<html>
+<head>
+    <title>{title}</title>
+</head>
+<body>
+    <h1>{title}</h1>
+    <p>{text}</p>
+</body>
+</html>
+"""
+
+
+class LoginError(RuntimeError):
+    """Raised through a flow's future when ID-porten returns an error."""
+
+
+class CallbackHandler(BaseHTTPRequestHandler):
+    """
+    Handles the redirect from ID-porten, '/token?code=...&state=...', for
+    the LoginServer it belongs to.
+    """
+    server: "_CallbackServer"
+
+    def do_GET(self):
+        """Handle HTTP GET request."""
+        query = parse_qs(urlparse(self.path).query)
+        states = query.get("state", [])
+        # The state has to match a pending flow exactly once.
+        # ref: https://tools.ietf.org/html/rfc7636
+        flow = self.server.login_server.pop(states[0]) \
+            if len(states) == 1 else None
+        if flow is None:
+            self._respond(400, "Unknown log-in",
+                          "This log-in has expired or was already used.")
+            return
+        if "error" in query or "code" not in query:
+            flow.future.set_exception(LoginError(
+                f"{query.get('error', ['no code'])[0]}: "
+                f"{query.get('error_description', [''])[0]}"
+            ))
+            self._respond(400, "Authentication failed",
+                          "ID-porten did not complete the log-in.")
+            return
+        self.server.login_server.complete(flow, query["code"][0])
+        self._respond(200, "Authentication complete",
+                      "You may close this page.")
+
+    def _respond(self, status: int, title: str, text: str):
+        body = _PAGE.format(title=title, text=text).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "text/html")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Callback urls carry authorization codes, keep them out of stderr.
+        pass
+
+
+class _CallbackServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, login_server: "LoginServer"):
+        self.login_server = login_server
+        super().__init__(address, CallbackHandler)
+
+    def service_actions(self):
+        # Called by serve_forever on every poll interval.
+        self.login_server.expire()
+
+
+class LoginServer:
+    """
+    Callback server for any number of ID-porten log-ins on one port.
+
+    Usage:
+    with LoginServer(port=12345) as server:
+        flow = server.start_login()
+        # Send the user to flow.authorize_uri.
+        headers = flow.future.result().headers()
+
+    :param host: Interface to listen on.
+    :param port: Port of the redirect uri.
+    :param timeout: Seconds a flow waits for its callback.
+    :param exchange_workers: Threads doing the /token exchanges.
+    """
+
+    def __init__(
+            self,
+            host: str = "127.0.0.1",
+            port: int = SERVER_PORT,
+            timeout: float = float(SERVER_TIMEOUT),
+            exchange_workers: int = 8,
+    ):
+        self.timeout = timeout
+        self._pending: Dict[str, LoginFlow] = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(
+            max_workers=exchange_workers, thread_name_prefix="id-porten-token"
+        )
+        self._server = _CallbackServer((host, port), self)
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, kwargs={"poll_interval": 0.5},
+            name="login-server", daemon=True,
+        )
+        self._thread.start()
+
+    @property
+    def port(self) -> int:
+        return self._server.server_address[1]
+
+    def start_login(self, **kwargs) -> LoginFlow:
+        """
+        Creates and registers a new flow, see
+        get_id_porten_token.new_login_flow for the arguments.
+        """
+        flow = new_login_flow(**kwargs)
+        self.add(flow)
+        return flow
+
+    def add(self, flow: LoginFlow):
+        """Registers a flow created elsewhere."""
+        with self._lock:
+            self._pending[flow.state] = flow
+
+    def pop(self, state: str) -> Optional[LoginFlow]:
+        """Removes and returns the pending flow of a state."""
+        with self._lock:
+            return self._pending.pop(state, None)
+
+    def pending(self) -> int:
+        with self._lock:
+            return len(self._pending)
+
+    def complete(self, flow: LoginFlow, code: str):
+        """Exchanges the code on the worker pool and completes the flow."""
+        def exchange():
+            try:
+                flow.future.set_result(exchange_code(flow, code))
+            except Exception as error:
+                flow.future.set_exception(error)
+
+        self._executor.submit(exchange)
+
+    def expire(self):
+        """Fails the flows that waited longer than 'timeout'."""
+        now = time.monotonic()
+        with self._lock:
+            expired = [
+                flow for flow in self._pending.values()
+                if now - flow.created_at > self.timeout
+            ]
+            for flow in expired:
+                del self._pending[flow.state]
+        for flow in expired:
+            flow.future.set_exception(TimeoutError(
+                f"No callback within {self.timeout} seconds."
+            ))
+
+    def close(self):
+        """
+        Stops the server and frees the port. Pending flows are failed,
+        exchanges already started are waited for.
+        """
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+        with self._lock:
+            flows = list(self._pending.values())
+            self._pending.clear()
+        for flow in flows:
+            flow.future.set_exception(RuntimeError("Login server closed."))
+        self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,396 @@
+"""
+Instrumentation of the HTTP calls made by the client and the ID-porten
+log-in. The transports emit one CallEvent per call to the hooks of an
+Instrumentation; with no hooks added nothing is measured, so it can stay
+on in production. MetricsCollector is a ready made hook keeping counters
+and latency histograms, with a Prometheus text format exporter.
+"""
+import asyncio
+import bisect
+import functools
+import json
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+from urllib.parse import urlencode, urlsplit
+
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import NewConnectionError
+
+# Upper bounds in seconds of the latency histogram buckets.
+DEFAULT_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0
+)
+
+# Name of the client method or log-in step making the current call.
+_OPERATION: ContextVar[Optional[str]] = ContextVar(
+    "vat_return_operation", default=None
+)
+
+# Connection phase timings of the call running on this thread.
+_PHASES = threading.local()
+
+
+@dataclass
+class CallEvent:
+    """
+    One HTTP call. Phase timings are in seconds and None when they did not
+    happen, e.g. dns, connect and tls on a reused connection.
+
+    ttfb is the time from the connection being ready to the response
+    headers, duration the whole call including retries and body.
+    """
+    operation: Optional[str]
+    method: str
+    host: str
+    status_code: Optional[int] = None
+    bytes_sent: int = 0
+    bytes_received: int = 0
+    dns: Optional[float] = None
+    connect: Optional[float] = None
+    tls: Optional[float] = None
+    ttfb: Optional[float] = None
+    duration: float = 0.0
+    retries: int = 0
+    error: Optional[str] = None
+
+
+class Instrumentation:
+    """
+    The hooks called with every CallEvent. Hook errors are swallowed, so a
+    broken exporter never fails a submission.
+    """
+
+    def __init__(self):
+        self._hooks: Tuple[Callable[[CallEvent], None], ...] = ()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self._hooks)
+
+    def add_hook(self, hook: Callable[[CallEvent], None]):
+        with self._lock:
+            self._hooks = self._hooks + (hook,)
+
+    def remove_hook(self, hook: Callable[[CallEvent], None]):
+        with self._lock:
+            self._hooks = tuple(h for h in self._hooks if h is not hook)
+
+    def emit(self, event: CallEvent):
+        for hook in self._hooks:
+            try:
+                hook(event)
+            except Exception:
+                pass
+
+
+# Used by every transport not given an Instrumentation of its own.
+INSTRUMENTATION = Instrumentation()
+
+
+def current_operation() -> Optional[str]:
+    return _OPERATION.get()
+
+
+@contextmanager
+def operation(name: str):
+    """Names the calls made inside the block."""
+    token = _OPERATION.set(name)
+    try:
+        yield
+    finally:
+        _OPERATION.reset(token)
+
+
+def instrumented(function):
+    """
+    Names the calls made by a function or coroutine after it, without a
+    leading underscore. Calls on worker threads are named by the
+    instrumented function running on that thread.
+    """
+    name = function.__name__.lstrip("_")
+
+    if asyncio.iscoroutinefunction(function):
+        @functools.wraps(function)
+        async def async_wrapper(*args, **kwargs):
+            token = _OPERATION.set(name)
+            try:
+                return await function(*args, **kwargs)
+            finally:
+                _OPERATION.reset(token)
+        return async_wrapper
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        token = _OPERATION.set(name)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _OPERATION.reset(token)
+    return wrapper
+
+
+def host_of(url: str) -> str:
+    return urlsplit(url).netloc
+
+
+def body_size(data, json_body=None) -> int:
+    """
+    Bytes sent for a request body, 0 when it can not be told.
+
+    :param data: The 'data' of the request.
+    :param json_body: The 'json' of the request, used without 'data'. It
+    is encoded the way requests and aiohttp encode it.
+    """
+    if data is None:
+        if json_body is not None:
+            return len(json.dumps(json_body).encode("utf-8"))
+        return 0
+    if isinstance(data, str):
+        return len(data.encode("utf-8"))
+    if isinstance(data, (bytes, bytearray)):
+        return len(data)
+    if isinstance(data, memoryview):
+        return data.nbytes
+    if isinstance(data, dict):
+        return len(urlencode(data))
+    return getattr(data, "bytes_read", 0)
+
+
+@contextmanager
+def connection_phases():
+    """
+    Collects the dns, connect and tls timings of connections opened by
+    this thread inside the block into the yielded dict.
+    """
+    phases = {}
+    _PHASES.current = phases
+    try:
+        yield phases
+    finally:
+        _PHASES.current = None
+
+
+class _TimedConnectionMixin:
+    """Times name resolution and the TCP connect of new connections."""
+
+    def _new_conn(self):
+        phases = getattr(_PHASES, "current", None)
+        if phases is None:
+            return super()._new_conn()
+        start = time.perf_counter()
+        dns_host = self._dns_host
+        try:
+            addresses = socket.getaddrinfo(
+                dns_host, self.port, 0, socket.SOCK_STREAM
+            )
+        except OSError:
+            addresses = []
+        resolved = time.perf_counter()
+        phases["dns"] = resolved - start
+        try:
+            if not addresses:
+                return super()._new_conn()
+            # Connect to the address just resolved instead of looking the
+            # name up again. If it is refused and the name has more
+            # addresses, let urllib3 try them all.
+            self._dns_host = addresses[0][4][0]
+            try:
+                return super()._new_conn()
+            except NewConnectionError:
+                if len(addresses) == 1:
+                    raise
+            finally:
+                self._dns_host = dns_host
+            return super()._new_conn()
+        finally:
+            phases["connect"] = time.perf_counter() - resolved
+
+    def connect(self):
+        phases = getattr(_PHASES, "current", None)
+        start = time.perf_counter()
+        super().connect()
+        if phases is not None and self.is_tls:
+            phases["tls"] = (
+                time.perf_counter() - start
+                - phases.get("dns", 0.0) - phases.get("connect", 0.0)
+            )
+
+
+class TimedHTTPConnection(_TimedConnectionMixin, HTTPConnection):
+    is_tls = False
+
+
+class TimedHTTPSConnection(_TimedConnectionMixin, HTTPSConnection):
+    is_tls = True
+
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+# Pool classes for urllib3 PoolManager.pool_classes_by_scheme.
+TIMED_POOL_CLASSES = {
+    "http": TimedHTTPConnectionPool,
+    "https": TimedHTTPSConnectionPool,
+}
+
+
+class LatencyHistogram:
+    """Cumulative histogram of latencies in seconds."""
+
+    def __init__(self, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Upper bound of the bucket holding the q quantile."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def cumulative(self) -> List[Tuple[str, int]]:
+        """(le, count) pairs as in the Prometheus exposition format."""
+        result = []
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            result.append((repr(float(bound)), seen))
+        result.append(("+Inf", self.count))
+        return result
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"') \
+        .replace("\n", "\\n")
+
+
+def _labels(**labels) -> str:
+    return "{" + ",".join(
+        f'{name}="{_escape(value)}"' for name, value in labels.items()
+    ) + "}"
+
+
+class MetricsCollector:
+    """
+    Hook aggregating CallEvents into request, byte and retry counters and
+    latency histograms by operation and host, plus phase histograms by
+    host. Add it with 'INSTRUMENTATION.add_hook(collector)'.
+
+    :param buckets: Histogram bucket upper bounds in seconds.
+    """
+
+    def __init__(self, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.requests: Dict[Tuple[str, str, str], int] = {}
+        self.bytes_sent: Dict[Tuple[str, str], int] = {}
+        self.bytes_received: Dict[Tuple[str, str], int] = {}
+        self.retries: Dict[Tuple[str, str], int] = {}
+        self.latency: Dict[Tuple[str, str], LatencyHistogram] = {}
+        self.phases: Dict[Tuple[str, str], LatencyHistogram] = {}
+        self._lock = threading.Lock()
+
+    def _histogram(self, histograms: Dict, key: Tuple) -> LatencyHistogram:
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = LatencyHistogram(self.buckets)
+        return histogram
+
+    def __call__(self, event: CallEvent):
+        key = (event.operation or "", event.host)
+        status = str(event.status_code) if event.status_code else "error"
+        with self._lock:
+            request_key = key + (status,)
+            self.requests[request_key] = self.requests.get(request_key, 0) + 1
+            self.bytes_sent[key] = self.bytes_sent.get(key, 0) + \
+                event.bytes_sent
+            self.bytes_received[key] = self.bytes_received.get(key, 0) + \
+                event.bytes_received
+            self.retries[key] = self.retries.get(key, 0) + event.retries
+            self._histogram(self.latency, key).observe(event.duration)
+            for phase in ("dns", "connect", "tls", "ttfb"):
+                value = getattr(event, phase)
+                if value is not None:
+                    self._histogram(
+                        self.phases, (event.host, phase)
+                    ).observe(value)
+
+    def prometheus_text(self, prefix: str = "vat_return") -> str:
+        """The metrics in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            lines += [
+                f"# HELP {prefix}_requests_total HTTP calls by operation, "
+                f"host and status.",
+                f"# TYPE {prefix}_requests_total counter",
+            ]
+            for (op, host, status), value in sorted(self.requests.items()):
+                labels = _labels(operation=op, host=host, status=status)
+                lines.append(f"{prefix}_requests_total{labels} {value}")
+            for name, values, help_text in (
+                    ("bytes_sent_total", self.bytes_sent, "Body bytes sent."),
+                    ("bytes_received_total", self.bytes_received,
+                     "Body bytes received."),
+                    ("retries_total", self.retries, "Throttle retries."),
+            ):
+                lines += [
+                    f"# HELP {prefix}_{name} {help_text}",
+                    f"# TYPE {prefix}_{name} counter",
+                ]
+                for (op, host), value in sorted(values.items()):
+                    labels = _labels(operation=op, host=host)
+                    lines.append(f"{prefix}_{name}{labels} {value}")
+            lines += [
+                f"# HELP {prefix}_request_duration_seconds Duration of "
+                f"HTTP calls.",
+                f"# TYPE {prefix}_request_duration_seconds histogram",
+            ]
+            for (op, host), histogram in sorted(self.latency.items()):
+                lines += _histogram_lines(
+                    f"{prefix}_request_duration_seconds", histogram,
+                    operation=op, host=host,
+                )
+            lines += [
+                f"# HELP {prefix}_phase_duration_seconds Duration of dns, "
+                f"connect, tls and ttfb phases.",
+                f"# TYPE {prefix}_phase_duration_seconds histogram",
+            ]
+            for (host, phase), histogram in sorted(self.phases.items()):
+                lines += _histogram_lines(
+                    f"{prefix}_phase_duration_seconds", histogram,
+                    host=host, phase=phase,
+                )
+        return "\n".join(lines) + "\n"
+
+
+def _histogram_lines(name: str, histogram: LatencyHistogram, **labels):
+    lines = [
+        f"{name}_bucket{_labels(**labels, le=le)} {count}"
+        for le, count in histogram.cumulative()
+    ]
+    lines.append(f"{name}_sum{_labels(**labels)} {histogram.sum}")
+    lines.append(f"{name}_count{_labels(**labels)} {histogram.count}")
+    return lines
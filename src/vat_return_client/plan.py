@@ -0,0 +1,140 @@
+"""
+Runs a small dependency graph of steps on a thread pool.
+A step starts as soon as the steps it comes after are done, so steps that
+do not depend on each other overlap. The first failure stops the plan:
+steps already running finish, nothing new is started. Every step's start
+and duration are recorded, and the critical path (the chain of steps that
+decided the total time) can be read back from them.
+"""
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+
+@dataclass
+class Step:
+    """A unit of work and the names of the steps it has to wait for."""
+    name: str
+    run: Callable[[], Any]
+    after: Tuple[str, ...] = ()
+
+
+@dataclass
+class StepTiming:
+    """When a step ran, in seconds since the plan started."""
+    start: float
+    duration: float
+    status: str = "done"
+
+    @property
+    def end(self) -> float:
+        return self.start + self.duration
+
+
+@dataclass
+class PlanRun:
+    """Results, timings and the first error of a plan."""
+    results: Dict[str, Any] = field(default_factory=dict)
+    timings: Dict[str, StepTiming] = field(default_factory=dict)
+    after: Dict[str, Tuple[str, ...]] = field(default_factory=dict)
+    error: Optional[BaseException] = None
+    failed_step: Optional[str] = None
+    skipped: List[str] = field(default_factory=list)
+    wall_time: float = 0.0
+
+    def critical_path(self) -> List[str]:
+        """
+        The steps, in order, from the last one to finish back through the
+        dependency each of them waited for longest.
+        """
+        if not self.timings:
+            return []
+        name = max(self.timings, key=lambda step: self.timings[step].end)
+        path = [name]
+        while True:
+            ran = [step for step in self.after[name] if step in self.timings]
+            if not ran:
+                return path[::-1]
+            name = max(ran, key=lambda step: self.timings[step].end)
+            path.append(name)
+
+    def raise_error(self):
+        if self.error is not None:
+            raise self.error
+
+
+def run_plan(steps: Sequence[Step], max_workers: int = 4) -> PlanRun:
+    """
+    Runs the steps, each once its 'after' steps are done.
+
+    :param steps: The steps; 'after' may only name steps in the list,
+    and may not form a cycle. Both are checked before any step runs.
+    :param max_workers: Steps running at once.
+    :return: The run. Check 'error', or call 'raise_error'.
+    """
+    by_name = {step.name: step for step in steps}
+    waiting = {step.name: set(step.after) for step in steps}
+    for step in steps:
+        unknown = waiting[step.name] - by_name.keys()
+        if unknown:
+            raise ValueError(f"{step.name} comes after unknown {unknown}")
+    dependents: Dict[str, List[str]] = {name: [] for name in by_name}
+    for step in steps:
+        for before in step.after:
+            dependents[before].append(step.name)
+    # Kahn's algorithm: refuse a cycle before any step has side effects.
+    blocking = {name: len(before) for name, before in waiting.items()}
+    ready = [name for name, count in blocking.items() if not count]
+    for name in ready:
+        for dependent in dependents[name]:
+            blocking[dependent] -= 1
+            if not blocking[dependent]:
+                ready.append(dependent)
+    if len(ready) < len(blocking):
+        cycle = sorted(blocking.keys() - set(ready))
+        raise ValueError(f"Steps in a cycle: {cycle}")
+
+    run = PlanRun(after={step.name: tuple(step.after) for step in steps})
+    started = time.perf_counter()
+
+    def timed(step: Step):
+        start = time.perf_counter()
+        try:
+            return step.run()
+        finally:
+            run.timings[step.name] = StepTiming(
+                start=start - started,
+                duration=time.perf_counter() - start,
+            )
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        running = {}
+
+        def start_ready():
+            for name in [name for name, before in waiting.items()
+                         if not before]:
+                del waiting[name]
+                running[executor.submit(timed, by_name[name])] = name
+
+        start_ready()
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                error = future.exception()
+                if error is not None:
+                    run.timings[name].status = "failed"
+                    if run.error is None:
+                        run.error = error
+                        run.failed_step = name
+                    continue
+                run.results[name] = future.result()
+                for dependent in dependents[name]:
+                    if dependent in waiting:
+                        waiting[dependent].discard(name)
+            if run.error is None:
+                start_ready()
+    run.skipped = sorted(waiting)
+    run.wall_time = time.perf_counter() - started
+    return run
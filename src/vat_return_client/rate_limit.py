@@ -0,0 +1,329 @@
+"""
+Per-host rate limiting with adaptive concurrency.
+Each host gets a token bucket capping the request rate and an AIMD
+(additive increase, multiplicative decrease) concurrency limit: the limit
+grows slowly while responses are fast, and is cut when the host answers
+429/503 or latency climbs well above the best observed. A Retry-After from
+the host pauses every request to it until the given time.
+"""
+import asyncio
+import io
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Dict, Hashable, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+from settings import (
+    ALTINN_BASE,
+    VAT_BASE,
+    VALIDATION_BASE,
+    ALTINN_RATE_LIMIT,
+    VAT_RATE_LIMIT,
+    VALIDATION_RATE_LIMIT,
+    DEFAULT_RATE_LIMIT,
+)
+
+# Status codes meaning the host wants us to slow down.
+THROTTLE_STATUS_CODES = (429, 503)
+
+# Request bodies are put in latency classes of sizes doubling from this.
+LATENCY_CLASS_BYTES = 64 * 1024
+
+
+def host_of(url: str) -> str:
+    """The host (netloc) of an url, or the value itself if it has none."""
+    return urlsplit(url).netloc or url
+
+
+def latency_class(operation: Optional[str], bytes_sent: int) -> Tuple:
+    """
+    The calls whose latencies are compared to detect overload: those of
+    the same operation with a body of about the same size. A large upload
+    is then not measured against a small status call.
+    """
+    return operation or "", (bytes_sent // LATENCY_CLASS_BYTES).bit_length()
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """
+    Seconds to wait from a Retry-After header, given either as seconds or
+    as an HTTP date. None when missing or unreadable.
+    """
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    """
+    Token bucket allowing 'rate' requests per second with bursts of up to
+    'burst' requests.
+    """
+
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(rate, 1.0)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """
+        Takes a token, possibly in advance.
+
+        :return: Seconds to wait before the request may be sent.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._updated) * self.rate
+            )
+            self._updated = now
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+
+class HostLimiter:
+    """
+    Rate and adaptive concurrency limit for one host.
+
+    :param rate: Requests per second, None for no rate limit.
+    :param initial_limit: Concurrent requests allowed at start.
+    :param min_limit: Lowest the concurrency limit is cut to.
+    :param max_limit: Highest the concurrency limit grows to.
+    :param decrease: Factor the limit is cut with on a throttle response.
+    :param latency_factor: Latency above this multiple of the best seen
+    latency of the same latency class (see latency_class) counts as
+    overload.
+    :param latency_margin: Seconds latency must also exceed the best seen
+    by, so jitter on very fast hosts does not count as overload.
+    """
+
+    def __init__(
+            self,
+            rate: Optional[float] = None,
+            initial_limit: float = 4,
+            min_limit: float = 1,
+            max_limit: float = 64,
+            decrease: float = 0.5,
+            latency_factor: float = 3.0,
+            latency_margin: float = 0.05,
+    ):
+        self.bucket = TokenBucket(rate) if rate else None
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.decrease = decrease
+        self.latency_factor = latency_factor
+        self.latency_margin = latency_margin
+        self.in_flight = 0
+        self.best_latency: Dict[Hashable, float] = {}
+        self.paused_until = 0.0
+        self._condition = threading.Condition()
+        # Coroutines waiting for a slot, with their loops. Releases can come
+        # from any thread, so they are woken with call_soon_threadsafe.
+        self._async_waiters: List[Tuple[asyncio.AbstractEventLoop,
+                                        asyncio.Future]] = []
+        self._stats = {
+            "requests": 0,
+            "throttled": 0,
+            "overloaded": 0,
+            "wait_seconds": 0.0,
+        }
+
+    def _try_enter(self) -> float:
+        """Takes a slot if one is free; returns 0, or seconds to retry in."""
+        now = time.monotonic()
+        if now < self.paused_until:
+            return self.paused_until - now
+        if self.in_flight >= int(self.limit):
+            return -1.0
+        self.in_flight += 1
+        self._stats["requests"] += 1
+        return 0.0
+
+    def acquire(self):
+        """Blocks until the request may be sent."""
+        start = time.monotonic()
+        with self._condition:
+            while True:
+                wait = self._try_enter()
+                if wait == 0:
+                    break
+                self._condition.wait(wait if wait > 0 else None)
+        delay = self.bucket.reserve() if self.bucket else 0.0
+        if delay:
+            time.sleep(delay)
+        with self._condition:
+            self._stats["wait_seconds"] += time.monotonic() - start
+
+    async def acquire_async(self):
+        """
+        Waits, without blocking the loop, until the request may be sent.
+        A waiting coroutine sleeps until a release wakes it, or the pause
+        of a Retry-After ends.
+        """
+        loop = asyncio.get_running_loop()
+        start = time.monotonic()
+        while True:
+            with self._condition:
+                wait = self._try_enter()
+                if wait == 0:
+                    break
+                waiter = loop.create_future()
+                self._async_waiters.append((loop, waiter))
+            try:
+                await asyncio.wait_for(waiter, wait if wait > 0 else None)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                with self._condition:
+                    if (loop, waiter) in self._async_waiters:
+                        self._async_waiters.remove((loop, waiter))
+        delay = self.bucket.reserve() if self.bucket else 0.0
+        if delay:
+            await asyncio.sleep(delay)
+        with self._condition:
+            self._stats["wait_seconds"] += time.monotonic() - start
+
+    def release(
+            self,
+            latency: float,
+            status_code: Optional[int],
+            retry_after: Optional[float] = None,
+            kind: Hashable = None,
+    ):
+        """
+        Frees the slot and adjusts the limit from the outcome.
+
+        :param latency: Seconds the request took.
+        :param status_code: Response status, None if the request failed.
+        :param retry_after: Seconds from the Retry-After header, if any.
+        :param kind: Latency class of the request, see latency_class.
+        """
+        with self._condition:
+            self.in_flight -= 1
+            if status_code in THROTTLE_STATUS_CODES:
+                self._stats["throttled"] += 1
+                self.limit = max(self.min_limit, self.limit * self.decrease)
+                if retry_after:
+                    self.paused_until = max(
+                        self.paused_until, time.monotonic() + retry_after
+                    )
+            elif status_code is not None:
+                best = self.best_latency.get(kind)
+                if best is None or latency < best:
+                    best = self.best_latency[kind] = latency
+                if latency > max(
+                        best * self.latency_factor,
+                        best + self.latency_margin,
+                ):
+                    self._stats["overloaded"] += 1
+                    self.limit = max(self.min_limit, self.limit * 0.9)
+                else:
+                    self.limit = min(
+                        self.max_limit, self.limit + 1 / self.limit
+                    )
+            self._condition.notify_all()
+            waiters, self._async_waiters = self._async_waiters, []
+        for loop, waiter in waiters:
+            loop.call_soon_threadsafe(_wake, waiter)
+
+    def stats(self) -> Dict:
+        with self._condition:
+            stats = dict(self._stats)
+            stats["limit"] = self.limit
+            stats["in_flight"] = self.in_flight
+        return stats
+
+
+class RateLimiter:
+    """
+    One HostLimiter per host. Altinn, the VAT app and the validation
+    service get the rates from settings.py; other hosts use the default.
+
+    :param rates: Requests per second by host, overriding the settings.
+    :param host_options: Extra HostLimiter arguments used for every host.
+    """
+
+    def __init__(
+            self,
+            rates: Optional[Dict[str, Optional[float]]] = None,
+            **host_options,
+    ):
+        self.rates = {
+            host_of(ALTINN_BASE): ALTINN_RATE_LIMIT,
+            host_of(VAT_BASE): VAT_RATE_LIMIT,
+            host_of(VALIDATION_BASE): VALIDATION_RATE_LIMIT,
+        }
+        self.rates.update({
+            host_of(host): rate for host, rate in (rates or {}).items()
+        })
+        self.host_options = host_options
+        self._hosts: Dict[str, HostLimiter] = {}
+        self._lock = threading.Lock()
+
+    def for_url(self, url: str) -> HostLimiter:
+        """The limiter of the host of the url."""
+        host = host_of(url)
+        limiter = self._hosts.get(host)
+        if limiter is None:
+            with self._lock:
+                limiter = self._hosts.get(host)
+                if limiter is None:
+                    limiter = HostLimiter(
+                        rate=self.rates.get(host, DEFAULT_RATE_LIMIT),
+                        **self.host_options,
+                    )
+                    self._hosts[host] = limiter
+        return limiter
+
+    def stats(self) -> Dict[str, Dict]:
+        """Limit, in-flight, throttle and wait counters by host."""
+        with self._lock:
+            hosts = dict(self._hosts)
+        return {host: limiter.stats() for host, limiter in hosts.items()}
+
+
+def _wake(waiter: asyncio.Future):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+def throttle_outcome(
+        status_code: int, headers
+) -> Tuple[bool, Optional[float]]:
+    """Whether a response is a throttle response, and its Retry-After."""
+    if status_code not in THROTTLE_STATUS_CODES:
+        return False, None
+    return True, parse_retry_after(headers.get("Retry-After"))
+
+
+def rewind_body(data) -> bool:
+    """
+    Prepares a request body to be sent again. Returns False for bodies that
+    can not be re-read, such as plain iterators, pipes and async
+    generators.
+    """
+    if data is None or isinstance(
+            data, (bytes, bytearray, memoryview, str, dict, list, tuple)
+    ):
+        return True
+    rewindable = getattr(data, "rewindable", None)
+    if rewindable is None or not rewindable():
+        return False
+    try:
+        data.rewind()
+    except (io.UnsupportedOperation, OSError):
+        return False
+    return True
@@ -30,6 +30,89 @@ REDIRECT_URI = os.environ.get("REDIRECT_URI", "http://localhost:12345/token")
 SERVER_PORT = int(os.environ.get("SERVER_PORT", 12345))
 CLIENT_AUTHENTICATION_METHOD = os.environ.get("CLIENT_AUTHENTICATION_METHOD", None)
 SERVER_TIMEOUT = os.environ.get("SERVER_TIMEOUT", 1000)
+# Seconds the ID-porten JWKS is cached, and an optional file to keep it in.
+JWKS_CACHE_TTL = int(os.environ.get("JWKS_CACHE_TTL", 3600))
+JWKS_CACHE_FILE = os.environ.get("JWKS_CACHE_FILE", None)
+# Users are told apart in the token store by this name.
+ID_PORTEN_USER = os.environ.get("ID_PORTEN_USER", "default")
+# Seconds before expiry an access token is renewed with the refresh token.
+ID_PORTEN_REFRESH_MARGIN = int(os.environ.get("ID_PORTEN_REFRESH_MARGIN", 60))
+
+# Settings for client_assertion.py
+# Used when CLIENT_AUTHENTICATION_METHOD is private_key_jwt: the RSA key
+# made with scripts/parse_jwk.py and the kid it was registered with.
+CLIENT_PRIVATE_KEY_FILE = os.environ.get("CLIENT_PRIVATE_KEY_FILE", None)
+CLIENT_KEY_ID = os.environ.get("CLIENT_KEY_ID", None)
+# Seconds a signed assertion is valid, and reused until this many remain.
+CLIENT_ASSERTION_LIFETIME = int(os.environ.get("CLIENT_ASSERTION_LIFETIME", 120))
+CLIENT_ASSERTION_MARGIN = int(os.environ.get("CLIENT_ASSERTION_MARGIN", 20))
+CLIENT_ASSERTION_REUSE = os.environ.get("CLIENT_ASSERTION_REUSE", "true").lower() == "true"
+
+# Settings for token_store.py
+# Folder of the encrypted token store, e.g. ~/.vat_return/tokens. Tokens
+# are only stored when it is set. Set TOKEN_STORE_KEY too: a key generated
+# into the folder protects the tokens no better than the folder itself.
+TOKEN_STORE_DIR = os.environ.get("TOKEN_STORE_DIR", None) or None
+TOKEN_STORE_KEY = os.environ.get("TOKEN_STORE_KEY", None)
+
+# Settings for transport.py
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", 10))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", 5))
+HTTP_READ_TIMEOUT = float(os.environ.get("HTTP_READ_TIMEOUT", 60))
+HTTP_KEEP_ALIVE = os.environ.get("HTTP_KEEP_ALIVE", "true").lower() == "true"
+
+# Settings for hedging.py
+# A read-only call is sent again when it has not answered within this
+# quantile of the recent latency of the same operation, or HEDGE_MIN_DELAY.
+HEDGE_QUANTILE = float(os.environ.get("HEDGE_QUANTILE", 0.95))
+HEDGE_MIN_DELAY = float(os.environ.get("HEDGE_MIN_DELAY", 0.05))
+# Hedges allowed per call, across all operations.
+HEDGE_BUDGET = float(os.environ.get("HEDGE_BUDGET", 0.05))
+HEDGE_MIN_SAMPLES = int(os.environ.get("HEDGE_MIN_SAMPLES", 20))
+HEDGE_WINDOW = int(os.environ.get("HEDGE_WINDOW", 256))
+HEDGE_MAX_WORKERS = int(os.environ.get("HEDGE_MAX_WORKERS", 32))
+
+# Settings for rate_limit.py
+# Requests per second allowed towards each host.
+ALTINN_RATE_LIMIT = float(os.environ.get("ALTINN_RATE_LIMIT", 50))
+VAT_RATE_LIMIT = float(os.environ.get("VAT_RATE_LIMIT", 50))
+VALIDATION_RATE_LIMIT = float(os.environ.get("VALIDATION_RATE_LIMIT", 20))
+DEFAULT_RATE_LIMIT = float(os.environ.get("DEFAULT_RATE_LIMIT", 20))
+
+# Settings for token_cache.py
+# Seconds before expiry an Altinn token is exchanged again.
+ALTINN_TOKEN_REFRESH_MARGIN = int(os.environ.get("ALTINN_TOKEN_REFRESH_MARGIN", 60))
+
+# Settings for xsd_validation.py
+# Path or url of the published XSDs, and a folder to keep downloaded ones in.
+XSD_BASE_URL = "https://raw.githubusercontent.com/Skatteetaten/mva-meldingen/master/docs/informasjonsmodell_filer/xsd"
+VAT_MESSAGE_XSD = os.environ.get(
+    "VAT_MESSAGE_XSD",
+    f"{XSD_BASE_URL}/no.skatteetaten.fastsetting.avgift.mva.skattemeldingformerverdiavgift.v1.0.xsd",
+)
+VAT_ENVELOPE_XSD = os.environ.get(
+    "VAT_ENVELOPE_XSD",
+    f"{XSD_BASE_URL}/no.skatteetaten.fastsetting.avgift.mva.mvameldinginnsending.v1.0.xsd",
+)
+XSD_CACHE_DIR = os.environ.get("XSD_CACHE_DIR", None)
+
+# Settings for validation_cache.py
+VALIDATION_CACHE_MAX_ENTRIES = int(os.environ.get("VALIDATION_CACHE_MAX_ENTRIES", 10000))
+VALIDATION_CACHE_MAX_BYTES = int(os.environ.get("VALIDATION_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+VALIDATION_CACHE_MAX_AGE = int(os.environ.get("VALIDATION_CACHE_MAX_AGE", 24 * 3600))
+VALIDATION_CACHE_FILE = os.environ.get("VALIDATION_CACHE_FILE", None)
+
+# Settings for instance_index.py
+INSTANCE_INDEX_FILE = os.environ.get("INSTANCE_INDEX_FILE", "instance_index.db")
+VAT_APP_ID = f"skd/mva-melding-innsending-{SUBMISSION_PATH_ENV}"
+
+# Settings for work_queue.py
+FILING_QUEUE_FILE = os.environ.get("FILING_QUEUE_FILE", "filing_queue.db")
+# Seconds a worker holds a job without renewing, before others may take it.
+FILING_LEASE_SECONDS = float(os.environ.get("FILING_LEASE_SECONDS", 120))
+
+# Settings for journal.py
+SUBMISSION_JOURNAL_FILE = os.environ.get("SUBMISSION_JOURNAL_FILE", "submission_journal.db")
 
 # These are constants and should not be changed.
 ALGORITHMS = ["RS256"]
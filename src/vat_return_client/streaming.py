@@ -0,0 +1,176 @@
+"""
+Streaming request bodies for uploads.
+Wraps bytes, files, memory-mapped files and chunk iterators in one
+file-like object that is read in fixed-size chunks while it is sent, and
+computes the SHA-256 and byte count of the content in the same pass. Peak
+memory per upload stays at one chunk, whatever the size of the file.
+"""
+import hashlib
+import io
+import mmap
+import os
+from contextlib import contextmanager
+from pathlib import Path
+from typing import IO, Iterable, Iterator, Optional, Union
+
+CHUNK_SIZE = 64 * 1024
+
+# str is sent as UTF-8 text (as upload_vat_submission always did), file
+# paths have to be given as pathlib.Path.
+UploadSource = Union[
+    bytes, bytearray, memoryview, str, Path, IO[bytes], mmap.mmap,
+    Iterable[bytes], "UploadBody",
+]
+
+
+class UploadBody(io.RawIOBase):
+    """
+    A request body read in chunks. Pass it as 'data' to the transport; the
+    length is announced with Content-Length when known, otherwise the body
+    is sent with chunked transfer encoding.
+
+    After the upload, 'sha256' and 'bytes_read' describe what was sent.
+
+    :param source: The content, see UploadSource.
+    :param chunk_size: Bytes read per chunk.
+    """
+
+    def __init__(self, source: UploadSource, chunk_size: int = CHUNK_SIZE):
+        super().__init__()
+        self.chunk_size = chunk_size
+        self.length: Optional[int] = None
+        self._owned_file = None
+        self._iterator: Optional[Iterator[bytes]] = None
+        self._stream: Optional[IO[bytes]] = None
+        self._view: Optional[memoryview] = None
+        self._start = 0
+        self._pending = b""
+        self._rewindable = False
+        self._hash = hashlib.sha256()
+        self.bytes_read = 0
+        self._open(source)
+
+    def _open(self, source: UploadSource):
+        if isinstance(source, str):
+            source = source.encode("utf-8")
+        if isinstance(source, (bytes, bytearray, memoryview, mmap.mmap)):
+            # Sliced chunk by chunk, so large buffers and mmaps are not copied.
+            self._view = memoryview(source).cast("B")
+            self.length = self._view.nbytes
+            self._rewindable = True
+        elif isinstance(source, Path):
+            self._owned_file = open(source, "rb")
+            self._stream = self._owned_file
+            # A named pipe opens like a file but cannot be read twice.
+            self._rewindable = self._stream.seekable()
+            if self._rewindable:
+                self.length = os.fstat(self._stream.fileno()).st_size
+        elif hasattr(source, "read"):
+            self._stream = source
+            seekable = getattr(source, "seekable", None)
+            if seekable is not None and seekable():
+                self._start = source.tell()
+                end = source.seek(0, io.SEEK_END)
+                source.seek(self._start)
+                self.length = end - self._start
+                self._rewindable = True
+        else:
+            self._iterator = iter(source)
+
+    def readable(self) -> bool:
+        return True
+
+    def rewindable(self) -> bool:
+        """
+        Whether the body can be read again, e.g. to retry an upload: true
+        for bytes and seekable files, false for pipes, sockets and chunk
+        iterators.
+        """
+        return self._rewindable
+
+    def rewind(self):
+        """Starts over from the beginning and resets hash and count."""
+        if not self.rewindable():
+            raise io.UnsupportedOperation(
+                "Cannot rewind a chunk iterator or unseekable stream."
+            )
+        if self._stream is not None:
+            self._stream.seek(self._start)
+        self._hash = hashlib.sha256()
+        self.bytes_read = 0
+
+    def _read_source(self, size: int) -> bytes:
+        if self._view is not None:
+            position = self._start + self.bytes_read
+            return self._view[position:position + size].tobytes()
+        if self._stream is not None:
+            return self._stream.read(size)
+        while not self._pending:
+            chunk = next(self._iterator, None)
+            if chunk is None:
+                return b""
+            self._pending = bytes(chunk)
+        data, self._pending = self._pending[:size], self._pending[size:]
+        return data
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0:
+            size = self.chunk_size
+        data = self._read_source(size)
+        self._hash.update(data)
+        self.bytes_read += len(data)
+        return data
+
+    def readinto(self, buffer) -> int:
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def __iter__(self) -> Iterator[bytes]:
+        while True:
+            chunk = self.read(self.chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+    def __len__(self) -> int:
+        # Unknown lengths report 0, which makes requests use chunked transfer.
+        return self.length or 0
+
+    def __bool__(self) -> bool:
+        # Without this an unknown length would make the body look empty.
+        return True
+
+    def tell(self) -> int:
+        return self.bytes_read
+
+    @property
+    def sha256(self) -> str:
+        """Hex SHA-256 of the bytes read so far."""
+        return self._hash.hexdigest()
+
+    def close(self):
+        if self._owned_file is not None:
+            self._owned_file.close()
+        super().close()
+
+
+def open_upload(source: UploadSource, chunk_size: int = CHUNK_SIZE) -> UploadBody:
+    """Wraps a source in an UploadBody, or returns it if it already is one."""
+    if isinstance(source, UploadBody):
+        return source
+    return UploadBody(source, chunk_size=chunk_size)
+
+
+@contextmanager
+def upload_body(source: UploadSource, chunk_size: int = CHUNK_SIZE):
+    """
+    Context manager version of open_upload. Closes the body on exit unless
+    the caller passed in an UploadBody of their own.
+    """
+    body = open_upload(source, chunk_size=chunk_size)
+    try:
+        yield body
+    finally:
+        if body is not source:
+            body.close()
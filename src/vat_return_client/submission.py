@@ -0,0 +1,344 @@
+"""
+The VAT submission flow for one organisation, as used by
+'example_mva_innsending.py', packaged so it can be run for many filings.
+"""
+import hashlib
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Union
+
+from attachments import AttachmentUpload
+from client import VatReturn
+from documents import Envelope, VatMessage, XmlDocument
+from journal import SubmissionJournal, file_sha256, filing_key
+from plan import Step, StepTiming, run_plan
+from streaming import upload_body
+
+# The stages of a submission, in order. Used as keys for stage limits and
+# stage timings.
+STAGES = ("validate", "create", "upload", "ship", "feedback")
+
+# Steps of one filing run at once, so stage_timings are added up under a lock.
+_TIMINGS_LOCK = threading.Lock()
+
+
+@dataclass
+class Attachment:
+    """An attachment to upload to the 'binaerVedlegg' datatype."""
+    content_type: str
+    file_name: str
+    path: Path
+
+
+@dataclass
+class Filing:
+    """
+    The files to submit for one organisation. Message and envelope are
+    files, their content as bytes, or documents models rendered when the
+    filing is submitted.
+    """
+    org_number: str
+    message: Union[Path, bytes, VatMessage]
+    envelope: Union[Path, bytes, Envelope]
+    attachments: List[Attachment] = field(default_factory=list)
+
+
+@dataclass
+class FilingResult:
+    """The outcome of submitting one filing."""
+    org_number: str
+    status: str = "pending"
+    instance_url: Optional[str] = None
+    validation: Optional[str] = None
+    feedback: Optional[Dict] = None
+    error: Optional[str] = None
+    stage_timings: Dict[str, float] = field(default_factory=dict)
+    step_timings: Dict[str, StepTiming] = field(default_factory=dict)
+    critical_path: List[str] = field(default_factory=list)
+    resumed_steps: List[str] = field(default_factory=list)
+    started_at: float = 0.0
+    duration: float = 0.0
+
+    @property
+    def ok(self) -> bool:
+        return self.status in ("submitted", "validated")
+
+
+@contextmanager
+def _stage(result: FilingResult, name: str, stage_limits: Optional[Dict]):
+    """Runs a stage under its concurrency limit and records its duration."""
+    limit = (stage_limits or {}).get(name)
+    if limit is not None:
+        limit.acquire()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        with _TIMINGS_LOCK:
+            result.stage_timings[name] = (
+                result.stage_timings.get(name, 0.0) + elapsed
+            )
+        if limit is not None:
+            limit.release()
+
+
+def _recorded(
+        steps: Dict[str, Dict], step: str, sha256: Optional[str] = None
+) -> Optional[Dict]:
+    """The journal entry of a step, if it is done with the same content."""
+    entry = steps.get(step)
+    if entry is None or (sha256 is not None and entry["sha256"] != sha256):
+        return None
+    return entry
+
+
+def content(
+        document: Union[Path, bytes, XmlDocument]
+) -> Union[Path, bytes]:
+    """A file path or bytes as they are, a documents model rendered."""
+    if isinstance(document, XmlDocument):
+        return document.to_bytes()
+    if isinstance(document, (bytes, bytearray)):
+        return bytes(document)
+    return Path(document)
+
+
+def _sha256(content: Union[Path, bytes]) -> str:
+    if isinstance(content, Path):
+        return file_sha256(content)
+    return hashlib.sha256(content).hexdigest()
+
+
+def _uploaded(data_element: Dict, what: str) -> Dict:
+    """Raises if an upload response is not a data element."""
+    if not isinstance(data_element, dict) or "id" not in data_element:
+        raise RuntimeError(f"{what} upload failed: {data_element}")
+    return data_element
+
+
+def _previous_uploads(
+        filing: Filing, steps: Dict[str, Dict]
+) -> Optional[List[AttachmentUpload]]:
+    """
+    Journaled attachment uploads as 'previous' results for
+    upload_attachments_batch. Files that changed since are uploaded again.
+    """
+    previous = []
+    for attachment in filing.attachments:
+        step = f"attachment:{attachment.file_name}"
+        entry = steps.get(step)
+        if entry is not None and \
+                entry["sha256"] == file_sha256(attachment.path):
+            previous.append(AttachmentUpload(
+                file_name=attachment.file_name,
+                content_type=attachment.content_type,
+                status="uploaded",
+                data_element=entry["data"],
+                sha256=entry["sha256"],
+            ))
+        else:
+            previous.append(AttachmentUpload(
+                file_name=attachment.file_name,
+                content_type=attachment.content_type,
+            ))
+    if not any(upload.ok for upload in previous):
+        return None
+    return previous
+
+
+def submit_filing(
+        vat_client: VatReturn,
+        filing: Filing,
+        stage_limits: Optional[Dict[str, Any]] = None,
+        validate_only: bool = False,
+        wait_for_feedback: bool = True,
+        journal: Optional[SubmissionJournal] = None,
+        max_parallel_steps: int = 4,
+) -> FilingResult:
+    """
+    Runs the submission flow for one filing: validate, create instance,
+    upload envelope, message and attachments, ship twice and retrieve
+    feedback. Errors are caught and recorded on the result.
+
+    With a journal every completed step is recorded, and a filing that was
+    interrupted continues on its existing instance, skipping the uploads
+    and ships already done.
+
+    Steps that do not depend on each other overlap: validation runs
+    alongside instance creation and the uploads alongside each other. The
+    time of each step is in 'step_timings' and the chain of steps that
+    took longest in 'critical_path'.
+
+    :param vat_client: Client with the altinn token set.
+    :param filing: The filing to submit.
+    :param stage_limits: Optional semaphore per stage name in STAGES,
+    shared between filings to cap how many run a stage at once.
+    :param validate_only: Stop after validation.
+    :param wait_for_feedback: Poll for feedback after shipping.
+    :param journal: Optional journal to record and resume steps with.
+    :param max_parallel_steps: Steps of the filing running at once, 1 runs
+    them one after the other.
+    :return: The result record.
+    """
+    result = FilingResult(org_number=filing.org_number)
+    result.started_at = time.time()
+    start = time.perf_counter()
+    try:
+        message = content(filing.message)
+        if isinstance(message, Path):
+            message = message.read_bytes()
+        key = filing_key(filing.org_number, message)
+        steps = journal.steps(key) if journal is not None else {}
+        result.resumed_steps = sorted(steps)
+
+        def record(step: str, data: Optional[Dict] = None,
+                   sha256: Optional[str] = None):
+            if journal is not None:
+                journal.record(key, step, data, sha256)
+
+        if "ship_2" in steps:
+            result.instance_url = steps["create"]["data"]["instance_url"]
+            result.status = "submitted"
+        else:
+            _submit(vat_client, filing, message, steps, record, result,
+                    stage_limits, validate_only, max_parallel_steps)
+            if validate_only:
+                return result
+        if wait_for_feedback:
+            with _stage(result, "feedback", stage_limits):
+                result.feedback = vat_client.retrieve_feedback(
+                    instance_url=result.instance_url
+                )
+    except Exception as error:
+        # A filing that was shipped stays submitted even if feedback failed.
+        if result.status != "submitted":
+            result.status = "failed"
+        result.error = f"{type(error).__name__}: {error}"
+    finally:
+        result.duration = time.perf_counter() - start
+    return result
+
+
+def _submit(
+        vat_client: VatReturn,
+        filing: Filing,
+        message: bytes,
+        steps: Dict[str, Dict],
+        record: Callable,
+        result: FilingResult,
+        stage_limits: Optional[Dict[str, Any]],
+        validate_only: bool,
+        max_parallel_steps: int,
+):
+    """
+    The steps of submit_filing up to and including the ships, run as a
+    plan: validation alongside instance creation, the envelope, message and
+    attachment uploads alongside each other once the instance exists, and
+    the two ships after all of them.
+    """
+    # Urls of the instance, set by 'create' before the uploads start.
+    links: Dict[str, str] = {}
+
+    def validate():
+        with _stage(result, "validate", stage_limits):
+            result.validation = vat_client.validate_tax_return(body=message)
+
+    def create():
+        created = _recorded(steps, "create")
+        if created is None:
+            with _stage(result, "create", stage_limits):
+                instance = vat_client.create_instance(
+                    organization_number=filing.org_number
+                )
+            created = {"data": {
+                "instance_url": instance["selfLinks"]["apps"],
+                "instance_data_url": instance["data"][0]["selfLinks"]["apps"],
+            }}
+            record("create", created["data"])
+        links.update(created["data"])
+        result.instance_url = links["instance_url"]
+
+    def upload_envelope():
+        instance_data_url = links["instance_data_url"]
+        with _stage(result, "upload", stage_limits):
+            envelope = content(filing.envelope)
+            envelope_hash = _sha256(envelope) if "envelope" in steps else None
+            if _recorded(steps, "envelope", envelope_hash) is not None:
+                return
+            with upload_body(envelope) as body:
+                _uploaded(vat_client.upload_vat_submission(
+                    instance_data_app_url=instance_data_url, content=body
+                ), "Envelope")
+                record("envelope", {"data_url": instance_data_url},
+                       body.sha256)
+
+    def upload_message():
+        instance_url = links["instance_url"]
+        # The message is part of the filing key, so a recorded upload is
+        # always of the same content.
+        if _recorded(steps, "message") is not None:
+            return
+        with _stage(result, "upload", stage_limits):
+            with upload_body(message) as body:
+                element = _uploaded(vat_client.upload_vat_return(
+                    instance_url=instance_url, content=body
+                ), "VAT message")
+                record("message", {"data_element": element["id"]},
+                       body.sha256)
+
+    def upload_attachments():
+        if not filing.attachments:
+            return
+        with _stage(result, "upload", stage_limits):
+            uploads = vat_client.upload_attachments_batch(
+                instance_url=links["instance_url"],
+                attachments=[
+                    (attachment.content_type, attachment.file_name,
+                     Path(attachment.path))
+                    for attachment in filing.attachments
+                ],
+                previous=_previous_uploads(filing, steps) if steps else None,
+            )
+        for upload in uploads:
+            if upload.status == "uploaded":
+                record(f"attachment:{upload.file_name}",
+                       upload.data_element, upload.sha256)
+        failed = [upload for upload in uploads if not upload.ok]
+        if failed:
+            raise RuntimeError(
+                f"Attachment upload failed: {failed[0].file_name}: "
+                f"{failed[0].error}"
+            )
+
+    def ship(step: str):
+        if step in steps:
+            return
+        with _stage(result, "ship", stage_limits):
+            process = vat_client.ship_to_next_process(
+                instance_url=links["instance_url"]
+            )
+        if isinstance(process, str):
+            raise RuntimeError(f"process/next failed: {process}")
+        record(step, {"task": (process.get("currentTask") or {})
+                      .get("elementId")})
+
+    plan = [Step("validate", validate)]
+    if not validate_only:
+        uploads = ("envelope", "message", "attachments")
+        plan += [
+            Step("create", create),
+            Step("envelope", upload_envelope, ("create",)),
+            Step("message", upload_message, ("create",)),
+            Step("attachments", upload_attachments, ("create",)),
+            Step("ship_1", lambda: ship("ship_1"), ("validate",) + uploads),
+            Step("ship_2", lambda: ship("ship_2"), ("ship_1",)),
+        ]
+    run = run_plan(plan, max_workers=max_parallel_steps)
+    result.step_timings = run.timings
+    result.critical_path = run.critical_path()
+    run.raise_error()
+    result.status = "validated" if validate_only else "submitted"
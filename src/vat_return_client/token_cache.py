@@ -0,0 +1,240 @@
+"""
+Cache for Altinn tokens.
+The Altinn token returned by the ID-porten exchange is a JWT with an 'exp'
+claim. The manager keeps one token per ID-porten identity and exchanges a
+new one shortly before it expires. When many threads need a new token at
+the same time, only one of them calls the exchange endpoint and the others
+wait for its result.
+"""
+import asyncio
+import json
+import threading
+import time
+from base64 import urlsafe_b64decode
+from hashlib import sha256
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from settings import ALTINN_TOKEN_REFRESH_MARGIN
+
+
+def decode_jwt_exp(token: str) -> Optional[int]:
+    """
+    Reads the 'exp' claim of a JWT without verifying it.
+
+    :param token: Encoded JWT.
+    :return: Expiry as unix time, or None when the token has none.
+    """
+    try:
+        payload = token.split(".")[1]
+        claims = json.loads(urlsafe_b64decode(payload + "==").decode())
+    except (IndexError, ValueError):
+        return None
+    exp = claims.get("exp")
+    return int(exp) if exp is not None else None
+
+
+class _Flight:
+    """An exchange in progress that other callers can wait on."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.token: Optional[str] = None
+        self.error: Optional[BaseException] = None
+        # Coroutines waiting for the exchange, with their loops. The
+        # exchange can end on any thread, so they are woken with
+        # call_soon_threadsafe.
+        self.async_waiters: List[
+            Tuple[asyncio.AbstractEventLoop, asyncio.Future]
+        ] = []
+
+
+class AltinnTokenManager:
+    """
+    Caches Altinn tokens per ID-porten identity and refreshes them ahead of
+    expiry. Safe to share between threads and clients.
+
+    :param refresh_margin: Seconds before 'exp' a token is refreshed.
+    :param default_lifetime: Lifetime used for tokens without 'exp'.
+    :param clock: Returns the current unix time, replaceable in tests.
+    """
+
+    def __init__(
+            self,
+            refresh_margin: float = ALTINN_TOKEN_REFRESH_MARGIN,
+            default_lifetime: float = 1800,
+            clock: Callable[[], float] = time.time,
+    ):
+        self.refresh_margin = refresh_margin
+        self.default_lifetime = default_lifetime
+        self.clock = clock
+        self._tokens: Dict[str, tuple] = {}
+        self._in_flight: Dict[str, _Flight] = {}
+        self._lock = threading.Lock()
+        self._stats = {
+            "hits": 0,
+            "misses": 0,
+            "waits": 0,
+            "refreshes": 0,
+            "refresh_failures": 0,
+            "refresh_seconds_total": 0.0,
+            "refresh_seconds_max": 0.0,
+        }
+
+    @staticmethod
+    def identity_key(id_porten_auth_headers: Dict) -> str:
+        """Hash of the ID-porten authorization header, used as cache key."""
+        authorization = id_porten_auth_headers.get("Authorization", "")
+        return sha256(authorization.encode("utf-8")).hexdigest()
+
+    def get_token(
+            self,
+            id_porten_auth_headers: Dict,
+            exchange: Callable[[], str],
+    ) -> str:
+        """
+        Returns a valid Altinn token for the identity, calling 'exchange'
+        only when there is no cached token or it is about to expire.
+
+        :param id_porten_auth_headers: Headers with the ID-porten token.
+        :param exchange: Performs the token exchange and returns the token.
+        :return: Altinn token.
+        """
+        key = self.identity_key(id_porten_auth_headers)
+        token, flight, leader = self._begin(key)
+        if token is not None:
+            return token
+        if not leader:
+            flight.done.wait()
+            return self._outcome(flight)
+
+        start = time.perf_counter()
+        try:
+            token = exchange()
+        except BaseException as error:
+            self._finish(key, flight, None, error, start)
+            raise
+        self._finish(key, flight, token, None, start)
+        return token
+
+    async def get_token_async(
+            self,
+            id_porten_auth_headers: Dict,
+            exchange: Callable[[], Awaitable[str]],
+    ) -> str:
+        """
+        Like 'get_token', for coroutines: 'exchange' is awaited, and callers
+        waiting for an exchange in progress do not block their loop. Shares
+        the cache and the exchanges in progress with 'get_token'.
+
+        :param id_porten_auth_headers: Headers with the ID-porten token.
+        :param exchange: Coroutine function doing the token exchange.
+        :return: Altinn token.
+        """
+        key = self.identity_key(id_porten_auth_headers)
+        loop = asyncio.get_running_loop()
+        waiter = loop.create_future()
+        token, flight, leader = self._begin(key, (loop, waiter))
+        if token is not None:
+            return token
+        if not leader:
+            await waiter
+            return self._outcome(flight)
+
+        start = time.perf_counter()
+        try:
+            token = await exchange()
+        except BaseException as error:
+            self._finish(key, flight, None, error, start)
+            raise
+        self._finish(key, flight, token, None, start)
+        return token
+
+    def _begin(self, key: str, async_waiter=None):
+        """
+        The cached token, or the exchange in progress to wait for, or a new
+        one this caller leads.
+
+        :return: (token, None, False), (None, flight, False) to wait, or
+        (None, flight, True) to do the exchange.
+        """
+        with self._lock:
+            cached = self._tokens.get(key)
+            if cached is not None and self.clock() < cached[1]:
+                self._stats["hits"] += 1
+                return cached[0], None, False
+            flight = self._in_flight.get(key)
+            if flight is None:
+                flight = _Flight()
+                self._in_flight[key] = flight
+                self._stats["misses"] += 1
+                return None, flight, True
+            self._stats["waits"] += 1
+            if async_waiter is not None:
+                flight.async_waiters.append(async_waiter)
+            return None, flight, False
+
+    @staticmethod
+    def _outcome(flight: _Flight) -> str:
+        if flight.error is not None:
+            raise flight.error
+        return flight.token
+
+    def _finish(
+            self,
+            key: str,
+            flight: _Flight,
+            token: Optional[str],
+            error: Optional[BaseException],
+            start: float,
+    ):
+        """Caches the token of an exchange and wakes everyone waiting."""
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            if error is not None:
+                self._stats["refresh_failures"] += 1
+            else:
+                exp = decode_jwt_exp(token)
+                if exp is None:
+                    exp = self.clock() + self.default_lifetime
+                self._tokens[key] = (token, exp - self.refresh_margin)
+                self._stats["refreshes"] += 1
+                self._stats["refresh_seconds_total"] += elapsed
+                self._stats["refresh_seconds_max"] = max(
+                    self._stats["refresh_seconds_max"], elapsed
+                )
+            del self._in_flight[key]
+            flight.token = token
+            flight.error = error
+            flight.done.set()
+            waiters, flight.async_waiters = flight.async_waiters, []
+        for loop, waiter in waiters:
+            loop.call_soon_threadsafe(_wake, waiter)
+
+    def cached_token(self, id_porten_auth_headers: Dict) -> Optional[str]:
+        """
+        The cached token of the identity, without exchanging one. It may be
+        in its refresh margin, but it has not expired.
+        """
+        key = self.identity_key(id_porten_auth_headers)
+        with self._lock:
+            cached = self._tokens.get(key)
+        if cached is None or \
+                self.clock() >= cached[1] + self.refresh_margin:
+            return None
+        return cached[0]
+
+    def invalidate(self, id_porten_auth_headers: Dict):
+        """Drops the cached token, e.g. after a 401 from Altinn."""
+        key = self.identity_key(id_porten_auth_headers)
+        with self._lock:
+            self._tokens.pop(key, None)
+
+    def stats(self) -> Dict:
+        """Hit, miss and refresh counters, and refresh latency in seconds."""
+        with self._lock:
+            return dict(self._stats)
+
+
+def _wake(waiter: asyncio.Future):
+    if not waiter.done():
+        waiter.set_result(None)
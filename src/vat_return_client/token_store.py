@@ -0,0 +1,155 @@
+"""
+Encrypted local store for ID-porten tokens.
+The tokens of a log-in (access token, refresh token and their expiry) are
+kept per client id and user, encrypted with Fernet, one file per entry.
+A later run loads them and renews the access token with the refresh token
+grant instead of sending a person through the browser log-in again.
+
+The key is taken from TOKEN_STORE_KEY (a Fernet key, see
+'Fernet.generate_key') or else generated once into '.key' in the store
+folder. The folder and files are readable by the owner only, but a key
+kept next to the tokens does not protect them from anyone who can read
+the folder; keep TOKEN_STORE_KEY elsewhere (a secret manager, the
+environment of the service) for the encryption to mean anything.
+"""
+import base64
+import json
+import os
+import threading
+import time
+from dataclasses import asdict, dataclass
+from hashlib import sha256
+from pathlib import Path
+from typing import Dict, Optional, Union
+
+from settings import TOKEN_STORE_DIR, TOKEN_STORE_KEY
+
+
+@dataclass
+class TokenSet:
+    """The tokens of one ID-porten log-in, with expiry as unix time."""
+    access_token: str
+    expires_at: float
+    refresh_token: Optional[str] = None
+    refresh_expires_at: Optional[float] = None
+    subject: Optional[str] = None
+
+    def headers(self) -> Dict:
+        """Authorization headers for the access token."""
+        return {"Authorization": f"Bearer {self.access_token}"}
+
+    def expires_within(self, seconds: float) -> bool:
+        return time.time() + seconds >= self.expires_at
+
+    def can_refresh(self) -> bool:
+        return self.refresh_token is not None and (
+            self.refresh_expires_at is None
+            or time.time() < self.refresh_expires_at
+        )
+
+
+class TokenStore:
+    """
+    TokenSets by client id and user, encrypted on disk. Safe to share
+    between threads; processes replace files atomically.
+
+    :param path: Folder to keep the tokens in, created readable by the
+    owner only.
+    :param key: Fernet key, else TOKEN_STORE_KEY or the key file.
+    """
+
+    def __init__(
+            self,
+            path: Union[str, Path] = TOKEN_STORE_DIR,
+            key: Optional[Union[str, bytes]] = TOKEN_STORE_KEY,
+    ):
+        if path is None:
+            raise ValueError("The token store needs a folder, see TOKEN_STORE_DIR.")
+        self.path = Path(path)
+        self.path.mkdir(mode=0o700, parents=True, exist_ok=True)
+        os.chmod(self.path, 0o700)
+        self._key = key
+        self._fernet = None
+        self._lock = threading.Lock()
+
+    def _cipher(self):
+        # cryptography is slow to import, so only loaded when tokens are
+        # read or written.
+        from cryptography.fernet import Fernet
+
+        if self._fernet is None:
+            key = self._key or self._key_file()
+            self._fernet = Fernet(key)
+        return self._fernet
+
+    def _key_file(self) -> bytes:
+        from cryptography.fernet import Fernet
+
+        key_path = self.path / ".key"
+        try:
+            return key_path.read_bytes().strip()
+        except FileNotFoundError:
+            pass
+        # The key is written in full to a temporary file before it gets its
+        # name, so other processes never read a partial key. A link, unlike
+        # a rename, fails if another process put its key there first.
+        key = Fernet.generate_key()
+        temporary = key_path.with_name(
+            f".key.{os.getpid()}.{threading.get_ident()}"
+        )
+        descriptor = os.open(
+            temporary, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600
+        )
+        with os.fdopen(descriptor, "wb") as file:
+            file.write(key)
+        try:
+            os.link(temporary, key_path)
+        except FileExistsError:
+            key = key_path.read_bytes().strip()
+        finally:
+            temporary.unlink()
+        return key
+
+    def _file(self, client_id: str, user: str) -> Path:
+        name = sha256(f"{client_id}\0{user}".encode("utf-8")).digest()
+        return self.path / (
+            base64.urlsafe_b64encode(name).decode().rstrip("=") + ".token"
+        )
+
+    def load(self, client_id: str, user: str) -> Optional[TokenSet]:
+        """The stored tokens, None if there are none or they do not decrypt."""
+        from cryptography.fernet import InvalidToken
+
+        try:
+            encrypted = self._file(client_id, user).read_bytes()
+        except FileNotFoundError:
+            return None
+        with self._lock:
+            cipher = self._cipher()
+        try:
+            return TokenSet(**json.loads(cipher.decrypt(encrypted)))
+        except (InvalidToken, ValueError, TypeError):
+            return None
+
+    def save(self, client_id: str, user: str, tokens: TokenSet):
+        """Stores the tokens, replacing earlier ones of the same user."""
+        with self._lock:
+            cipher = self._cipher()
+        encrypted = cipher.encrypt(json.dumps(asdict(tokens)).encode("utf-8"))
+        path = self._file(client_id, user)
+        temporary = path.with_name(
+            f"{path.name}.{os.getpid()}.{threading.get_ident()}"
+        )
+        descriptor = os.open(
+            temporary, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600
+        )
+        with os.fdopen(descriptor, "wb") as file:
+            file.write(encrypted)
+        os.replace(temporary, path)
+
+    def delete(self, client_id: str, user: str):
+        """Forgets the tokens, e.g. when the refresh token was rejected."""
+        try:
+            self._file(client_id, user).unlink()
+        except FileNotFoundError:
+            pass
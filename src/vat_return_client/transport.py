@@ -0,0 +1,262 @@
+"""
+HTTP transport used by the VAT Return client.
+Keeps one pooled, keep-alive session per host so repeated calls towards
+Altinn, the VAT app and the validation service reuse TCP and TLS connections
+instead of doing a fresh handshake for every request.
+"""
+import threading
+import time
+from typing import Dict, Optional, Tuple
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import (
+    INSTRUMENTATION,
+    TIMED_POOL_CLASSES,
+    CallEvent,
+    Instrumentation,
+    body_size,
+    connection_phases,
+    current_operation,
+    host_of,
+)
+from rate_limit import (
+    RateLimiter,
+    latency_class,
+    rewind_body,
+    throttle_outcome,
+)
+from settings import (
+    HTTP_POOL_SIZE,
+    HTTP_CONNECT_TIMEOUT,
+    HTTP_READ_TIMEOUT,
+    HTTP_KEEP_ALIVE,
+)
+
+
+class Transport:
+    """
+    Pooled HTTP transport. One session is created lazily per host
+    (scheme + netloc) and shared by every thread using the transport.
+
+    Any object exposing the same 'request' method can be passed to the
+    client instead, e.g. to add logging or to point at a stub server.
+
+    :param pool_size: Max connections kept open per host.
+    :param connect_timeout: Seconds to wait for a connection.
+    :param read_timeout: Seconds to wait for the server to send data.
+    :param keep_alive: Keep connections open between requests.
+    :param block: Wait for a free connection when the pool is exhausted
+    instead of opening a throwaway one.
+    :param rate_limiter: Optional rate_limit.RateLimiter. Every request
+    then waits for its host's rate and concurrency limit, and 429/503
+    responses are retried after Retry-After (or a backoff).
+    :param max_throttle_retries: Retries of a throttled request.
+    :param instrumentation: Hooks called with a metrics.CallEvent per
+    request, defaults to metrics.INSTRUMENTATION.
+    """
+
+    def __init__(
+            self,
+            pool_size: int = HTTP_POOL_SIZE,
+            connect_timeout: float = HTTP_CONNECT_TIMEOUT,
+            read_timeout: float = HTTP_READ_TIMEOUT,
+            keep_alive: bool = HTTP_KEEP_ALIVE,
+            block: bool = True,
+            rate_limiter: Optional[RateLimiter] = None,
+            max_throttle_retries: int = 3,
+            instrumentation: Optional[Instrumentation] = None,
+    ):
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout, read_timeout)
+        self.keep_alive = keep_alive
+        self.block = block
+        self.rate_limiter = rate_limiter
+        self.max_throttle_retries = max_throttle_retries
+        self.instrumentation = instrumentation or INSTRUMENTATION
+        self._sessions: Dict[str, requests.Session] = {}
+        self._request_counts: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def host_key(url: str) -> str:
+        """Returns the pool key (scheme://netloc) for an url."""
+        parts = urlsplit(url)
+        return f"{parts.scheme}://{parts.netloc}"
+
+    def _new_session(self) -> requests.Session:
+        session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=self.pool_size,
+            pool_block=self.block,
+        )
+        # Connections that report their dns, connect and tls timings.
+        adapter.poolmanager.pool_classes_by_scheme = TIMED_POOL_CLASSES
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        if not self.keep_alive:
+            session.headers["Connection"] = "close"
+        return session
+
+    def session_for(self, url: str) -> requests.Session:
+        """Returns the shared session for the host of the url."""
+        key = self.host_key(url)
+        session = self._sessions.get(key)
+        if session is None:
+            with self._lock:
+                session = self._sessions.get(key)
+                if session is None:
+                    session = self._new_session()
+                    self._sessions[key] = session
+                    self._request_counts[key] = 0
+        return session
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        """
+        Sends a request on the pooled session for the host of the url.
+        Takes the same keyword arguments as 'requests.request'.
+        """
+        session = self.session_for(url)
+        kwargs.setdefault("timeout", self.timeout)
+        key = self.host_key(url)
+        with self._lock:
+            self._request_counts[key] = self._request_counts.get(key, 0) + 1
+        if not self.instrumentation.enabled:
+            return self._send(session, method, url, kwargs)[0]
+        return self._observed(session, method, url, kwargs)
+
+    def _observed(
+            self, session: requests.Session, method: str, url: str,
+            kwargs: Dict,
+    ) -> requests.Response:
+        """Sends a request and emits its CallEvent."""
+        event = CallEvent(current_operation(), method, host_of(url))
+        start = time.perf_counter()
+        with connection_phases() as phases:
+            try:
+                response, event.retries = self._send(
+                    session, method, url, kwargs
+                )
+            except Exception as error:
+                event.error = type(error).__name__
+                raise
+            else:
+                event.status_code = response.status_code
+                if kwargs.get("stream"):
+                    event.bytes_received = int(
+                        response.headers.get("Content-Length") or 0
+                    )
+                else:
+                    event.bytes_received = len(response.content)
+                event.ttfb = max(
+                    response.elapsed.total_seconds()
+                    - sum(phases.values()), 0.0
+                )
+                return response
+            finally:
+                event.duration = time.perf_counter() - start
+                event.bytes_sent = body_size(
+                    kwargs.get("data"), kwargs.get("json")
+                )
+                event.dns = phases.get("dns")
+                event.connect = phases.get("connect")
+                event.tls = phases.get("tls")
+                self.instrumentation.emit(event)
+
+    def _send(
+            self, session: requests.Session, method: str, url: str,
+            kwargs: Dict,
+    ) -> Tuple[requests.Response, int]:
+        """Sends a request; returns the response and the retry count."""
+        if self.rate_limiter is None:
+            return session.request(method, url, **kwargs), 0
+        limiter = self.rate_limiter.for_url(url)
+        attempt = 0
+        while True:
+            limiter.acquire()
+            start = time.monotonic()
+            status_code = None
+            throttled, retry_after = False, None
+            try:
+                response = session.request(method, url, **kwargs)
+                status_code = response.status_code
+                throttled, retry_after = throttle_outcome(
+                    status_code, response.headers
+                )
+            finally:
+                limiter.release(
+                    time.monotonic() - start, status_code, retry_after,
+                    kind=latency_class(
+                        current_operation(),
+                        body_size(kwargs.get("data"), kwargs.get("json")),
+                    ),
+                )
+            if not throttled or attempt >= self.max_throttle_retries or \
+                    not rewind_body(kwargs.get("data")):
+                return response, attempt
+            response.close()
+            attempt += 1
+            # With Retry-After the limiter holds the next acquire back.
+            if retry_after is None:
+                time.sleep(min(0.5 * 2 ** attempt, 30))
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request("POST", url, **kwargs)
+
+    def put(self, url: str, **kwargs) -> requests.Response:
+        return self.request("PUT", url, **kwargs)
+
+    def _pool_counts(self, session: requests.Session) -> Tuple[int, int]:
+        """Sums opened connections and served requests over the pools."""
+        connections = 0
+        requests_served = 0
+        for adapter in set(session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            with pools.lock:
+                active_pools = list(pools._container.values())
+            for pool in active_pools:
+                connections += pool.num_connections
+                requests_served += pool.num_requests
+        return connections, requests_served
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        """
+        Pool reuse statistics per host.
+
+        :return: Dict keyed by host with the number of requests sent, the
+        number of connections opened and how many requests reused an
+        already open connection.
+        """
+        with self._lock:
+            sessions = dict(self._sessions)
+            request_counts = dict(self._request_counts)
+        result = {}
+        for key, session in sessions.items():
+            connections, requests_served = self._pool_counts(session)
+            result[key] = {
+                "requests": request_counts[key],
+                "connections": connections,
+                "reused": max(requests_served - connections, 0),
+            }
+        return result
+
+    def close(self):
+        """Closes every pooled connection."""
+        with self._lock:
+            sessions = list(self._sessions.values())
+            self._sessions.clear()
+            self._request_counts.clear()
+        for session in sessions:
+            session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
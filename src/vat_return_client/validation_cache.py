@@ -0,0 +1,256 @@
+"""
+Cache for remote validation results.
+Results are keyed by a hash of the canonicalised VAT message plus the
+validation environment, so unchanged messages (retries, re-runs, repeated
+submissions) are answered locally. Canonicalising a large message takes
+far longer than the lookup itself, so the cache also remembers which key
+the exact bytes of a message had: a message seen before is found by a
+hash of its bytes alone, and only new bytes are canonicalised. An
+in-memory LRU with size and age limits sits in front of an optional
+SQLite file that several worker processes can share.
+"""
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from hashlib import sha256
+from pathlib import Path
+from typing import Dict, Optional, Union
+from xml.etree.ElementTree import C14NWriterTarget, ParseError, XMLParser
+
+from settings import (
+    VALIDATION_CACHE_MAX_ENTRIES,
+    VALIDATION_CACHE_MAX_BYTES,
+    VALIDATION_CACHE_MAX_AGE,
+    VALIDATION_CACHE_FILE,
+)
+
+
+class _IndentationFilter:
+    """
+    Parser target in front of a C14NWriterTarget that drops whitespace-only
+    text between elements, and passes the text of elements without
+    children on exactly, whitespace and all.
+    """
+
+    def __init__(self, target: C14NWriterTarget):
+        self._target = target
+        self._text = []
+        self._in_leaf = False
+
+    def _flush(self, leaf: bool):
+        text = "".join(self._text)
+        self._text = []
+        if text and (leaf or text.strip()):
+            self._target.data(text)
+
+    def data(self, data: str):
+        self._text.append(data)
+
+    def start_ns(self, prefix: str, uri: str):
+        self._target.start_ns(prefix, uri)
+
+    def start(self, tag: str, attrs: Dict[str, str]):
+        self._flush(False)
+        self._target.start(tag, attrs)
+        self._in_leaf = True
+
+    def end(self, tag: str):
+        self._flush(self._in_leaf)
+        self._target.end(tag)
+        self._in_leaf = False
+
+    def comment(self, text: str):
+        self._flush(False)
+        self._target.comment(text)
+
+    def pi(self, target: str, data: Optional[str] = None):
+        self._flush(False)
+        self._target.pi(target, data)
+
+    def close(self):
+        self._flush(False)
+
+
+def normalise_message(body: Union[bytes, str]) -> bytes:
+    """
+    Canonical form of a message (C14N 2.0, whitespace-only text between
+    elements removed), so formatting differences give the same cache key.
+    The text of the elements is kept as it is. Documents that are not
+    UTF-8 or do not parse are used as they are.
+    """
+    raw = body if isinstance(body, bytes) else body.encode("utf-8")
+    try:
+        text = body.decode("utf-8") if isinstance(body, bytes) else body
+        out = []
+        parser = XMLParser(
+            target=_IndentationFilter(C14NWriterTarget(out.append))
+        )
+        parser.feed(text)
+        parser.close()
+        return "".join(out).encode("utf-8")
+    except (UnicodeDecodeError, ParseError):
+        return raw
+
+
+def raw_key(body: Union[bytes, str], environment: str) -> str:
+    """Hash of the exact bytes of a message and the environment."""
+    digest = sha256(environment.encode("utf-8"))
+    digest.update(b"\1")
+    digest.update(body if isinstance(body, bytes) else body.encode("utf-8"))
+    return digest.hexdigest()
+
+
+def cache_key(body: Union[bytes, str], environment: str) -> str:
+    """Cache key for a message validated in an environment."""
+    digest = sha256(environment.encode("utf-8"))
+    digest.update(b"\0")
+    digest.update(normalise_message(body))
+    return digest.hexdigest()
+
+
+class ValidationCache:
+    """
+    LRU of validation results with an optional shared SQLite store.
+
+    :param max_entries: Max results kept in memory.
+    :param max_bytes: Max total size of the results kept in memory.
+    :param max_age: Seconds a result is reused, in memory and on disk.
+    :param path: SQLite file shared by workers, None for memory only.
+    """
+
+    def __init__(
+            self,
+            max_entries: int = VALIDATION_CACHE_MAX_ENTRIES,
+            max_bytes: int = VALIDATION_CACHE_MAX_BYTES,
+            max_age: float = VALIDATION_CACHE_MAX_AGE,
+            path: Optional[Union[str, Path]] = VALIDATION_CACHE_FILE,
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.path = Path(path) if path else None
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._aliases: "OrderedDict[str, str]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._stats = {
+            "hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "evictions": 0,
+        }
+        if self.path is not None:
+            with self._connection() as connection:
+                connection.execute(
+                    "CREATE TABLE IF NOT EXISTS validation_results ("
+                    "key TEXT PRIMARY KEY, result TEXT, stored_at REAL)"
+                )
+
+    def _connection(self) -> sqlite3.Connection:
+        """One connection per thread, sqlite3 connections are not shared."""
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            connection = sqlite3.connect(str(self.path), timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self._local.connection = connection
+        return connection
+
+    def _remember(self, key: str, result: str, stored_at: float):
+        size = len(result)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old[0])
+            self._entries[key] = (result, stored_at)
+            self._bytes += size
+            while self._entries and (
+                    len(self._entries) > self.max_entries or
+                    self._bytes > self.max_bytes
+            ):
+                _, (evicted, _) = self._entries.popitem(last=False)
+                self._bytes -= len(evicted)
+                self._stats["evictions"] += 1
+
+    def key(self, body: Union[bytes, str], environment: str) -> str:
+        """
+        The cache_key of a message, canonicalised only the first time
+        these exact bytes are seen.
+        """
+        raw = raw_key(body, environment)
+        with self._lock:
+            key = self._aliases.get(raw)
+            if key is not None:
+                self._aliases.move_to_end(raw)
+                return key
+        key = cache_key(body, environment)
+        with self._lock:
+            self._aliases[raw] = key
+            while len(self._aliases) > self.max_entries:
+                self._aliases.popitem(last=False)
+        return key
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        :param key: Key from key() or cache_key.
+        :return: The cached result, or None.
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if now - entry[1] <= self.max_age:
+                    self._entries.move_to_end(key)
+                    self._stats["hits"] += 1
+                    return entry[0]
+                del self._entries[key]
+                self._bytes -= len(entry[0])
+        if self.path is not None:
+            row = self._connection().execute(
+                "SELECT result, stored_at FROM validation_results "
+                "WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and now - row[1] <= self.max_age:
+                self._remember(key, row[0], row[1])
+                with self._lock:
+                    self._stats["disk_hits"] += 1
+                return row[0]
+        with self._lock:
+            self._stats["misses"] += 1
+        return None
+
+    def put(self, key: str, result: str):
+        """Stores a result in memory and, if configured, on disk."""
+        stored_at = time.time()
+        self._remember(key, result, stored_at)
+        if self.path is not None:
+            with self._connection() as connection:
+                connection.execute(
+                    "INSERT OR REPLACE INTO validation_results "
+                    "(key, result, stored_at) VALUES (?, ?, ?)",
+                    (key, result, stored_at),
+                )
+
+    def clear(self):
+        """Empties the memory and disk stores."""
+        with self._lock:
+            self._entries.clear()
+            self._aliases.clear()
+            self._bytes = 0
+        if self.path is not None:
+            with self._connection() as connection:
+                connection.execute("DELETE FROM validation_results")
+
+    def stats(self) -> Dict:
+        """Hit, miss and eviction counters, entry count and hit rate."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+            stats["bytes"] = self._bytes
+        lookups = stats["hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"] = (
+            (stats["hits"] + stats["disk_hits"]) / lookups if lookups else 0.0
+        )
+        return stats
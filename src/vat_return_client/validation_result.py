@@ -0,0 +1,182 @@
+"""
+Structured results of the remote validation.
+The valideringsresultat returned by 'validate_tax_return' is read with a
+pull parser, so no DOM of the response is built and 'has_errors' can stop
+at the first finding that decides it. Findings are counted as errors,
+deviations or warnings from their alvorlighetsgrad.
+ref: https://skatteetaten.github.io/mva-meldingen/english/valideringsregler/
+"""
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
+from xml.etree.ElementTree import XMLPullParser
+
+ValidationResponse = Union[bytes, str, Iterable[bytes]]
+
+
+def severity(grade: Optional[str]) -> str:
+    """'error', 'deviation' or 'warning' for an alvorlighetsgrad."""
+    grade = (grade or "").upper()
+    if "FEIL" in grade or "UGYLDIG" in grade:
+        return "error"
+    if "AVVIK" in grade:
+        return "deviation"
+    return "warning"
+
+
+def _invalid(status: Optional[str]) -> bool:
+    return status is not None and "UGYLDIG" in status.upper()
+
+
+@dataclass
+class Finding:
+    """One valideringsfunn."""
+    severity: str
+    grade: Optional[str] = None
+    code: Optional[str] = None
+    text: Optional[str] = None
+    paths: List[str] = field(default_factory=list)
+
+
+@dataclass
+class ValidationResult:
+    """A parsed validation response."""
+    status: Optional[str] = None
+    errors: int = 0
+    deviations: int = 0
+    warnings: int = 0
+    findings: List[Finding] = field(default_factory=list)
+
+    @property
+    def ok(self) -> bool:
+        return self.errors == 0 and not _invalid(self.status)
+
+    def as_dict(self) -> Dict:
+        return {
+            "status": self.status,
+            "errors": self.errors,
+            "deviations": self.deviations,
+            "warnings": self.warnings,
+            "findings": [
+                [finding.severity, finding.code, finding.text, finding.paths]
+                for finding in self.findings
+            ],
+        }
+
+
+def _chunks(response: ValidationResponse) -> Iterator[bytes]:
+    if isinstance(response, str):
+        response = response.encode("utf-8")
+    if isinstance(response, (bytes, bytearray, memoryview)):
+        yield bytes(response)
+    else:
+        yield from response
+
+
+def _local_name(tag: str) -> str:
+    return tag.rpartition("}")[2]
+
+
+class _EventReader:
+    """
+    Pull parser of a response fed chunk by chunk, giving ('status', text)
+    and ('finding', Finding) in document order.
+    """
+
+    def __init__(self):
+        self._parser = XMLPullParser(events=("start", "end"))
+        self._finding: Optional[Finding] = None
+
+    def feed(self, chunk: bytes) -> Iterator[Tuple[str, object]]:
+        self._parser.feed(chunk)
+        for event, element in self._parser.read_events():
+            name = _local_name(element.tag)
+            finding = self._finding
+            if event == "start":
+                if name == "valideringsfunn":
+                    self._finding = Finding(severity="warning")
+                continue
+            text = (element.text or "").strip() or None
+            if finding is None:
+                if name == "status":
+                    yield "status", text
+            elif name == "valideringsfunn":
+                finding.severity = severity(finding.grade)
+                yield "finding", finding
+                self._finding = None
+                element.clear()
+            elif name == "alvorlighetsgrad":
+                finding.grade = text
+            elif name == "kode":
+                finding.code = text
+            elif name in ("tekst", "beskrivelse"):
+                finding.text = text
+            elif name == "sti":
+                finding.paths.append(text)
+
+    def close(self):
+        self._parser.close()
+
+
+def _events(response: ValidationResponse) -> Iterator[Tuple[str, object]]:
+    """Events of the response, parsed as the chunks arrive."""
+    reader = _EventReader()
+    for chunk in _chunks(response):
+        yield from reader.feed(chunk)
+    reader.close()
+
+
+class ValidationParser:
+    """
+    'parse_validation' for chunks that are pushed in as they arrive, e.g.
+    from an async stream: call 'feed' with each chunk and 'close' at the
+    end.
+    """
+
+    def __init__(self):
+        self._reader = _EventReader()
+        self._result = ValidationResult()
+
+    def feed(self, chunk: bytes):
+        for kind, value in self._reader.feed(chunk):
+            if kind == "status":
+                self._result.status = value
+                continue
+            self._result.findings.append(value)
+            if value.severity == "error":
+                self._result.errors += 1
+            elif value.severity == "deviation":
+                self._result.deviations += 1
+            else:
+                self._result.warnings += 1
+
+    def close(self) -> ValidationResult:
+        """Ends the parse; raises ParseError for an incomplete response."""
+        self._reader.close()
+        return self._result
+
+
+def parse_validation(response: ValidationResponse) -> ValidationResult:
+    """
+    Parses a validation response.
+
+    :param response: The response as text, bytes or chunks of bytes (e.g.
+    'iter_content' of a streamed response).
+    :return: Status, counts per severity and the findings.
+    """
+    parser = ValidationParser()
+    for chunk in _chunks(response):
+        parser.feed(chunk)
+    return parser.close()
+
+
+def has_errors(response: ValidationResponse) -> bool:
+    """
+    Whether the response has an error finding or an invalid status.
+    Stops reading at the first one found.
+    """
+    for kind, value in _events(response):
+        if kind == "status" and _invalid(value):
+            return True
+        if kind == "finding" and value.severity == "error":
+            return True
+    return False
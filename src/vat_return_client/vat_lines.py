@@ -0,0 +1,224 @@
+"""
+Local checks of the sums in a VAT message before it is validated remotely.
+The mvaSpesifikasjonslinje elements are kept as columns (typed arrays of
+code, basis, rate and amount) instead of one object per line, and the line
+amounts, per-code totals and the fastsattMerverdiavgift reconciliation are
+computed with NumPy over whole columns.
+"""
+import io
+from array import array
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import IO, Dict, Iterable, List, Optional, Union
+from xml.etree.ElementTree import iterparse
+
+import numpy
+
+from documents import VatLine, VatMessage
+
+# Allowed difference, in NOK, between a computed and a reported amount.
+# Amounts are rounded per line, so a few øre either way are expected.
+ROUNDING_TOLERANCE = 1.0
+
+_COLUMNS = {"mvaKode": 0, "grunnlag": 1, "sats": 2, "merverdiavgift": 3}
+
+
+def _local_name(tag: str) -> str:
+    return tag.rpartition("}")[2]
+
+
+def _number(text: Optional[str]) -> float:
+    return float(text) if text else numpy.nan
+
+
+def _code(text: Optional[str], index: int) -> int:
+    """The mvaKode of the line at 'index', which every line must have."""
+    try:
+        return int(text)
+    except (TypeError, ValueError):
+        raise ValueError(
+            f"mvaSpesifikasjonslinje {index + 1} has no valid mvaKode: "
+            f"{text!r}"
+        ) from None
+
+
+@dataclass
+class LineDiscrepancy:
+    """A line whose amount is not basis times rate."""
+    line: int
+    code: int
+    basis: float
+    rate: float
+    amount: float
+    expected: float
+
+
+@dataclass
+class TotalsReport:
+    """The outcome of VatLines.check."""
+    lines: int
+    reported_total: Optional[float]
+    computed_total: float
+    totals_by_code: Dict[int, float] = field(default_factory=dict)
+    discrepancies: List[LineDiscrepancy] = field(default_factory=list)
+    tolerance: float = ROUNDING_TOLERANCE
+
+    @property
+    def total_ok(self) -> bool:
+        return self.reported_total is None or \
+            abs(self.reported_total - self.computed_total) <= self.tolerance
+
+    @property
+    def ok(self) -> bool:
+        return self.total_ok and not self.discrepancies
+
+    def as_dict(self) -> Dict:
+        return {
+            "ok": self.ok,
+            "lines": self.lines,
+            "reported_total": self.reported_total,
+            "computed_total": self.computed_total,
+            "totals_by_code": self.totals_by_code,
+            "discrepancies": [
+                [d.line, d.code, d.basis, d.rate, d.amount, d.expected]
+                for d in self.discrepancies
+            ],
+        }
+
+
+class VatLines:
+    """
+    The specification lines of a VAT message as columns. Missing basis or
+    rate are NaN, and such lines are left out of the line amount check.
+
+    :param codes: mvaKode per line.
+    :param basis: grunnlag per line.
+    :param rates: sats per line, in percent.
+    :param amounts: merverdiavgift per line.
+    :param reported_total: The fastsattMerverdiavgift of the message.
+    """
+    __slots__ = ("codes", "basis", "rates", "amounts", "reported_total")
+
+    def __init__(
+            self,
+            codes: numpy.ndarray,
+            basis: numpy.ndarray,
+            rates: numpy.ndarray,
+            amounts: numpy.ndarray,
+            reported_total: Optional[float] = None,
+    ):
+        self.codes = numpy.asarray(codes, dtype=numpy.int32)
+        self.basis = numpy.asarray(basis, dtype=numpy.float64)
+        self.rates = numpy.asarray(rates, dtype=numpy.float64)
+        self.amounts = numpy.asarray(amounts, dtype=numpy.float64)
+        self.reported_total = reported_total
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    @classmethod
+    def from_xml(cls, source: Union[str, Path, IO[bytes]]) -> "VatLines":
+        """
+        Reads the lines from a VAT message file, element by element, so no
+        tree of the whole message is kept.
+
+        :param source: Path or binary file object of the message.
+        :raises ValueError: For a line without a numeric mvaKode.
+        """
+        codes, basis, rates, amounts = (
+            array("i"), array("d"), array("d"), array("d")
+        )
+        line: List[Optional[str]] = [None] * 4
+        reported_total = None
+        for _, element in iterparse(source, events=("end",)):
+            name = _local_name(element.tag)
+            column = _COLUMNS.get(name)
+            if column is not None:
+                line[column] = element.text
+            elif name == "mvaSpesifikasjonslinje":
+                codes.append(_code(line[0], len(codes)))
+                basis.append(_number(line[1]))
+                rates.append(_number(line[2]))
+                amounts.append(_number(line[3]))
+                line = [None] * 4
+                element.clear()
+            elif name == "fastsattMerverdiavgift":
+                reported_total = float(element.text)
+        return cls(
+            numpy.frombuffer(codes, dtype=numpy.int32),
+            numpy.frombuffer(basis),
+            numpy.frombuffer(rates),
+            numpy.frombuffer(amounts),
+            reported_total,
+        )
+
+    @classmethod
+    def from_bytes(cls, message: bytes) -> "VatLines":
+        return cls.from_xml(io.BytesIO(message))
+
+    @classmethod
+    def from_lines(
+            cls, lines: Iterable[VatLine], reported_total: Optional[float] = None
+    ) -> "VatLines":
+        """From documents.VatLine objects, e.g. those of a VatMessage."""
+        columns = [array("i"), array("d"), array("d"), array("d")]
+        for line in lines:
+            columns[0].append(int(line.code))
+            columns[1].append(numpy.nan if line.basis is None
+                              else float(line.basis))
+            columns[2].append(numpy.nan if line.rate is None
+                              else float(line.rate))
+            columns[3].append(float(line.amount))
+        return cls(
+            numpy.frombuffer(columns[0], dtype=numpy.int32),
+            *(numpy.frombuffer(column) for column in columns[1:]),
+            reported_total=reported_total,
+        )
+
+    @classmethod
+    def from_message(cls, message: VatMessage) -> "VatLines":
+        return cls.from_lines(message.lines, float(message.total))
+
+    def expected_amounts(self) -> numpy.ndarray:
+        """Basis times rate per line, NaN where either is missing."""
+        return self.basis * self.rates / 100
+
+    def totals_by_code(self) -> Dict[int, float]:
+        """Sum of the line amounts per mvaKode."""
+        codes, index = numpy.unique(self.codes, return_inverse=True)
+        sums = numpy.bincount(index, weights=self.amounts,
+                              minlength=len(codes))
+        return {int(code): float(total) for code, total in zip(codes, sums)}
+
+    def total(self) -> float:
+        """Sum of all line amounts, to compare to fastsattMerverdiavgift."""
+        return float(self.amounts.sum())
+
+    def check(self, tolerance: float = ROUNDING_TOLERANCE) -> TotalsReport:
+        """
+        Checks every line amount against basis times rate, and the sum of
+        the lines against the reported total.
+
+        :param tolerance: Allowed difference in NOK.
+        :return: The report, listing only the lines that are off.
+        """
+        expected = self.expected_amounts()
+        with numpy.errstate(invalid="ignore"):
+            off = numpy.abs(self.amounts - expected) > tolerance
+        report = TotalsReport(
+            lines=len(self),
+            reported_total=self.reported_total,
+            computed_total=self.total(),
+            totals_by_code=self.totals_by_code(),
+            tolerance=tolerance,
+        )
+        for index in numpy.flatnonzero(off):
+            report.discrepancies.append(LineDiscrepancy(
+                line=int(index),
+                code=int(self.codes[index]),
+                basis=float(self.basis[index]),
+                rate=float(self.rates[index]),
+                amount=float(self.amounts[index]),
+                expected=round(float(expected[index]), 2),
+            ))
+        return report
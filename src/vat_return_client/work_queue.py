@@ -0,0 +1,431 @@
+"""
+Durable queue of filings for worker processes on one or more hosts.
+Filings are enqueued into SQLite once; any number of workers sharing the
+file claim jobs under a lease, run the submission flow and store the
+result. A worker renews the leases of its running jobs while it works, so
+the jobs of a worker that died are claimed again by another once their
+lease runs out. With a shared SubmissionJournal the new worker continues
+on the Altinn instance already created instead of starting over.
+
+The VAT message and envelope are stored in the queue, attachments by
+absolute path, so every host needs the same paths to them.
+
+On a network filesystem (NFS, SMB) give 'network_filesystem=True': WAL
+needs shared memory between the processes, which only works on one host,
+so the rollback journal and file locks are used instead.
+"""
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Union
+
+from bulk import BulkSummary
+from client import VatReturn
+from journal import SubmissionJournal, filing_key
+from settings import FILING_LEASE_SECONDS, FILING_QUEUE_FILE
+from submission import (
+    Attachment, Filing, FilingResult, content, submit_filing,
+)
+
+# Status of a job: waiting, claimed by a worker, or finished.
+JOB_STATUSES = ("queued", "running", "done", "failed")
+
+logger = logging.getLogger(__name__)
+
+
+def worker_name() -> str:
+    """A name telling the workers of all hosts apart."""
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+@dataclass
+class Job:
+    """A claimed filing."""
+    id: int
+    filing: Filing
+    attempts: int
+
+
+class FilingQueue:
+    """
+    Filing jobs in SQLite, claimed with leases. Safe to use from many
+    threads, processes and, on a shared filesystem, hosts.
+
+    :param path: SQLite file.
+    :param lease_seconds: How long a claim holds without being renewed.
+    :param max_attempts: Claims of a job before it is failed, so a job
+    that kills its workers does not take down every worker in turn.
+    :param network_filesystem: Use file locks instead of WAL.
+    """
+
+    def __init__(
+            self,
+            path: Union[str, Path] = FILING_QUEUE_FILE,
+            lease_seconds: float = FILING_LEASE_SECONDS,
+            max_attempts: int = 3,
+            network_filesystem: bool = False,
+    ):
+        self.path = Path(path)
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.network_filesystem = network_filesystem
+        self._local = threading.local()
+        with self._connection() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id INTEGER PRIMARY KEY, filing_key TEXT UNIQUE, "
+                "org_number TEXT, message BLOB, envelope BLOB, "
+                "attachments TEXT, status TEXT, attempts INTEGER, "
+                "worker TEXT, lease_expires REAL, result TEXT, error TEXT, "
+                "enqueued_at REAL, finished_at REAL)"
+            )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS jobs_status "
+                "ON jobs (status, lease_expires)"
+            )
+
+    def _connection(self) -> sqlite3.Connection:
+        """One connection per thread, sqlite3 connections are not shared."""
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            # Transactions are begun explicitly, see 'claim'.
+            connection = sqlite3.connect(
+                str(self.path), timeout=30, isolation_level=None
+            )
+            connection.execute(
+                "PRAGMA journal_mode=DELETE" if self.network_filesystem
+                else "PRAGMA journal_mode=WAL"
+            )
+            self._local.connection = connection
+        return connection
+
+    def _transaction(self, sql: str, parameters=()) -> sqlite3.Cursor:
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            cursor = connection.execute(sql, parameters)
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+        return cursor
+
+    def enqueue(self, filings: Iterable[Filing]) -> int:
+        """
+        Adds filings. A filing already in the queue (same organisation and
+        message) is not added again, so a manifest can be enqueued twice.
+
+        :return: The number of filings added.
+        """
+        rows = []
+        for filing in filings:
+            message = content(filing.message)
+            if isinstance(message, Path):
+                message = message.read_bytes()
+            envelope = content(filing.envelope)
+            if isinstance(envelope, Path):
+                envelope = envelope.read_bytes()
+            attachments = [
+                [attachment.content_type, attachment.file_name,
+                 str(Path(attachment.path).resolve())]
+                for attachment in filing.attachments
+            ]
+            rows.append((
+                filing_key(filing.org_number, message), filing.org_number,
+                message, envelope, json.dumps(attachments), "queued", 0,
+                time.time(),
+            ))
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            before = connection.total_changes
+            connection.executemany(
+                "INSERT OR IGNORE INTO jobs (filing_key, org_number, "
+                "message, envelope, attachments, status, attempts, "
+                "enqueued_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            added = connection.total_changes - before
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+        return added
+
+    def claim(self, worker: str, limit: int = 1) -> List[Job]:
+        """
+        Claims up to 'limit' jobs: queued ones first, then running ones
+        whose lease ran out. Jobs out of attempts are failed instead.
+
+        :param worker: Name of the claiming worker, see worker_name.
+        """
+        now = time.time()
+        connection = self._connection()
+        # IMMEDIATE takes the write lock up front, so two workers never
+        # read the same free job.
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.execute(
+                "UPDATE jobs SET status = 'failed', finished_at = ?, "
+                "error = 'Lease expired ' || attempts || ' times.' "
+                "WHERE status = 'running' AND lease_expires < ? "
+                "AND attempts >= ?",
+                (now, now, self.max_attempts),
+            )
+            rows = connection.execute(
+                "SELECT id, org_number, message, envelope, attachments, "
+                "attempts FROM jobs WHERE status = 'queued' "
+                "OR (status = 'running' AND lease_expires < ?) "
+                "ORDER BY status = 'running', id LIMIT ?",
+                (now, limit),
+            ).fetchall()
+            connection.executemany(
+                "UPDATE jobs SET status = 'running', worker = ?, "
+                "lease_expires = ?, attempts = attempts + 1 WHERE id = ?",
+                [(worker, now + self.lease_seconds, row[0]) for row in rows],
+            )
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+        return [
+            Job(
+                id=id_,
+                filing=Filing(
+                    org_number=org_number,
+                    message=bytes(message),
+                    envelope=bytes(envelope),
+                    attachments=[
+                        Attachment(content_type, file_name, Path(path))
+                        for content_type, file_name, path
+                        in json.loads(attachments)
+                    ],
+                ),
+                attempts=attempts + 1,
+            )
+            for id_, org_number, message, envelope, attachments, attempts
+            in rows
+        ]
+
+    def renew(self, worker: str, job_ids: Iterable[int]) -> int:
+        """
+        Extends the leases the worker still holds.
+
+        :return: The number of leases renewed.
+        """
+        job_ids = list(job_ids)
+        if not job_ids:
+            return 0
+        return self._transaction(
+            f"UPDATE jobs SET lease_expires = ? WHERE worker = ? "
+            f"AND status = 'running' "
+            f"AND id IN ({', '.join('?' * len(job_ids))})",
+            [time.time() + self.lease_seconds, worker] + job_ids,
+        ).rowcount
+
+    def complete(self, worker: str, job_id: int, result: FilingResult) -> bool:
+        """
+        Stores the result of a job.
+
+        :return: False when the worker lost the lease and another worker
+        has the job, the result is then not stored.
+        """
+        return self._transaction(
+            "UPDATE jobs SET status = ?, result = ?, error = ?, "
+            "finished_at = ?, lease_expires = NULL "
+            "WHERE id = ? AND worker = ? AND status = 'running'",
+            (
+                "done" if result.ok else "failed",
+                json.dumps(asdict(result), default=str),
+                result.error,
+                time.time(),
+                job_id,
+                worker,
+            ),
+        ).rowcount == 1
+
+    def release(self, worker: str, job_ids: Iterable[int]):
+        """Puts jobs the worker will not run back in the queue."""
+        job_ids = list(job_ids)
+        if not job_ids:
+            return
+        self._transaction(
+            f"UPDATE jobs SET status = 'queued', worker = NULL, "
+            f"lease_expires = NULL, attempts = attempts - 1 "
+            f"WHERE worker = ? AND status = 'running' "
+            f"AND id IN ({', '.join('?' * len(job_ids))})",
+            [worker] + job_ids,
+        )
+
+    def requeue_failed(self) -> int:
+        """Puts the failed jobs back in the queue with fresh attempts."""
+        return self._transaction(
+            "UPDATE jobs SET status = 'queued', attempts = 0, worker = NULL, "
+            "result = NULL, error = NULL, finished_at = NULL "
+            "WHERE status = 'failed'"
+        ).rowcount
+
+    def counts(self) -> Dict[str, int]:
+        """Number of jobs per status."""
+        rows = self._connection().execute(
+            "SELECT status, COUNT(*) FROM jobs GROUP BY status"
+        ).fetchall()
+        return dict(rows)
+
+    def unfinished(self) -> int:
+        """Jobs queued or running."""
+        return self._connection().execute(
+            "SELECT COUNT(*) FROM jobs WHERE status IN ('queued', 'running')"
+        ).fetchone()[0]
+
+    def results(self, status: Optional[str] = None) -> List[Dict]:
+        """
+        The stored results of finished jobs, optionally of one status.
+        """
+        query = "SELECT id, org_number, status, result, error, finished_at " \
+                "FROM jobs WHERE status IN ('done', 'failed')"
+        parameters = []
+        if status is not None:
+            query += " AND status = ?"
+            parameters.append(status)
+        rows = self._connection().execute(query + " ORDER BY id", parameters)
+        return [
+            {
+                "id": id_,
+                "org_number": org_number,
+                "status": status,
+                "result": json.loads(result) if result else None,
+                "error": error,
+                "finished_at": finished_at,
+            }
+            for id_, org_number, status, result, error, finished_at in rows
+        ]
+
+
+def run_worker(
+        vat_client: VatReturn,
+        queue: FilingQueue,
+        concurrency: int = 8,
+        worker: Optional[str] = None,
+        until_empty: bool = True,
+        poll_interval: float = 1.0,
+        stop: Optional[threading.Event] = None,
+        validate_only: bool = False,
+        wait_for_feedback: bool = True,
+        journal: Optional[SubmissionJournal] = None,
+        max_parallel_steps: int = 4,
+        on_result: Optional[Callable[[FilingResult], None]] = None,
+) -> BulkSummary:
+    """
+    Claims and submits filings from the queue until it is empty or 'stop'
+    is set. Run one per process; start more processes, on this or other
+    hosts, to go faster.
+
+    :param vat_client: Client with the altinn token set. Its transport
+    should have a pool size of at least concurrency.
+    :param queue: The shared queue.
+    :param concurrency: Filings of this worker in flight at once.
+    :param worker: Name of the worker, defaults to a new worker_name.
+    :param until_empty: Return once no job is queued or running anywhere,
+    else keep waiting for new jobs until 'stop' is set.
+    :param poll_interval: Seconds between looks for new jobs.
+    :param stop: Set to stop claiming; running filings are finished.
+    :param journal: Journal shared by the workers. Without one, a job
+    claimed again after its worker died is submitted from scratch.
+    :param on_result: Called with the result of every job this worker
+    stored. Errors it raises are logged.
+    :return: The filings this worker finished and stored; jobs whose
+    lease was lost to another worker are left out.
+    """
+    worker = worker or worker_name()
+    stop = stop or threading.Event()
+    summary = BulkSummary()
+    start = time.perf_counter()
+    running: Dict = {}
+    lock = threading.Lock()
+    done_heartbeat = threading.Event()
+
+    def heartbeat():
+        # Errors are logged and the renewal tried again next round; a
+        # renewer that died would let every lease of the worker run out.
+        while not done_heartbeat.wait(queue.lease_seconds / 3):
+            with lock:
+                job_ids = [job.id for job in running.values()]
+            try:
+                renewed = queue.renew(worker, job_ids)
+            except Exception:
+                logger.warning("Renewing %d leases failed.", len(job_ids),
+                               exc_info=True)
+                continue
+            if renewed < len(job_ids):
+                logger.warning("%d of %d leases were lost to other workers.",
+                               len(job_ids) - renewed, len(job_ids))
+
+    def run(job: Job) -> FilingResult:
+        return submit_filing(
+            vat_client,
+            job.filing,
+            validate_only=validate_only,
+            wait_for_feedback=wait_for_feedback,
+            journal=journal,
+            max_parallel_steps=max_parallel_steps,
+        )
+
+    renewer = threading.Thread(
+        target=heartbeat, name="filing-lease-renewer", daemon=True
+    )
+    renewer.start()
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            while True:
+                free = concurrency - len(running)
+                if free and not stop.is_set():
+                    for job in queue.claim(worker, free):
+                        with lock:
+                            running[executor.submit(run, job)] = job
+                if not running:
+                    if stop.is_set() or \
+                            (until_empty and not queue.unfinished()):
+                        break
+                    stop.wait(poll_interval)
+                    continue
+                done, _ = wait(
+                    list(running), timeout=poll_interval,
+                    return_when=FIRST_COMPLETED,
+                )
+                for future in done:
+                    with lock:
+                        job = running.pop(future)
+                    result = future.result()
+                    if not queue.complete(worker, job.id, result):
+                        # Another worker claimed the job after the lease
+                        # ran out, its result is the one kept.
+                        logger.warning(
+                            "Lost the lease of job %d (%s), its result "
+                            "was not stored.", job.id, job.filing.org_number,
+                        )
+                        continue
+                    summary.results.append(result)
+                    if on_result is not None:
+                        try:
+                            on_result(result)
+                        except Exception:
+                            logger.exception("on_result failed for job %d.",
+                                             job.id)
+    finally:
+        done_heartbeat.set()
+        renewer.join()
+        with lock:
+            unfinished = [job.id for job in running.values()]
+        queue.release(worker, unfinished)
+    summary.wall_time = time.perf_counter() - start
+    return summary
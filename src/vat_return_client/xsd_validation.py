@@ -0,0 +1,157 @@
+"""
+Offline XSD pre-validation of VAT messages and envelopes.
+The published schemas are loaded and compiled once per process (and can be
+kept on disk between runs), so structurally broken messages are rejected
+locally before they are sent to the remote validation service.
+ref: https://github.com/Skatteetaten/mva-meldingen/tree/master/docs/informasjonsmodell_filer/xsd
+"""
+import threading
+from pathlib import Path
+from typing import Dict, List, Optional, Union
+
+from lxml import etree
+
+from settings import VAT_MESSAGE_XSD, VAT_ENVELOPE_XSD, XSD_CACHE_DIR
+from transport import Transport
+
+# Compiled schemas by source, shared by every validator in the process.
+# lxml schemas keep their error log on the object, so each one is used
+# under its own lock.
+_SCHEMAS: Dict[str, tuple] = {}
+_SCHEMAS_LOCK = threading.Lock()
+
+
+def _parser() -> etree.XMLParser:
+    """A new parser (they are not thread safe) that expands no entities."""
+    return etree.XMLParser(resolve_entities=False, no_network=True)
+
+
+class SchemaValidationError(ValueError):
+    """Raised when a document does not conform to its XSD."""
+
+    def __init__(self, errors: List[str]):
+        self.errors = errors
+        super().__init__(
+            "Document is not valid according to the XSD:\n" + "\n".join(errors)
+        )
+
+
+def _read_source(
+        source: str, cache_dir: Optional[Path], transport: Transport
+) -> bytes:
+    """Reads an XSD from a path or url, using the disk cache for urls."""
+    if "://" not in source:
+        return Path(source).read_bytes()
+    cached = cache_dir / Path(source).name if cache_dir else None
+    if cached is not None and cached.exists():
+        return cached.read_bytes()
+    response = transport.get(source)
+    response.raise_for_status()
+    if cached is not None:
+        cached.parent.mkdir(parents=True, exist_ok=True)
+        cached.write_bytes(response.content)
+    return response.content
+
+
+def load_schema(
+        source: str,
+        cache_dir: Optional[Union[str, Path]] = XSD_CACHE_DIR,
+        transport: Optional[Transport] = None,
+) -> etree.XMLSchema:
+    """
+    Returns the compiled schema for a path or url, compiling it only the
+    first time it is asked for in the process.
+
+    :param source: Path or url of the XSD.
+    :param cache_dir: Folder to keep downloaded XSDs in, None for no disk
+    cache.
+    :param transport: Transport used to download the XSD.
+    :return: The compiled schema.
+    """
+    return _compiled(source, cache_dir, transport)[0]
+
+
+def _compiled(
+        source: str,
+        cache_dir: Optional[Union[str, Path]],
+        transport: Optional[Transport] = None,
+) -> tuple:
+    """The (schema, lock) pair for a source, compiled on first use."""
+    compiled = _SCHEMAS.get(source)
+    if compiled is not None:
+        return compiled
+    with _SCHEMAS_LOCK:
+        compiled = _SCHEMAS.get(source)
+        if compiled is None:
+            content = _read_source(
+                source,
+                Path(cache_dir) if cache_dir else None,
+                transport or Transport(),
+            )
+            schema = etree.XMLSchema(etree.fromstring(content, _parser()))
+            compiled = (schema, threading.Lock())
+            _SCHEMAS[source] = compiled
+    return compiled
+
+
+class XsdValidator:
+    """
+    Validates VAT messages and envelopes against their XSD. The schemas
+    are compiled lazily on first use and then reused.
+
+    :param message_xsd: Path or url of the skattemeldingformerverdiavgift XSD.
+    :param envelope_xsd: Path or url of the envelope XSD.
+    :param cache_dir: Folder to keep downloaded XSDs in.
+    """
+
+    def __init__(
+            self,
+            message_xsd: str = VAT_MESSAGE_XSD,
+            envelope_xsd: str = VAT_ENVELOPE_XSD,
+            cache_dir: Optional[Union[str, Path]] = XSD_CACHE_DIR,
+    ):
+        self.message_xsd = message_xsd
+        self.envelope_xsd = envelope_xsd
+        self.cache_dir = cache_dir
+
+    def _errors(self, source: str, body: Union[bytes, str]) -> List[str]:
+        schema, lock = _compiled(source, self.cache_dir)
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        try:
+            document = etree.fromstring(body, _parser())
+        except etree.XMLSyntaxError as error:
+            return [f"line {error.lineno}: {error.msg}"]
+        with lock:
+            if schema.validate(document):
+                return []
+            return [
+                f"line {error.line}: {error.message}"
+                for error in schema.error_log
+            ]
+
+    def message_errors(self, body: Union[bytes, str]) -> List[str]:
+        """
+        :param body: VAT message.
+        :return: Syntax and schema errors, empty when valid.
+        """
+        return self._errors(self.message_xsd, body)
+
+    def envelope_errors(self, body: Union[bytes, str]) -> List[str]:
+        """
+        :param body: Submission envelope.
+        :return: Syntax and schema errors, empty when valid.
+        """
+        return self._errors(self.envelope_xsd, body)
+
+    def check_message(self, body: Union[bytes, str]):
+        """Raises SchemaValidationError if the VAT message is invalid."""
+        errors = self.message_errors(body)
+        if errors:
+            raise SchemaValidationError(errors)
+
+    def check_envelope(self, body: Union[bytes, str]):
+        """Raises SchemaValidationError if the envelope is invalid."""
+        errors = self.envelope_errors(body)
+        if errors:
+            raise SchemaValidationError(errors)
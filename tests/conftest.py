@@ -0,0 +1,9 @@
+"""
+The client modules import each other by their flat names, as when run from
+src/vat_return_client, so that folder is put on the path.
+"""
+import sys
+from pathlib import Path
+
+SRC = Path(__file__).resolve().parent.parent / "src"
+sys.path[:0] = [str(SRC / "vat_return_client"), str(SRC / "benchmarks")]
@@ -0,0 +1,108 @@
+import asyncio
+
+import aiohttp
+import pytest
+
+from async_client import AsyncTransport, AsyncVatReturn
+from fake_altinn import FakeAltinn
+from hedging import HedgePolicy
+from instance_index import InstanceIndex
+from token_cache import AltinnTokenManager
+from validation_cache import ValidationCache
+
+
+def _client(fake: FakeAltinn, transport: AsyncTransport, **kwargs):
+    return AsyncVatReturn(
+        id_porten_auth_headers={"Authorization": "Bearer test"},
+        altinn_environment=fake.url,
+        id_porten_environment=fake.url,
+        instance_api_url=fake.instance_api_url,
+        transport=transport,
+        **kwargs,
+    )
+
+
+def test_token_manager_shares_one_exchange_and_index_records(tmp_path):
+    index = InstanceIndex(tmp_path / "index.db")
+
+    async def run(fake):
+        async with AsyncTransport() as transport:
+            vat_client = _client(
+                fake, transport,
+                token_manager=AltinnTokenManager(), instance_index=index,
+            )
+            instances = await asyncio.gather(*(
+                vat_client.create_instance("999999999") for _ in range(10)
+            ))
+            await vat_client.ship_to_next_process(
+                instances[0]["selfLinks"]["apps"]
+            )
+            return instances
+
+    with FakeAltinn(latency=0.01) as fake:
+        instances = asyncio.run(run(fake))
+        assert fake.requests["GET exchange/id-porten"] == 1
+    recorded = index.get(instances[0]["selfLinks"]["apps"])
+    assert recorded["org_number"] == "999999999"
+    assert recorded["process_step"] == "Task_2"
+    assert len(index.instances()) == 10
+
+
+def test_managed_token_and_streamed_validation_result():
+    async def run(fake):
+        async with AsyncTransport() as transport:
+            vat_client = _client(
+                fake, transport, token_manager=AltinnTokenManager(),
+                validation_cache=ValidationCache(path=None),
+            )
+            assert vat_client.altinn_token is None
+            await vat_client.set_altinn_token()
+            assert vat_client.altinn_token == await vat_client._token()
+            result = await vat_client.validate_tax_return_result(
+                b"<melding/>"
+            )
+            text = await vat_client.validate_tax_return(b"<melding/>")
+            return vat_client, result, text
+
+    with FakeAltinn() as fake:
+        vat_client, result, text = asyncio.run(run(fake))
+        assert fake.requests["GET exchange/id-porten"] == 1
+    assert result.status == "GODKJENT" and result.ok
+    assert text.startswith("<?xml")
+    assert vat_client.validation_cache.stats()["hits"] == 1
+
+
+def test_failed_exchange_raises():
+    async def run(fake):
+        async with AsyncTransport() as transport:
+            await _client(fake, transport).set_altinn_token()
+
+    with FakeAltinn(error_rate=1.0, error_status=500) as fake:
+        with pytest.raises(aiohttp.ClientResponseError):
+            asyncio.run(run(fake))
+
+
+def test_call_async_hedges_slow_attempts():
+    policy = HedgePolicy(min_delay=0.01, min_samples=1, budget=1.0)
+    delays = iter([0.0, 1.0, 0.0])
+    cancelled = []
+
+    async def send():
+        delay = next(delays)
+        try:
+            await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            cancelled.append(delay)
+            raise
+        return delay
+
+    async def run():
+        await policy.call_async(send, "op")
+        return await policy.call_async(send, "op")
+
+    assert asyncio.run(run()) == 0.0
+    assert policy.stats()["op"] == {
+        "calls": 2, "hedged": 1, "hedge_wins": 1, "denied": 0
+    }
+    assert cancelled == [1.0]
+    policy.close()
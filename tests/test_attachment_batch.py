@@ -0,0 +1,70 @@
+import os
+
+import pytest
+
+from attachments import AttachmentUpload
+from client import VatReturn
+from fake_altinn import FakeAltinn
+from transport import Transport
+
+
+@pytest.fixture
+def failing_altinn():
+    with FakeAltinn(error_rate=1.0, error_status=500) as fake:
+        yield fake
+
+
+def _client(fake: FakeAltinn) -> VatReturn:
+    vat_client = VatReturn(
+        id_porten_auth_headers={"Authorization": "Bearer test"},
+        altinn_environment=fake.url,
+        id_porten_environment=fake.url,
+        instance_api_url=fake.instance_api_url,
+        transport=Transport(),
+    )
+    vat_client.altinn_token = "test"
+    return vat_client
+
+
+def _pipe(content: bytes):
+    read_end, write_end = os.pipe()
+    os.write(write_end, content)
+    os.close(write_end)
+    return os.fdopen(read_end, "rb")
+
+
+def test_failed_uploads_are_retried_and_pipes_are_not(failing_altinn):
+    pipe = _pipe(b"<xml/>")
+    results = _client(failing_altinn).upload_attachments_batch(
+        f"{failing_altinn.instance_api_url}/1/abc",
+        [("text/xml", "a.xml", b"<xml/>"), ("text/xml", "b.xml", pipe)],
+        max_attempts=3,
+        retry_wait=0,
+    )
+    pipe.close()
+    assert [result.status for result in results] == ["failed", "failed"]
+    assert [result.attempts for result in results] == [3, 1]
+    assert results[0].error.startswith("HTTP 500")
+
+
+def test_previous_must_match_the_attachments(failing_altinn):
+    with pytest.raises(ValueError):
+        _client(failing_altinn).upload_attachments_batch(
+            f"{failing_altinn.instance_api_url}/1/abc",
+            [("text/xml", "a.xml", b"<xml/>")],
+            previous=[],
+        )
+
+
+def test_previous_uploads_are_skipped(failing_altinn):
+    previous = [
+        AttachmentUpload("a.xml", "text/xml", status="uploaded"),
+        AttachmentUpload("b.xml", "text/xml", status="failed"),
+    ]
+    results = _client(failing_altinn).upload_attachments_batch(
+        f"{failing_altinn.instance_api_url}/1/abc",
+        [("text/xml", "a.xml", b"a"), ("text/xml", "b.xml", b"b")],
+        max_attempts=1,
+        previous=previous,
+    )
+    assert [result.status for result in results] == ["skipped", "failed"]
@@ -0,0 +1,32 @@
+from bulk import run_bulk
+from client import VatReturn
+from fake_altinn import FakeAltinn
+from submission import Filing
+from transport import Transport
+
+
+def _client(fake):
+    vat_client = VatReturn(
+        id_porten_auth_headers={"Authorization": "Bearer test"},
+        altinn_environment=fake.url,
+        id_porten_environment=fake.url,
+        instance_api_url=fake.instance_api_url,
+        transport=Transport(),
+    )
+    vat_client.altinn_token = "test"
+    return vat_client
+
+
+def test_failing_on_result_keeps_the_summary(caplog):
+    filings = [Filing(str(org), b"<melding/>", b"<konvolutt/>")
+               for org in (999999991, 999999992, 999999993)]
+
+    def on_result(result):
+        raise RuntimeError("callback broke")
+
+    with FakeAltinn() as fake:
+        summary = run_bulk(_client(fake), filings, max_workers=2,
+                           wait_for_feedback=False, on_result=on_result)
+    assert [result.status for result in summary.results] == \
+        ["submitted"] * 3
+    assert caplog.text.count("on_result failed") == 3
@@ -0,0 +1,34 @@
+import json
+import os
+import subprocess
+import sys
+
+from fake_altinn import FakeAltinn
+from run_benchmarks import CLIENT_DIR, EXAMPLE_FILES, HEAVY_MODULES, _CLI_RUN
+
+# Generous for slow CI machines; a heavy import (numpy, lxml, aiohttp,
+# cryptography) alone takes longer on most machines.
+MAX_IMPORT_MS = 250
+
+
+def test_validate_with_token_keeps_stdout_json_and_imports_little():
+    argv = [
+        "validate",
+        str(EXAMPLE_FILES / "message" / "compensation_vat_message.xml"),
+    ]
+    with FakeAltinn() as fake:
+        process = subprocess.run(
+            [sys.executable, "-c", _CLI_RUN.format(
+                client_dir=str(CLIENT_DIR),
+                argv=["--validation-url", fake.url] + argv,
+                heavy=HEAVY_MODULES,
+            )],
+            env=dict(os.environ, ID_PORTEN_TOKEN="Bearer test"),
+            capture_output=True, text=True, timeout=60,
+        )
+    assert process.returncode == 0, process.stderr
+    result = json.loads(process.stdout)
+    assert result[0]["summary"]["status"] == "GODKJENT"
+    report = json.loads(process.stderr.strip().splitlines()[-1])
+    assert report["heavy_modules"] == []
+    assert report["import_ms"] < MAX_IMPORT_MS
@@ -0,0 +1,25 @@
+from feedback_poller import FeedbackPoller
+
+
+class _Client:
+    def get_feedback_status(self, instance_url):
+        return True
+
+    def get_feedback(self, instance_url):
+        return {"instance": instance_url}
+
+
+def test_failing_callback_does_not_hang_results(caplog):
+    def on_result(result):
+        raise RuntimeError("callback failed")
+
+    with FeedbackPoller(
+            _Client(), initial_delay=0, jitter=0, on_result=on_result
+    ) as poller:
+        poller.add("a")
+        poller.add("b")
+        assert poller.wait(timeout=5)
+        results = list(poller.results(timeout=5))
+    assert sorted(result.instance_url for result in results) == ["a", "b"]
+    assert {result.status for result in results} == {"feedback"}
+    assert caplog.text.count("on_result failed") == 2
@@ -0,0 +1,40 @@
+import threading
+import time
+
+from hedging import HedgePolicy
+
+
+def test_calls_without_enough_samples_run_on_the_caller_thread():
+    policy = HedgePolicy(min_samples=5)
+    assert policy.call(threading.get_ident, "op") == threading.get_ident()
+    policy.close()
+
+
+def test_queue_time_is_not_taken_for_slowness():
+    policy = HedgePolicy(min_delay=0.05, min_samples=1, budget=1.0,
+                         max_workers=1)
+    policy.call(lambda: None, "op")
+    # The only worker is busy for a while, the next call queues behind it.
+    release = threading.Event()
+    policy._executor.submit(release.wait)
+    threading.Timer(0.2, release.set).start()
+    assert policy.call(lambda: "first", "op") == "first"
+    assert policy.stats()["op"]["hedged"] == 0
+    policy.close()
+
+
+def test_slow_first_attempt_is_hedged():
+    policy = HedgePolicy(min_delay=0.02, min_samples=1, budget=1.0)
+    policy.call(lambda: None, "op")
+    attempts = []
+
+    def send():
+        attempts.append(None)
+        if len(attempts) == 1:
+            time.sleep(0.5)
+            return "first"
+        return "hedge"
+
+    assert policy.call(send, "op") == "hedge"
+    assert policy.stats()["op"]["hedge_wins"] == 1
+    policy.close()
@@ -0,0 +1,63 @@
+import pytest
+
+from instance_index import InstanceIndex, changed_at
+from settings import VAT_APP_ID
+
+
+def _instance(number: int, last_changed: str):
+    url = f"https://altinn/instances/5000/{number:08d}"
+    return {
+        "id": f"5000/{number:08d}",
+        "selfLinks": {"apps": url},
+        "lastChanged": last_changed,
+        "process": {"currentTask": {"elementId": "Task_2"}},
+    }
+
+
+class _Pages:
+    """query_instances over fixed pages, failing at page 'fail_at'."""
+
+    def __init__(self, pages, fail_at=None):
+        self.pages = pages
+        self.fail_at = fail_at
+        self.params = []
+
+    def query_instances(self, params=None, url=None):
+        number = 0 if url is None else int(url)
+        if url is None:
+            self.params.append(params)
+        if number == self.fail_at:
+            raise ConnectionError("page failed")
+        return {
+            "instances": self.pages[number],
+            "next": str(number + 1) if number + 1 < len(self.pages) else None,
+        }
+
+
+def test_changed_at_compares_in_time_order():
+    assert changed_at("2024-01-01T10:00:00.5Z") > \
+        changed_at("2024-01-01T10:00:00.1234567Z")
+    assert changed_at("2024-01-01T11:00:00+01:00") == \
+        changed_at("2024-01-01T10:00:00Z")
+    assert changed_at("not a time") is None
+
+
+def test_cursor_moves_only_after_the_last_page(tmp_path):
+    index = InstanceIndex(tmp_path / "index.db")
+    pages = [
+        [_instance(1, "2024-01-03T00:00:00.5Z")],
+        [_instance(2, "2024-01-01T00:00:00Z")],
+        [_instance(3, "2024-01-03T00:00:00.4999999Z")],
+    ]
+    with pytest.raises(ConnectionError):
+        index.sync(_Pages(pages, fail_at=1))
+    query = {"appId": VAT_APP_ID}
+    assert index.cursor(dict(query)) is None
+    assert len(index.instances()) == 1
+
+    client = _Pages(pages)
+    assert index.sync(client) == 3
+    assert index.cursor(dict(query)) == "2024-01-03T00:00:00.5Z"
+
+    index.sync(client)
+    assert client.params[-1]["lastChanged"] == "gte:2024-01-03T00:00:00.5Z"
@@ -0,0 +1,86 @@
+from client import VatReturn
+from fake_altinn import FakeAltinn
+from journal import SubmissionJournal
+from submission import Attachment, Filing, submit_filing
+from transport import Transport
+
+
+class _FailingSecondShip(VatReturn):
+    """Dies on the second ship, like a worker killed half way."""
+
+    ships = 0
+
+    def ship_to_next_process(self, instance_url):
+        self.ships += 1
+        if self.ships == 2:
+            raise ConnectionError("worker died")
+        return super().ship_to_next_process(instance_url)
+
+
+def _client(fake, cls=VatReturn):
+    vat_client = cls(
+        id_porten_auth_headers={"Authorization": "Bearer test"},
+        altinn_environment=fake.url,
+        id_porten_environment=fake.url,
+        instance_api_url=fake.instance_api_url,
+        transport=Transport(),
+    )
+    vat_client.altinn_token = "test"
+    return vat_client
+
+
+def test_interrupted_filing_resumes_on_its_instance(tmp_path):
+    attachment = tmp_path / "a.pdf"
+    attachment.write_bytes(b"%PDF-1.4")
+    filing = Filing(
+        "999999999", b"<melding/>", b"<konvolutt/>",
+        [Attachment("application/pdf", "a.pdf", attachment)],
+    )
+    journal = SubmissionJournal(tmp_path / "journal.db")
+    with FakeAltinn() as fake:
+        first = submit_filing(
+            _client(fake, _FailingSecondShip), filing,
+            journal=journal, wait_for_feedback=False,
+        )
+        assert first.status == "failed"
+        sent = dict(fake.requests)
+
+        second = submit_filing(
+            _client(fake), filing, journal=journal, wait_for_feedback=False,
+        )
+        assert second.status == "submitted"
+        assert second.instance_url == first.instance_url
+        assert {"create", "envelope", "message", "attachment:a.pdf",
+                "ship_1"} <= set(second.resumed_steps)
+        resent = {
+            endpoint: count - sent.get(endpoint, 0)
+            for endpoint, count in fake.requests.items()
+            if count != sent.get(endpoint, 0)
+        }
+        # Only the validation and the missing ship are sent again.
+        assert set(resent) <= {"POST valider", "PUT process/next"}
+        assert resent["PUT process/next"] == 1
+
+        third = submit_filing(
+            _client(fake), filing, journal=journal, wait_for_feedback=False,
+        )
+        assert third.status == "submitted"
+        assert fake.requests["PUT process/next"] == 2
+
+
+def test_changed_attachment_is_uploaded_again(tmp_path):
+    attachment = tmp_path / "a.pdf"
+    attachment.write_bytes(b"%PDF-1.4")
+    filing = Filing(
+        "999999999", b"<melding/>", b"<konvolutt/>",
+        [Attachment("application/pdf", "a.pdf", attachment)],
+    )
+    journal = SubmissionJournal(tmp_path / "journal.db")
+    with FakeAltinn() as fake:
+        submit_filing(_client(fake, _FailingSecondShip), filing,
+                      journal=journal, wait_for_feedback=False)
+        uploads = fake.requests["POST data"]
+        attachment.write_bytes(b"%PDF-1.5")
+        submit_filing(_client(fake), filing, journal=journal,
+                      wait_for_feedback=False)
+        assert fake.requests["POST data"] == uploads + 1
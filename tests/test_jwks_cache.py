@@ -0,0 +1,56 @@
+import json
+
+import pytest
+import requests
+
+from jwks_cache import JwksCache
+
+JWKS = {"keys": [{"kid": "a"}]}
+
+
+class _Response:
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self.body = body
+
+    def json(self):
+        return self.body
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"{self.status_code}")
+
+
+class _Transport:
+    def __init__(self, jwks_response):
+        self.jwks_response = jwks_response
+        self.gets = 0
+
+    def get(self, url):
+        self.gets += 1
+        if url == "https://idporten/config":
+            return _Response(200, {"jwks_uri": "https://idporten/jwks"})
+        return self.jwks_response
+
+
+def _cache(tmp_path, response):
+    return JwksCache(
+        jwk_url="https://idporten/config",
+        cache_file=tmp_path / "jwks.json",
+        transport=_Transport(response),
+    )
+
+
+@pytest.mark.parametrize("stored", [{"fetched_at": 1e12}, [], "jwks"])
+def test_malformed_cache_file_is_fetched_again(tmp_path, stored):
+    (tmp_path / "jwks.json").write_text(json.dumps(stored))
+    cache = _cache(tmp_path, _Response(200, JWKS))
+    assert cache.get_jwks() == JWKS
+    assert cache.transport.gets == 2
+
+
+def test_error_response_is_not_cached(tmp_path):
+    cache = _cache(tmp_path, _Response(503, {"error": "unavailable"}))
+    with pytest.raises(requests.HTTPError):
+        cache.get_jwks()
+    assert not (tmp_path / "jwks.json").exists()
@@ -0,0 +1,34 @@
+from client import VatReturn
+from fake_altinn import FakeAltinn
+from metrics import Instrumentation
+from transport import Transport
+
+
+def test_attachment_uploads_are_named_after_the_public_method():
+    instrumentation = Instrumentation()
+    events = []
+    instrumentation.add_hook(events.append)
+    with FakeAltinn() as fake:
+        vat_client = VatReturn(
+            id_porten_auth_headers={"Authorization": "Bearer test"},
+            altinn_environment=fake.url,
+            id_porten_environment=fake.url,
+            instance_api_url=fake.instance_api_url,
+            transport=Transport(instrumentation=instrumentation),
+        )
+        vat_client.altinn_token = "test"
+        instance = vat_client.create_instance("999999999")
+        instance_url = instance["selfLinks"]["apps"]
+        vat_client.upload_attachments(
+            instance_url, "application/pdf", "a.pdf", b"%PDF"
+        )
+        vat_client.upload_attachments_batch(
+            instance_url, [("application/pdf", "b.pdf", b"%PDF")] * 2
+        )
+    assert [event.operation for event in events] == [
+        "create_instance"
+    ] + ["upload_attachments"] * 3
+    create = events[0]
+    assert create.bytes_sent == len(
+        b'{"instanceOwner": {"organisationNumber": "999999999"}}'
+    )
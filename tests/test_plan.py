@@ -0,0 +1,92 @@
+import threading
+import time
+
+import pytest
+
+from plan import Step, run_plan
+
+
+def _sleep(seconds, value=None):
+    def run():
+        time.sleep(seconds)
+        return value
+    return run
+
+
+def test_steps_start_after_their_dependencies_and_overlap_otherwise():
+    run = run_plan([
+        Step("create", _sleep(0.05, "instance")),
+        Step("validate", _sleep(0.05)),
+        Step("upload_a", _sleep(0.05), after=("create",)),
+        Step("upload_b", _sleep(0.05), after=("create",)),
+        Step("ship", _sleep(0.01), after=("upload_a", "upload_b",
+                                          "validate")),
+    ])
+    run.raise_error()
+    timings = run.timings
+    assert timings["upload_a"].start >= timings["create"].end
+    assert timings["ship"].start >= max(
+        timings[name].end for name in ("upload_a", "upload_b", "validate")
+    )
+    # validate ran alongside create, the uploads alongside each other.
+    assert timings["validate"].start < timings["create"].end
+    assert timings["upload_b"].start < timings["upload_a"].end
+    assert run.results["create"] == "instance"
+    assert run.critical_path()[-1] == "ship"
+    assert run.critical_path()[0] in ("create", "validate")
+
+
+def test_failure_stops_the_steps_after_it():
+    ran = []
+
+    def fail():
+        raise RuntimeError("upload failed")
+
+    run = run_plan([
+        Step("create", lambda: ran.append("create")),
+        Step("upload", fail, after=("create",)),
+        Step("ship", lambda: ran.append("ship"), after=("upload",)),
+    ])
+    assert run.failed_step == "upload"
+    assert run.skipped == ["ship"]
+    assert ran == ["create"]
+    assert run.timings["upload"].status == "failed"
+    with pytest.raises(RuntimeError):
+        run.raise_error()
+
+
+def test_one_worker_runs_steps_one_at_a_time():
+    active, most = [0], [0]
+    lock = threading.Lock()
+
+    def step():
+        with lock:
+            active[0] += 1
+            most[0] = max(most[0], active[0])
+        time.sleep(0.01)
+        with lock:
+            active[0] -= 1
+
+    run_plan([Step(str(number), step) for number in range(4)], max_workers=1)
+    assert most[0] == 1
+
+
+def test_unknown_dependencies_and_cycles_are_refused():
+    with pytest.raises(ValueError):
+        run_plan([Step("a", lambda: None, after=("b",))])
+    with pytest.raises(ValueError):
+        run_plan([
+            Step("a", lambda: None, after=("b",)),
+            Step("b", lambda: None, after=("a",)),
+        ])
+
+
+def test_cycle_is_refused_before_any_step_runs():
+    ran = []
+    with pytest.raises(ValueError, match="cycle"):
+        run_plan([
+            Step("create", lambda: ran.append("create")),
+            Step("a", lambda: None, after=("create", "b")),
+            Step("b", lambda: None, after=("a",)),
+        ])
+    assert ran == []
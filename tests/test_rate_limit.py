@@ -0,0 +1,71 @@
+import asyncio
+import os
+import threading
+import time
+
+from rate_limit import HostLimiter, latency_class, rewind_body
+from streaming import UploadBody
+
+
+def test_rewind_body_buffers_and_seekable_bodies():
+    for data in (None, b"x", bytearray(b"x"), memoryview(b"x"), "x",
+                 {"a": "b"}, [("a", "b")]):
+        assert rewind_body(data)
+    body = UploadBody(b"content")
+    body.read()
+    assert rewind_body(body)
+    assert body.bytes_read == 0
+
+
+def test_rewind_body_refuses_pipes_and_iterators():
+    read_end, write_end = os.pipe()
+    os.close(write_end)
+    with os.fdopen(read_end, "rb") as pipe:
+        assert not rewind_body(UploadBody(pipe))
+    assert not rewind_body(UploadBody(iter([b"x"])))
+    assert not rewind_body(iter([b"x"]))
+
+
+def test_rewind_body_returns_false_when_the_seek_fails():
+    class Broken:
+        def rewindable(self):
+            return True
+
+        def rewind(self):
+            raise OSError("gone")
+
+    assert not rewind_body(Broken())
+
+
+def test_slow_large_uploads_do_not_count_as_overload():
+    limiter = HostLimiter(initial_limit=8, latency_margin=0.0)
+    status = latency_class("get_feedback_status", 0)
+    upload = latency_class("upload_attachments", 25 * 1024 * 1024)
+    assert status != upload
+    for _ in range(20):
+        limiter.acquire()
+        limiter.release(0.01, 200, kind=status)
+        limiter.acquire()
+        limiter.release(2.0, 200, kind=upload)
+    assert limiter.stats()["overloaded"] == 0
+    limiter.acquire()
+    limiter.release(1.0, 200, kind=status)
+    assert limiter.stats()["overloaded"] == 1
+
+
+def test_async_waiters_are_woken_by_a_release_from_another_thread():
+    limiter = HostLimiter(initial_limit=1, max_limit=1)
+    limiter.acquire()
+
+    async def wait_for_slot():
+        start = time.monotonic()
+        await limiter.acquire_async()
+        return time.monotonic() - start
+
+    timer = threading.Timer(0.05, limiter.release, (0.01, 200))
+    timer.start()
+    waited = asyncio.run(wait_for_slot())
+    timer.join()
+    assert 0.04 < waited < 1
+    assert limiter.stats()["in_flight"] == 1
+    assert not limiter._async_waiters
@@ -0,0 +1,64 @@
+import hashlib
+import io
+import os
+
+import pytest
+
+from streaming import UploadBody
+
+
+def _pipe(content: bytes):
+    read_end, write_end = os.pipe()
+    os.write(write_end, content)
+    os.close(write_end)
+    return os.fdopen(read_end, "rb")
+
+
+@pytest.mark.parametrize("source", [
+    b"content", bytearray(b"content"), memoryview(b"content"), "content",
+])
+def test_buffers_rewind(source):
+    body = UploadBody(source)
+    first = body.read()
+    assert body.rewindable()
+    body.rewind()
+    assert body.read() == first
+    assert body.bytes_read == len(first)
+
+
+def test_seekable_file_rewinds_to_its_start_position(tmp_path):
+    path = tmp_path / "body.bin"
+    path.write_bytes(b"skip-content")
+    with open(path, "rb") as file:
+        file.seek(5)
+        body = UploadBody(file)
+        assert body.length == 7
+        assert body.read() == b"content"
+        body.rewind()
+        assert body.read() == b"content"
+
+
+def test_path_source(tmp_path):
+    path = tmp_path / "body.bin"
+    path.write_bytes(b"content")
+    body = UploadBody(path)
+    assert body.rewindable() and body.length == 7
+    body.close()
+
+
+def test_pipe_is_not_rewindable():
+    pipe = _pipe(b"content")
+    body = UploadBody(pipe)
+    assert not body.rewindable()
+    assert body.length is None
+    assert body.read() == b"content"
+    with pytest.raises(io.UnsupportedOperation):
+        body.rewind()
+    pipe.close()
+
+
+def test_iterator_is_not_rewindable():
+    body = UploadBody(iter([b"con", b"tent"]))
+    assert not body.rewindable()
+    assert b"".join(body) == b"content"
+    assert body.sha256 == hashlib.sha256(b"content").hexdigest()
@@ -0,0 +1,76 @@
+import threading
+import time
+
+from fake_altinn import fake_token
+from token_cache import AltinnTokenManager
+
+HEADERS = {"Authorization": "Bearer id-porten"}
+
+
+def _exchange(calls, delay=0.1, error=None):
+    def exchange():
+        calls.append(None)
+        time.sleep(delay)
+        if error is not None:
+            raise error
+        return fake_token().decode()
+    return exchange
+
+
+def _in_threads(count, target):
+    results, threads = [], []
+
+    def run():
+        try:
+            results.append(target())
+        except Exception as error:
+            results.append(error)
+
+    for _ in range(count):
+        threads.append(threading.Thread(target=run))
+        threads[-1].start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_concurrent_callers_share_one_exchange():
+    manager, calls = AltinnTokenManager(), []
+    tokens = _in_threads(
+        16, lambda: manager.get_token(HEADERS, _exchange(calls))
+    )
+    assert len(calls) == 1
+    assert len(set(tokens)) == 1
+    assert manager.stats()["waits"] + manager.stats()["misses"] == 16
+
+
+def test_waiters_get_the_error_of_the_exchange():
+    manager, calls = AltinnTokenManager(), []
+    results = _in_threads(8, lambda: manager.get_token(
+        HEADERS, _exchange(calls, error=ConnectionError("exchange down"))
+    ))
+    assert len(calls) == 1
+    assert all(isinstance(result, ConnectionError) for result in results)
+    # The failed exchange is not cached, the next caller tries again.
+    manager.get_token(HEADERS, _exchange(calls, delay=0))
+    assert len(calls) == 2
+
+
+def test_token_is_exchanged_again_near_expiry():
+    now = [time.time()]
+    manager = AltinnTokenManager(refresh_margin=60, clock=lambda: now[0])
+    calls = []
+    manager.get_token(HEADERS, _exchange(calls, delay=0))
+    manager.get_token(HEADERS, _exchange(calls, delay=0))
+    assert len(calls) == 1
+    now[0] += 1800 - 59
+    manager.get_token(HEADERS, _exchange(calls, delay=0))
+    assert len(calls) == 2
+
+
+def test_identities_do_not_share_tokens():
+    manager, calls = AltinnTokenManager(), []
+    manager.get_token(HEADERS, _exchange(calls, delay=0))
+    manager.get_token({"Authorization": "Bearer other"},
+                      _exchange(calls, delay=0))
+    assert len(calls) == 2
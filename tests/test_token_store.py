@@ -0,0 +1,34 @@
+import stat
+import threading
+import time
+
+from token_store import TokenSet, TokenStore
+
+
+def _mode(path):
+    return stat.S_IMODE(path.stat().st_mode)
+
+
+def test_folder_and_files_are_private(tmp_path):
+    store = TokenStore(tmp_path / "tokens", key=None)
+    store.save("client", "user", TokenSet("access", time.time() + 60))
+    assert _mode(store.path) == 0o700
+    assert _mode(store.path / ".key") == 0o600
+    for path in store.path.glob("*.token"):
+        assert _mode(path) == 0o600
+    assert store.load("client", "user").access_token == "access"
+
+
+def test_stores_racing_for_the_key_agree(tmp_path):
+    stores = [TokenStore(tmp_path, key=None) for _ in range(8)]
+    keys = []
+    threads = [
+        threading.Thread(target=lambda s=store: keys.append(s._key_file()))
+        for store in stores
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(set(keys)) == 1 and keys[0]
+    assert [path.name for path in tmp_path.iterdir()] == [".key"]
@@ -0,0 +1,58 @@
+import time
+
+from validation_cache import ValidationCache, cache_key
+
+MESSAGE = b"<melding><a>1</a>\n  <b>2</b></melding>"
+
+
+def test_formatting_does_not_change_the_key():
+    reformatted = b"<melding>\n<a>1</a><b>2</b>\n</melding>"
+    assert cache_key(MESSAGE, "test") == cache_key(reformatted, "test")
+    assert cache_key(MESSAGE, "test") != cache_key(MESSAGE, "prod")
+
+
+def test_whitespace_inside_values_changes_the_key():
+    padded = b"<melding><a> 1 </a>\n  <b>2</b></melding>"
+    assert cache_key(MESSAGE, "test") != cache_key(padded, "test")
+
+
+def test_key_of_non_utf8_or_broken_message_falls_back_to_bytes():
+    latin1 = "<melding>Bodø</melding>".encode("latin-1")
+    assert cache_key(latin1, "test") != cache_key(b"<melding/>", "test")
+    assert cache_key(b"<melding>", "test") == cache_key(b"<melding>", "test")
+
+
+def test_known_bytes_are_not_canonicalised_again(monkeypatch):
+    import validation_cache
+
+    cache = ValidationCache(path=None)
+    key = cache.key(MESSAGE, "test")
+    assert key == cache_key(MESSAGE, "test")
+
+    def fail(*args, **kwargs):
+        raise AssertionError("canonicalised a known message")
+
+    monkeypatch.setattr(validation_cache, "cache_key", fail)
+    assert cache.key(MESSAGE, "test") == key
+    assert cache.key(MESSAGE.decode(), "test") == key
+
+
+def test_lookup_of_large_message_is_fast():
+    rows = b"".join(
+        b"<linje><kode>%d</kode><belop>%d.00</belop></linje>" % (i, i)
+        for i in range(16000)
+    )
+    message = b"<melding>" + rows + b"</melding>"
+    cache = ValidationCache(path=None)
+    cache.put(cache.key(message, "test"), "<ok/>")
+    start = time.perf_counter()
+    assert cache.get(cache.key(message, "test")) == "<ok/>"
+    assert time.perf_counter() - start < 0.02
+
+
+def test_shared_disk_store(tmp_path):
+    path = tmp_path / "validation.db"
+    ValidationCache(path=path).put(cache_key(MESSAGE, "test"), "<ok/>")
+    other = ValidationCache(path=path)
+    assert other.get(other.key(MESSAGE, "test")) == "<ok/>"
+    assert other.stats()["disk_hits"] == 1
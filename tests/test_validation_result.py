@@ -0,0 +1,51 @@
+from client import VatReturn
+from fake_altinn import FakeAltinn
+from transport import Transport
+from validation_cache import ValidationCache
+from validation_result import has_errors, parse_validation
+
+RESPONSE = (
+    b'<valideringsresultat xmlns="no:skatteetaten:fastsetting:avgift:mva:'
+    b'valideringsresultat:v0.1"><status>UGYLDIG_SKATTEMELDING</status>'
+    b'<valideringsfunn><alvorlighetsgrad>AVVIKENDE</alvorlighetsgrad>'
+    b'<kode>A1</kode><sti>/a</sti></valideringsfunn>'
+    b'<valideringsfunn><alvorlighetsgrad>FEIL</alvorlighetsgrad>'
+    b'<kode>F1</kode><sti>/b</sti><sti>/c</sti></valideringsfunn>'
+    b'</valideringsresultat>'
+)
+
+
+def test_parse_in_chunks():
+    chunks = [RESPONSE[i:i + 7] for i in range(0, len(RESPONSE), 7)]
+    result = parse_validation(chunks)
+    assert (result.errors, result.deviations, result.warnings) == (1, 1, 0)
+    assert result.findings[1].paths == ["/b", "/c"]
+    assert not result.ok
+
+
+def test_has_errors_stops_at_the_first_error():
+    read = []
+
+    def chunks():
+        for chunk in (RESPONSE, b"<not xml"):
+            read.append(chunk)
+            yield chunk
+
+    assert has_errors(chunks())
+    assert len(read) == 1
+
+
+def test_client_parses_the_streamed_response():
+    with FakeAltinn() as fake:
+        vat_client = VatReturn(
+            id_porten_auth_headers={"Authorization": "Bearer test"},
+            altinn_environment=fake.url,
+            id_porten_environment=fake.url,
+            instance_api_url=fake.instance_api_url,
+            transport=Transport(),
+            validation_cache=ValidationCache(path=None),
+        )
+        result = vat_client.validate_tax_return_result(b"<melding/>")
+        assert result.status == "GODKJENT" and result.ok
+        assert vat_client.validate_tax_return(b"<melding/>").startswith("<?xml")
+        assert vat_client.validation_cache.stats()["hits"] == 1
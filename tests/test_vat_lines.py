@@ -0,0 +1,17 @@
+import pytest
+
+from vat_lines import VatLines
+
+MESSAGE = (
+    b"<mvaMelding><skattegrunnlagOgBeregnetSkatt>"
+    b"<mvaSpesifikasjonslinje><mvaKode>1</mvaKode>"
+    b"<merverdiavgift>100</merverdiavgift></mvaSpesifikasjonslinje>"
+    b"<mvaSpesifikasjonslinje>"
+    b"<merverdiavgift>50</merverdiavgift></mvaSpesifikasjonslinje>"
+    b"</skattegrunnlagOgBeregnetSkatt></mvaMelding>"
+)
+
+
+def test_line_without_code_is_reported_by_number():
+    with pytest.raises(ValueError, match="mvaSpesifikasjonslinje 2"):
+        VatLines.from_bytes(MESSAGE)
@@ -0,0 +1,109 @@
+import logging
+import time
+
+import pytest
+
+from client import VatReturn
+from fake_altinn import FakeAltinn
+from submission import Filing, FilingResult
+from transport import Transport
+from work_queue import FilingQueue, run_worker
+
+
+def _filings(count: int):
+    return [
+        Filing(f"{number:09d}", b"<melding/>", b"<konvolutt/>")
+        for number in range(count)
+    ]
+
+
+def _result(job):
+    return FilingResult(job.filing.org_number, status="validated")
+
+
+@pytest.fixture
+def queue(tmp_path):
+    return FilingQueue(tmp_path / "queue.db", lease_seconds=60)
+
+
+def test_enqueue_skips_filings_already_queued(queue):
+    assert queue.enqueue(_filings(3)) == 3
+    assert queue.enqueue(_filings(4)) == 1
+    assert queue.counts() == {"queued": 4}
+
+
+def test_claims_do_not_overlap(queue):
+    queue.enqueue(_filings(5))
+    first = queue.claim("a", 3)
+    second = queue.claim("b", 3)
+    assert len(first) == 3 and len(second) == 2
+    assert not {job.id for job in first} & {job.id for job in second}
+    assert queue.claim("c", 1) == []
+
+
+def test_expired_lease_is_claimed_again_and_the_old_worker_loses_it(queue):
+    queue.lease_seconds = 0.05
+    queue.enqueue(_filings(1))
+    (job,) = queue.claim("a")
+    assert queue.renew("a", [job.id]) == 1
+    time.sleep(0.1)
+    (again,) = queue.claim("b")
+    assert again.id == job.id and again.attempts == 2
+    assert queue.renew("a", [job.id]) == 0
+    result = _result(job)
+    assert not queue.complete("a", job.id, result)
+    assert queue.complete("b", job.id, result)
+    assert queue.counts() == {"done": 1}
+
+
+def test_job_out_of_attempts_is_failed(queue):
+    queue.lease_seconds = 0.01
+    queue.max_attempts = 2
+    queue.enqueue(_filings(1))
+    for worker in ("a", "b"):
+        assert queue.claim(worker)
+        time.sleep(0.02)
+    assert queue.claim("c") == []
+    assert queue.counts() == {"failed": 1}
+    assert queue.requeue_failed() == 1
+    assert queue.claim("c")[0].attempts == 1
+
+
+def test_release_puts_jobs_back_without_using_an_attempt(queue):
+    queue.enqueue(_filings(2))
+    jobs = queue.claim("a", 2)
+    queue.release("a", [job.id for job in jobs])
+    assert [job.attempts for job in queue.claim("b", 2)] == [1, 1]
+
+
+def test_worker_survives_failing_renewals_and_callbacks(
+        queue, monkeypatch, caplog
+):
+    queue.lease_seconds = 0.3
+
+    def failing_renew(worker, job_ids):
+        raise OSError("disk gone")
+
+    monkeypatch.setattr(queue, "renew", failing_renew)
+    queue.enqueue(_filings(3))
+
+    def on_result(result):
+        raise RuntimeError("callback failed")
+
+    with FakeAltinn(latency=0.15) as fake:
+        vat_client = VatReturn(
+            id_porten_auth_headers={"Authorization": "Bearer test"},
+            altinn_environment=fake.url,
+            id_porten_environment=fake.url,
+            instance_api_url=fake.instance_api_url,
+            transport=Transport(),
+        )
+        vat_client.altinn_token = "test"
+        with caplog.at_level(logging.WARNING, logger="work_queue"):
+            summary = run_worker(
+                vat_client, queue, concurrency=1, validate_only=True,
+                poll_interval=0.05, on_result=on_result,
+            )
+    assert len(summary.results) == 3
+    assert queue.counts() == {"done": 3}
+    assert "Renewing" in caplog.text and "on_result failed" in caplog.text